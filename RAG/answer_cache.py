@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""質問の埋め込みで引く回答キャッシュ（query.py --answer-cache から使う）。
+
+- キー: (インデックス, 回答に効く設定のハッシュ, インデックスの版) ごとに、質問ベクトルのコサイン類似度で引く。
+  言い回しが違っても --cache-similarity 以上近い質問があれば、保存済みの回答と根拠チャンクをそのまま返す
+  （埋め込み1回で済み、検索と Chat を省ける）。
+- 失効: インデックスの版（common.index_version。index.* / meta.* の更新時刻とサイズ）が変わったら、
+  そのインデックスの古い回答を捨てる。
+- 保存先は標準ライブラリの sqlite3。件数が上限を超えたら最終利用が古いものから捨てる。
+  ヒット・ミスの累計もインデックスごとに記録する。
+
+環境変数:
+  RAG_ANSWER_CACHE      キャッシュファイルのパス（"off" で無効化。既定: ./RAG/cache/answers.sqlite）
+  RAG_ANSWER_CACHE_MAX  保存する回答の最大件数（既定: 10000）
+
+使い方（ヒット率の確認・消去）:
+  python RAG/answer_cache.py
+  python RAG/answer_cache.py --clear
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import normalize_rows, pretty
+
+DEFAULT_PATH = "./RAG/cache/answers.sqlite"
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_SIMILARITY = 0.95
+
+
+def config_key(settings: Dict[str, Any]) -> str:
+    """回答に効く設定（モデル・プロンプト・k など）のハッシュ。どれかが変われば別のキャッシュになる"""
+    return hashlib.sha256(json.dumps(settings, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class AnswerCache:
+    def __init__(self, path: Path, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = int(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (index, config, version) -> (id の配列, 正規化した質問ベクトルの行列)
+        self._mats: Dict[Tuple[str, str, str], Tuple[Any, Any]] = {}
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY, idx TEXT NOT NULL, config TEXT NOT NULL, version TEXT NOT NULL,"
+            " question TEXT NOT NULL, qvec BLOB NOT NULL, answer TEXT NOT NULL, contexts TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_key ON answers (idx, config, version)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_lru ON answers (last_used)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stats ("
+            " idx TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0,"
+            " expired INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.commit()
+
+    def _count(self, idx: str, hits: int = 0, misses: int = 0, expired: int = 0) -> None:
+        self._db.execute("INSERT OR IGNORE INTO stats (idx) VALUES (?)", (idx,))
+        self._db.execute(
+            "UPDATE stats SET hits=hits+?, misses=misses+?, expired=expired+? WHERE idx=?", (hits, misses, expired, idx)
+        )
+
+    def _expire(self, idx: str, version: str) -> None:
+        cur = self._db.execute("DELETE FROM answers WHERE idx=? AND version!=?", (idx, version))
+        if cur.rowcount:
+            self._count(idx, expired=cur.rowcount)
+            self._mats = {key: v for key, v in self._mats.items() if key[0] != idx or key[2] == version}
+
+    def _matrix(self, key: Tuple[str, str, str]):
+        import numpy as np
+
+        if key not in self._mats:
+            rows = self._db.execute("SELECT id, qvec FROM answers WHERE idx=? AND config=? AND version=?", key).fetchall()
+            ids = np.asarray([r[0] for r in rows], dtype=np.int64)
+            mat = np.stack([np.frombuffer(r[1], dtype="float32") for r in rows]) if rows else None
+            self._mats[key] = (ids, mat)
+        return self._mats[key]
+
+    def lookup(self, idx: str, config: str, version: str, q_vecs, threshold: float = DEFAULT_SIMILARITY) -> List[Optional[Dict]]:
+        """質問ごとに、類似度が threshold 以上で最も近い保存済みの回答（無ければ None）を返す。
+
+        版の違う古い回答はここで消える。
+        """
+        import numpy as np
+
+        q = normalize_rows(np.asarray(q_vecs, dtype="float32"))
+        out: List[Optional[Dict]] = [None] * len(q)
+        with self._lock:
+            self._expire(idx, version)
+            ids, mat = self._matrix((idx, config, version))
+            if mat is not None and mat.shape[1] == q.shape[1]:
+                sims = q @ mat.T
+                best = sims.argmax(axis=1)
+                now = time.time()
+                for n, j in enumerate(best.tolist()):
+                    if sims[n, j] < threshold:
+                        continue
+                    row = self._db.execute("SELECT question, answer, contexts FROM answers WHERE id=?", (int(ids[j]),)).fetchone()
+                    if row is None:
+                        continue
+                    self._db.execute("UPDATE answers SET last_used=?, hits=hits+1 WHERE id=?", (now, int(ids[j])))
+                    out[n] = {"question": row[0], "answer": row[1], "contexts": json.loads(row[2]), "similarity": float(sims[n, j])}
+            found = sum(o is not None for o in out)
+            self.hits += found
+            self.misses += len(out) - found
+            self._count(idx, hits=found, misses=len(out) - found)
+            self._db.commit()
+        return out
+
+    def put(self, idx: str, config: str, version: str, items: List[Tuple[str, Any, str, List[Dict]]]) -> None:
+        """(質問, 質問ベクトル, 回答, 根拠チャンク) を保存する"""
+        import numpy as np
+
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            vecs = normalize_rows(np.asarray([v for _, v, _, _ in items], dtype="float32").reshape(len(items), -1))
+            new_ids = []
+            for (question, _, answer, contexts), v in zip(items, vecs):
+                cur = self._db.execute(
+                    "INSERT INTO answers (idx, config, version, question, qvec, answer, contexts, created, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (idx, config, version, question, v.tobytes(), answer, json.dumps(contexts, ensure_ascii=False), now, now),
+                )
+                new_ids.append(cur.lastrowid)
+            key = (idx, config, version)
+            if key in self._mats:
+                ids, mat = self._mats[key]
+                mat = vecs if mat is None else np.concatenate([mat, vecs])
+                self._mats[key] = (np.concatenate([ids, np.asarray(new_ids, dtype=np.int64)]), mat)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        over = self._db.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+        if over > 0:
+            self._db.execute("DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)", (over,))
+            # 消した行を行列から外すのは手間なので、次に引くときに読み直す
+            self._mats.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            per = []
+            for idx, hits, misses, expired in self._db.execute("SELECT idx, hits, misses, expired FROM stats ORDER BY idx"):
+                entries = self._db.execute("SELECT COUNT(*) FROM answers WHERE idx=?", (idx,)).fetchone()[0]
+                total = hits + misses
+                per.append({"index": idx, "entries": entries, "hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else None, "expired": expired})
+        return {"path": str(self.path), "indexes": per}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM answers")
+            self._db.execute("DELETE FROM stats")
+            self._db.commit()
+            self._mats.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def default_answer_cache() -> Optional[AnswerCache]:
+    """環境変数に従った回答キャッシュ。無効化されていれば None"""
+    path = os.getenv("RAG_ANSWER_CACHE", DEFAULT_PATH)
+    if path.strip().lower() in ("", "0", "off", "none", "false"):
+        return None
+    return AnswerCache(Path(path), max_entries=int(os.getenv("RAG_ANSWER_CACHE_MAX", DEFAULT_MAX_ENTRIES)))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: show or clear the semantic answer cache")
+    p.add_argument("--clear", action="store_true", help="保存済みの回答と統計をすべて消す")
+    args = p.parse_args(argv)
+
+    cache = default_answer_cache()
+    if cache is None:
+        print("回答キャッシュは無効です（RAG_ANSWER_CACHE=off）")
+        return 0
+    if args.clear:
+        cache.clear()
+    print(pretty(cache.stats()))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
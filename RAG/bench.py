@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""検索バックエンドのベンチマーク（合成コーパス。API を呼ばない）。
+
+- コーパス: 単位球上に clusters 個の中心を置き、各行 = 中心 + ノイズ（--spread）を正規化した、塊のある分布。
+  ブロックごとに .vec へ書くので 10M 行でも全体をメモリに載せない。同じ設定のコーパスは --workdir に残して再利用する。
+- 質問: 中心の近くから別の乱数で作る（コーパスの行そのものは使わない）。正解は全件走査（common.search_batch）の上位 k。
+- バックエンドごとに、構築時間・付随ファイルのサイズ・recall@k・1件ずつの検索レイテンシの p50/p95/p99・一括検索のスループットを測る。
+- 結果は JSON（--out）。コミット・環境・設定を含むので、--compare で前回の結果と並べて比べられる。
+
+使い方:
+  python RAG/bench.py --sizes 10k,100k
+  python RAG/bench.py --sizes 1m --backends exact,ivf,pq,binary --dims 256 --dtype float16 --out RAG/bench/after.json --compare RAG/bench/before.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import SEARCH_BACKENDS, VectorWriter, batch_search, load_vectors, normalize_rows, open_searcher, pretty, search_batch
+
+BENCH_VERSION = 1
+BLOCK_ROWS = 65536
+
+
+def parse_size(text: str) -> int:
+    """"10k" / "1m" / "2500" -> 行数"""
+    text = text.strip().lower()
+    mult = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if mult > 1 else text) * mult)
+
+
+def auto_clusters(rows: int) -> int:
+    return min(4096, max(16, int(rows**0.5)))
+
+
+def _centers(dims: int, clusters: int, seed: int):
+    import numpy as np
+
+    return normalize_rows(np.random.default_rng(seed).standard_normal((clusters, dims)).astype("float32"))
+
+
+def _around(centers, n: int, spread: float, rng):
+    import numpy as np
+
+    dims = centers.shape[1]
+    which = rng.integers(0, len(centers), size=n)
+    noise = rng.standard_normal((n, dims)).astype("float32") * (spread / dims**0.5)
+    return normalize_rows(centers[which] + noise)
+
+
+def make_corpus(path: Path, rows: int, dims: int, clusters: int, spread: float, seed: int = 0, dtype: str = "float32") -> Path:
+    """合成コーパスを path（.vec）に書く。既にあれば作らない"""
+    import numpy as np
+
+    path = Path(path)
+    if path.exists():
+        return path
+    centers = _centers(dims, clusters, seed)
+    rng = np.random.default_rng(seed + 1)
+    tmp = path.with_name(path.name + ".tmp")
+    with VectorWriter(tmp, dims=dims, dtype=dtype, model="synthetic") as w:
+        for s in range(0, rows, BLOCK_ROWS):
+            w.append(_around(centers, min(BLOCK_ROWS, rows - s), spread, rng))
+    os.replace(tmp, path)
+    return path
+
+
+def make_queries(n: int, dims: int, clusters: int, spread: float, seed: int = 0):
+    import numpy as np
+
+    return _around(_centers(dims, clusters, seed), n, spread, np.random.default_rng(seed + 2))
+
+
+def _build(backend: str, index_path: Path, args) -> None:
+    if backend == "ivf":
+        from ivf_index import build_ivf
+
+        build_ivf(index_path, n_lists=args.lists)
+    elif backend == "hnsw":
+        from hnsw_index import update_hnsw
+
+        update_hnsw(index_path, rebuild=True, progress=False)
+    elif backend == "pq":
+        from pq_index import build_pq
+
+        build_pq(index_path)
+    elif backend == "binary":
+        from binary_index import build_binary
+
+        build_binary(index_path)
+
+
+def _sidecars(index_path: Path) -> Dict[str, int]:
+    return {p.name: p.stat().st_size for p in index_path.parent.glob(index_path.stem + ".*") if p != index_path and p.is_file()}
+
+
+def _clear_sidecars(index_path: Path) -> None:
+    for name in _sidecars(index_path):
+        (index_path.parent / name).unlink()
+
+
+def _percentiles(ms: List[float]) -> Dict[str, float]:
+    import numpy as np
+
+    a = np.asarray(ms)
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3), "mean": round(float(a.mean()), 3)}
+
+
+def bench_backend(backend: str, index_path: Path, queries, truth, args) -> Dict[str, Any]:
+    """1つのバックエンドを構築・計測する"""
+    _clear_sidecars(index_path)
+    t0 = time.perf_counter()
+    _build(backend, index_path, args)
+    build_s = time.perf_counter() - t0
+    sizes = _sidecars(index_path)
+    vectors = load_vectors(index_path)
+    opts = {"nprobe": args.nprobe, "ef": args.ef, "rescore": args.rescore}
+    searcher = open_searcher(index_path, vectors, backend, **opts)
+
+    k = args.k
+    for q in queries[: min(10, len(queries))]:
+        searcher.search(q, k)  # 読み込み・キャッシュを温める
+    lat: List[float] = []
+    found: List[List[int]] = []
+    for q in queries:
+        t = time.perf_counter()
+        res = searcher.search(q, k)
+        lat.append((time.perf_counter() - t) * 1000)
+        found.append([i for i, _ in res])
+    t = time.perf_counter()
+    batch_search(searcher, queries, k)
+    batch_s = time.perf_counter() - t
+    hit = sum(len(set(f) & set(tr.tolist())) for f, tr in zip(found, truth))
+    return {
+        "backend": backend,
+        "params": {key: opts[key] for key in {"ivf": ("nprobe",), "hnsw": ("ef",), "pq": ("rescore",), "binary": ("rescore",)}.get(backend, ())},
+        "build_s": round(build_s, 3),
+        "index_bytes": sum(sizes.values()),
+        "files": sizes,
+        "recall_at_k": round(hit / max(1, truth.size), 4),
+        "latency_ms": _percentiles(lat),
+        "batch_qps": round(len(queries) / batch_s, 1) if batch_s > 0 else None,
+    }
+
+
+def _git_commit() -> Tuple[Optional[str], Optional[bool]]:
+    here = Path(__file__).resolve().parent
+    try:
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no", "--", "."], cwd=here, capture_output=True, text=True, check=True).stdout.strip())
+        return head, dirty
+    except Exception:
+        return None, None
+
+
+def _environment() -> Dict[str, Any]:
+    import numpy as np
+
+    commit, dirty = _git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _ratio(a, b) -> Optional[float]:
+    return round(a / b, 3) if a is not None and b else None
+
+
+def compare(old: Dict, new: Dict) -> List[Dict[str, Any]]:
+    """同じ (行数, バックエンド) の結果どうしの差（recall は差分、時間・サイズは比）"""
+    before = {(r["rows"], r["backend"]): r for r in old.get("results", [])}
+    out = []
+    for r in new.get("results", []):
+        o = before.get((r["rows"], r["backend"]))
+        if o is None or "skipped" in r or "skipped" in o:
+            continue
+        out.append({
+            "rows": r["rows"],
+            "backend": r["backend"],
+            "params": r["params"] if r["params"] == o["params"] else {"before": o["params"], "after": r["params"]},
+            "recall_delta": round(r["recall_at_k"] - o["recall_at_k"], 4),
+            "p50_ratio": _ratio(r["latency_ms"]["p50"], o["latency_ms"]["p50"]),
+            "p95_ratio": _ratio(r["latency_ms"]["p95"], o["latency_ms"]["p95"]),
+            "p99_ratio": _ratio(r["latency_ms"]["p99"], o["latency_ms"]["p99"]),
+            "build_ratio": _ratio(r["build_s"], o["build_s"]),
+            "size_ratio": _ratio(r["index_bytes"], o["index_bytes"]),
+        })
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: benchmark search backends on synthetic clustered corpora")
+    p.add_argument("--sizes", default="10k,100k", help="コーパスの行数（カンマ区切り。10k / 1m などの表記可）")
+    p.add_argument("--dims", type=int, default=256)
+    p.add_argument("--dtype", choices=("float32", "float16"), default="float32")
+    p.add_argument("--clusters", type=int, default=0, help="塊の数（0 で sqrt(行数)。16..4096）")
+    p.add_argument("--spread", type=float, default=1.0, help="塊の広がり（中心からのノイズの大きさ。中心は長さ 1）")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--backends", default=",".join(SEARCH_BACKENDS), help=f"計測するバックエンド（{', '.join(SEARCH_BACKENDS)}）")
+    p.add_argument("--hnsw-max-rows", type=int, default=100_000, help="これより大きいコーパスでは hnsw を飛ばす（Python 実装の構築が遅いため。0 で制限なし）")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--lists", type=int, default=0, help="ivf: リスト数（0 で 4*sqrt(行数)）")
+    p.add_argument("--nprobe", type=int, default=8)
+    p.add_argument("--ef", type=int, default=64)
+    p.add_argument("--rescore", type=int, default=100)
+    p.add_argument("--workdir", default="./RAG/bench", help="合成コーパスと付随ファイルの置き場所")
+    p.add_argument("--out", help="結果 JSON の出力先（既定: <workdir>/bench-<commit>.json）")
+    p.add_argument("--compare", help="前回の結果 JSON。同じ行数・バックエンドどうしの差を表示する")
+    p.add_argument("--dry-run", action="store_true")
+    args = p.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    unknown = [b for b in backends if b not in SEARCH_BACKENDS]
+    if unknown:
+        p.error(f"未知のバックエンドです: {', '.join(unknown)}")
+    workdir = Path(args.workdir).resolve()
+    config = {key: getattr(args, key) for key in ("dims", "dtype", "clusters", "spread", "seed", "queries", "k", "lists", "nprobe", "ef", "rescore", "hnsw_max_rows")}
+    config.update(sizes=sizes, backends=backends)
+
+    if args.dry_run:
+        import numpy as np
+
+        bytes_per = args.dims * np.dtype(args.dtype).itemsize
+        print("[DRY-RUN] benchmark plan:")
+        print(pretty(dict(config, workdir=str(workdir), corpus_bytes={n: n * bytes_per for n in sizes})))
+        return 0
+
+    report: Dict[str, Any] = {"format": "ragbench", "version": BENCH_VERSION, "created": time.time(), "environment": _environment(), "config": config, "results": []}
+    for rows in sizes:
+        clusters = args.clusters or auto_clusters(rows)
+        path = workdir / f"corpus-{rows}-{args.dims}-{args.dtype}-c{clusters}-s{args.spread}-seed{args.seed}" / "index.vec"
+        t0 = time.perf_counter()
+        existed = path.exists()
+        make_corpus(path, rows, args.dims, clusters, args.spread, args.seed, args.dtype)
+        print(f"== {rows} rows x {args.dims} dims ({clusters} clusters): {path} ({'reused' if existed else f'generated in {time.perf_counter() - t0:.1f}s'})", flush=True)
+
+        queries = make_queries(args.queries, args.dims, clusters, args.spread, args.seed)
+        t0 = time.perf_counter()
+        truth, _ = search_batch(queries, load_vectors(path), args.k)
+        print(f"  ground truth: {time.perf_counter() - t0:.1f}s", flush=True)
+        for backend in backends:
+            base = {"rows": rows, "dims": args.dims, "dtype": args.dtype, "clusters": clusters, "vectors_bytes": path.stat().st_size}
+            if backend == "hnsw" and args.hnsw_max_rows and rows > args.hnsw_max_rows:
+                report["results"].append(dict(base, backend=backend, skipped=f"rows > --hnsw-max-rows ({args.hnsw_max_rows})"))
+                print(f"  {backend:7s} skipped", flush=True)
+                continue
+            res = dict(base, **bench_backend(backend, path, queries, truth, args))
+            report["results"].append(res)
+            lat = res["latency_ms"]
+            print(
+                f"  {backend:7s} build {res['build_s']:8.2f}s  size {res['index_bytes'] / 1e6:9.1f} MB  recall@{args.k} {res['recall_at_k']:.3f}"
+                f"  p50 {lat['p50']:8.3f}  p95 {lat['p95']:8.3f}  p99 {lat['p99']:8.3f} ms  batch {res['batch_qps']} q/s",
+                flush=True,
+            )
+        _clear_sidecars(path)
+
+    if args.compare:
+        report["compare"] = {"baseline": str(Path(args.compare).resolve()), "results": compare(json.loads(Path(args.compare).read_text(encoding="utf-8")), report)}
+        print(pretty(report["compare"]))
+    commit = report["environment"]["commit"]
+    out = Path(args.out) if args.out else workdir / f"bench-{(commit or 'nogit')[:12]}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"saved report: {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
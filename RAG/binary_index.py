@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""1ビット（符号ビット）量子化による前段フィルタ + 元ベクトルでの再採点。
+
+- 構築: 各次元の符号（>0 なら 1）を np.packbits で詰め、1行 D/8 バイトにする（1536 次元で 192B、32分の1）。
+- 検索: 質問も同様に符号化し、XOR + popcount（ハミング距離）で全行をふるいにかけ、
+  距離の小さい上位 rescore 件だけを index.vec（memmap）の元ベクトルで内積採点する。
+
+保存: index.bin1.npy（(rows, D/8) uint8。memmap で開く）+ index.bin1.npz（行数など）
+
+使い方:
+  python RAG/binary_index.py --index RAG/index/index.vec --eval 200 --rescore 200
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from common import eval_recall, load_live_mask, load_vectors, normalize_rows, pretty, read_vec_header, sidecar_path
+
+BIN_VERSION = 1
+
+
+def pack_signs(vectors, block_rows: int = 65536):
+    import numpy as np
+
+    out = np.empty((len(vectors), (vectors.shape[1] + 7) // 8), dtype=np.uint8)
+    for s in range(0, len(vectors), block_rows):
+        out[s : s + block_rows] = np.packbits(np.asarray(vectors[s : s + block_rows]) > 0, axis=1)
+    return out
+
+
+def _popcount_table():
+    import numpy as np
+
+    return np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def hamming(codes, qbits, block_rows: int = 262144):
+    """各行と質問のハミング距離（異なるビット数）を返す"""
+    import numpy as np
+
+    out = np.empty(len(codes), dtype=np.uint16)
+    count = getattr(np, "bitwise_count", None)  # NumPy 2.0+ はハードウェア popcount
+    table = None if count else _popcount_table()
+    for s in range(0, len(codes), block_rows):
+        x = np.bitwise_xor(codes[s : s + block_rows], qbits)
+        bits = count(x) if count else table[x]
+        out[s : s + block_rows] = bits.sum(axis=1, dtype=np.uint16)
+    return out
+
+
+def build_binary(index_path: Path) -> Path:
+    import numpy as np
+
+    index_path = Path(index_path)
+    vectors = load_vectors(index_path)
+    if len(vectors) == 0:
+        raise RuntimeError(f"ベクトルが空です: {index_path}")
+    np.save(sidecar_path(index_path, ".bin1.npy"), pack_signs(vectors))
+    uid = read_vec_header(index_path).get("uid") if index_path.suffix == ".vec" else None
+    out = sidecar_path(index_path, ".bin1.npz")
+    np.savez(out, version=BIN_VERSION, rows=len(vectors), dims=vectors.shape[1], source_uid=np.array(uid or ""))
+    return out
+
+
+class BinarySearcher:
+    """top_k_similar と同じ (行番号, スコア) のリストを返す、ハミング前段フィルタ付き検索器"""
+
+    def __init__(self, index_path: Path, vectors, mask=None, rescore: int = 200) -> None:
+        import numpy as np
+
+        index_path = Path(index_path)
+        path = sidecar_path(index_path, ".bin1.npz")
+        if not path.exists():
+            raise FileNotFoundError(f"バイナリインデックスが見つかりません: {path}（binary_index.py か ingest.py --build-binary で作成）")
+        data = np.load(path)
+        if int(data["version"]) > BIN_VERSION:
+            raise ValueError(f"未対応のバイナリインデックス版です: {int(data['version'])}")
+        uid = str(data["source_uid"])
+        if uid and index_path.suffix == ".vec" and uid != read_vec_header(index_path).get("uid"):
+            raise RuntimeError("バイナリインデックスが現在の index.vec と一致しません。binary_index.py で作り直してください。")
+        self.bin_rows = int(data["rows"])
+        self.codes = np.load(sidecar_path(index_path, ".bin1.npy"), mmap_mode="r")
+        self.vectors = vectors
+        self.mask = mask
+        self.rescore = max(1, int(rescore))
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        q = normalize_rows(np.asarray(query_vec).reshape(-1))
+        dist = hamming(self.codes, np.packbits(q > 0)).astype(np.int32)
+        if self.mask is not None:
+            dist[~self.mask[: self.bin_rows]] = np.iinfo(np.int32).max
+        n_short = min(len(dist), max(k, self.rescore))
+        short = np.argpartition(dist, n_short - 1)[:n_short] if n_short else np.zeros(0, dtype=np.int64)
+        short = short[dist[short] != np.iinfo(np.int32).max]
+        # 構築後に追記された行は前段フィルタを通さず、そのまま再採点対象に含める
+        if len(self.vectors) > self.bin_rows:
+            tail = np.arange(self.bin_rows, len(self.vectors))
+            if self.mask is not None:
+                tail = tail[self.mask[tail]]
+            short = np.concatenate([short, tail])
+        if len(short) == 0:
+            return []
+        short = np.sort(short)
+        sims = np.asarray(self.vectors[short], dtype="float32") @ q
+        order = np.argsort(-sims)[:k]
+        return [(int(short[i]), float(sims[i])) for i in order]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: build 1-bit sign codes for Hamming prefilter search")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--eval", type=int, default=0, help="構築後に N 件の質問で recall@k を測る")
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--rescore", type=int, default=200, help="元ベクトルで再採点する候補数")
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    t0 = time.perf_counter()
+    out = build_binary(index_path)
+    codes = sidecar_path(index_path, ".bin1.npy")
+    print(f"saved binary: {out} ({codes.stat().st_size / 1e6:.1f} MB codes, {time.perf_counter() - t0:.1f}s)")
+    if args.eval:
+        vectors = load_vectors(index_path)
+        mask = load_live_mask(index_path, len(vectors))
+        searcher = BinarySearcher(index_path, vectors, mask=mask, rescore=args.rescore)
+        print(pretty(dict(eval_recall(searcher, vectors, mask, n_queries=args.eval, k=args.k), rescore=args.rescore)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
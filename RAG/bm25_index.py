@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""BM25 による語彙（キーワード）検索の転置インデックス。
+
+- 分かち書き: NFKC 正規化 + 小文字化のうえ、英数字は語単位（型番・エラー番号を1語として扱う）、
+  それ以外（日本語など）は文字 2-gram と 3-gram。形態素解析器は不要。
+- 語は 64bit ハッシュで持ち、語ごとのポスティング（行番号の差分と出現回数）を可変長整数（varint）で詰めて保存する。
+- 検索: 質問の語のポスティングだけを復号して BM25 で採点する。埋め込み API を呼ばないので速い。
+
+保存: index.bm25.npz（語ハッシュ・df・オフセット・圧縮ポスティング・文書長）
+インデックス構築後に ingest で追記された行は、メタデータのテキストから読み込み時にメモリ上で補う。
+
+使い方:
+  python RAG/bm25_index.py --index RAG/index/index.vec --meta RAG/index/meta.idx --query "E-1234"
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from common import load_live_mask, load_vectors, open_meta, pretty, read_vec_header, sidecar_path
+
+BM25_VERSION = 1
+_TOKEN_RE = re.compile(r"[0-9a-z]+(?:[-_.:/][0-9a-z]+)*|[^\W0-9a-z_]+")
+_SEP_RE = re.compile(r"[-_.:/]")
+
+
+def tokenize(text: str) -> List[str]:
+    """英数字は語単位（区切り記号を含む語は部分語も）、それ以外は文字 2-gram/3-gram に分ける"""
+    out: List[str] = []
+    for m in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        w = m.group(0)
+        if w[0].isascii():
+            out.append(w)
+            parts = _SEP_RE.split(w)
+            if len(parts) > 1:
+                out.extend(p for p in parts if p)
+        elif len(w) == 1:
+            out.append(w)
+        else:
+            out.extend(w[i : i + 2] for i in range(len(w) - 1))
+            out.extend(w[i : i + 3] for i in range(len(w) - 2))
+    return out
+
+
+def token_coverage(query: str, text: str) -> float:
+    """質問の異なり語のうち text に現れる割合（0..1）"""
+    q = set(tokenize(query))
+    if not q:
+        return 0.0
+    return len(q & set(tokenize(text))) / len(q)
+
+
+_hash_cache: Dict[str, int] = {}
+
+
+def term_hash(term: str) -> int:
+    h = _hash_cache.get(term)
+    if h is None:
+        h = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+        if len(_hash_cache) < 1_000_000:
+            _hash_cache[term] = h
+    return h
+
+
+def _postings(texts: Iterable[str], start_row: int = 0):
+    """(語ハッシュ, 行番号) 順に並べた (hashes, docs, tfs) と各行の語数を返す"""
+    import numpy as np
+
+    hs, ds, ts, lens = [], [], [], []
+    for row, text in enumerate(texts, start=start_row):
+        c = Counter(tokenize(text))
+        lens.append(sum(c.values()))
+        hs.append(np.fromiter((term_hash(t) for t in c), dtype=np.uint64, count=len(c)))
+        ts.append(np.fromiter(c.values(), dtype=np.uint32, count=len(c)))
+        ds.append(np.full(len(c), row, dtype=np.int64))
+    if not hs:
+        z = np.zeros(0, dtype=np.uint64)
+        return z, z.astype(np.int64), z.astype(np.uint32), np.zeros(0, dtype=np.uint32)
+    hashes, docs, tfs = np.concatenate(hs), np.concatenate(ds), np.concatenate(ts)
+    order = np.lexsort((docs, hashes))
+    return hashes[order], docs[order], tfs[order], np.asarray(lens, dtype=np.uint32)
+
+
+def varint_encode(vals):
+    """非負整数列を LEB128（7bit ずつ、最上位ビットが継続フラグ）で詰め、(バイト列, 各値の開始位置) を返す"""
+    import numpy as np
+
+    v = np.asarray(vals, dtype=np.uint64)
+    nb = np.ones(len(v), dtype=np.int64)
+    t = v >> np.uint64(7)
+    while t.any():
+        nb += t > 0
+        t >>= np.uint64(7)
+    pos = np.zeros(len(v) + 1, dtype=np.int64)
+    np.cumsum(nb, out=pos[1:])
+    out = np.empty(int(pos[-1]), dtype=np.uint8)
+    cur = v.copy()
+    for j in range(int(nb.max()) if len(nb) else 0):
+        m = nb > j
+        byte = (cur[m] & np.uint64(127)) | np.where(nb[m] > j + 1, np.uint64(128), np.uint64(0))
+        out[pos[:-1][m] + j] = byte.astype(np.uint8)
+        cur >>= np.uint64(7)
+    return out, pos
+
+
+def varint_decode(buf):
+    import numpy as np
+
+    buf = np.asarray(buf, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 128)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = (np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)).astype(np.uint64) * np.uint64(7)
+    return np.add.reduceat((buf.astype(np.uint64) & np.uint64(127)) << shift, starts)
+
+
+def build_bm25(index_path: Path, meta_path: Path) -> Path:
+    """メタデータのテキストから index.bm25.npz を作る"""
+    import numpy as np
+
+    index_path = Path(index_path)
+    meta = open_meta(meta_path)
+    if not len(meta):
+        raise RuntimeError(f"メタデータが空です: {meta_path}")
+    hashes, docs, tfs, doc_len = _postings(it.get("text", "") for it in meta)
+    terms, starts, df = np.unique(hashes, return_index=True, return_counts=True)
+    # 語ごとに行番号を差分にし、(差分, 出現回数) を交互に並べて varint で詰める
+    deltas = docs.copy()
+    deltas[1:] -= docs[:-1]
+    deltas[starts] = docs[starts]
+    vals = np.empty(2 * len(docs), dtype=np.uint64)
+    vals[0::2] = deltas
+    vals[1::2] = tfs
+    blob, pos = varint_encode(vals)
+    offsets = np.append(pos[2 * starts], pos[-1]).astype(np.int64)
+    uid = read_vec_header(index_path).get("uid") if index_path.suffix == ".vec" else None
+    out = sidecar_path(index_path, ".bm25.npz")
+    np.savez(
+        out,
+        version=BM25_VERSION,
+        rows=len(meta),
+        terms=terms,
+        df=df.astype(np.uint32),
+        offsets=offsets,
+        postings=blob,
+        doc_len=doc_len,
+        source_uid=np.array(uid or ""),
+    )
+    return out
+
+
+class BM25Searcher:
+    """質問文を受け取り (行番号, BM25 スコア) のリストを返す語彙検索器"""
+
+    def __init__(self, index_path: Path, meta_items, mask=None, k1: float = 1.2, b: float = 0.75) -> None:
+        import numpy as np
+
+        index_path = Path(index_path)
+        path = sidecar_path(index_path, ".bm25.npz")
+        if not path.exists():
+            raise FileNotFoundError(f"BM25 インデックスが見つかりません: {path}（bm25_index.py か ingest.py --build-bm25 で作成）")
+        data = np.load(path)
+        if int(data["version"]) > BM25_VERSION:
+            raise ValueError(f"未対応の BM25 版です: {int(data['version'])}")
+        uid = str(data["source_uid"])
+        if uid and index_path.suffix == ".vec" and uid != read_vec_header(index_path).get("uid"):
+            raise RuntimeError("BM25 インデックスが現在の index.vec と一致しません。bm25_index.py で作り直してください。")
+        self.bm25_rows = int(data["rows"])
+        self.terms = data["terms"]
+        self.df = data["df"]
+        self.offsets = data["offsets"]
+        self.postings = data["postings"]
+        # 構築後に追記された行はメモリ上の非圧縮ポスティングで補う
+        tail = [it.get("text", "") for it in meta_items[self.bm25_rows :]]
+        self.tail_hashes, self.tail_docs, self.tail_tfs, tail_len = _postings(tail, start_row=self.bm25_rows)
+        self.doc_len = np.concatenate([data["doc_len"], tail_len]).astype("float32")
+        self.avgdl = float(self.doc_len.mean()) if len(self.doc_len) else 1.0
+        self.mask = mask
+        self.k1 = k1
+        self.b = b
+
+    def _lookup(self, h: int):
+        """1語分の (行番号, 出現回数) を返す"""
+        import numpy as np
+
+        docs, tfs = [], []
+        i = int(np.searchsorted(self.terms, np.uint64(h)))
+        if i < len(self.terms) and int(self.terms[i]) == h:
+            vals = varint_decode(self.postings[self.offsets[i] : self.offsets[i + 1]])
+            docs.append(np.cumsum(vals[0::2]).astype(np.int64))
+            tfs.append(vals[1::2])
+        s, e = np.searchsorted(self.tail_hashes, np.uint64(h), side="left"), np.searchsorted(self.tail_hashes, np.uint64(h), side="right")
+        if e > s:
+            docs.append(self.tail_docs[s:e])
+            tfs.append(self.tail_tfs[s:e])
+        if not docs:
+            return None
+        return np.concatenate(docs), np.concatenate(tfs).astype("float32")
+
+    def search(self, question: str, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        n = len(self.doc_len)
+        doc_parts, score_parts = [], []
+        for h in {term_hash(t) for t in tokenize(question)}:
+            hit = self._lookup(h)
+            if hit is None:
+                continue
+            docs, tf = hit
+            idf = math.log(1.0 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+            doc_parts.append(docs)
+            score_parts.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+        if not doc_parts:
+            return []
+        rows, inv = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(score_parts))
+        if self.mask is not None:
+            live = self.mask[rows]
+            rows, scores = rows[live], scores[live]
+        k = min(k, len(rows))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: build BM25 inverted index (char n-gram) for lexical search")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    p.add_argument("--query", help="構築後にこの文字列で検索して上位を表示する")
+    p.add_argument("--k", type=int, default=5)
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    meta_path = Path(args.meta).resolve()
+    t0 = time.perf_counter()
+    out = build_bm25(index_path, meta_path)
+    print(f"saved bm25: {out} ({out.stat().st_size / 1e6:.1f} MB, {time.perf_counter() - t0:.1f}s)")
+    if args.query:
+        meta_items = open_meta(meta_path)
+        mask = load_live_mask(index_path, len(load_vectors(index_path)))
+        t0 = time.perf_counter()
+        top = BM25Searcher(index_path, meta_items, mask=mask).search(args.query, args.k)
+        ms = (time.perf_counter() - t0) * 1000
+        print(pretty([{"row": i, "score": round(s, 4), "file": meta_items[i].get("file"), "text": meta_items[i].get("text", "")[:80]} for i, s in top]))
+        print(f"search: {ms:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,9 +2,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import base64
+import hashlib
 import json
 import os
-from typing import Any, Iterable, List, Tuple
+import random
+import struct
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 def need_key() -> None:
@@ -22,6 +30,19 @@ def client() -> Any:
     return OpenAI()
 
 
+_shared_client: Any = None
+_shared_lock = threading.Lock()
+
+
+def shared_client() -> Any:
+    """プロセス内で1つの OpenAI クライアント（HTTP 接続プールを使い回す。スレッドから共有可）"""
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = client()
+        return _shared_client
+
+
 def pretty(obj: Any) -> str:
     try:
         return json.dumps(obj, ensure_ascii=False, indent=2)
@@ -53,25 +74,995 @@ def cosine_sim_matrix(a, b):
     return a_norm @ b_norm.T
 
 
-def top_k_similar(query_vec, vectors, k: int) -> List[Tuple[int, float]]:
+def normalize_rows(a):
+    """行ごとに L2 正規化した float32 配列を返す"""
+    import numpy as np
+
+    a = np.asarray(a, dtype="float32")
+    if a.ndim == 1:
+        return a / (np.linalg.norm(a) + 1e-8)
+    return a / (np.linalg.norm(a, axis=1, keepdims=True) + 1e-8)
+
+
+def dot_rows(vectors, q, block_rows: int = 65536):
+    """vectors @ q を計算する。float32 以外（float16 など）はブロック単位で float32 化して全体コピーを避ける"""
+    import numpy as np
+
+    q = np.asarray(q, dtype="float32")
+    if vectors.dtype == np.float32:
+        return vectors @ q
+    out_shape = (vectors.shape[0],) + q.shape[1:]
+    out = np.empty(out_shape, dtype="float32")
+    for s in range(0, vectors.shape[0], block_rows):
+        out[s : s + block_rows] = vectors[s : s + block_rows].astype("float32") @ q
+    return out
+
+
+def top_k_similar(query_vec, vectors, k: int, normalized: bool = False, mask=None) -> List[Tuple[int, float]]:
+    """コサイン類似の上位K件を (行番号, スコア) で返す。
+
+    normalized=True の場合は vectors が正規化済み（load_vectors の戻り値）とみなし、
+    質問ベクトルだけを正規化して内積1回で済ませる。
+    mask（bool配列）を渡すと False の行は候補から除外する（削除済み行など）。
+    """
+    import numpy as np
+
+    if normalized:
+        sims = dot_rows(vectors, normalize_rows(query_vec.reshape(-1)))
+    else:
+        q = query_vec.reshape(1, -1)
+        sims = cosine_sim_matrix(q, vectors)[0]
+    if mask is not None:
+        sims = np.where(mask, sims, -np.inf)
+    idx, vals = top_k_rows(sims.reshape(1, -1), k)
+    return [(int(i), float(v)) for i, v in zip(idx[0], vals[0]) if np.isfinite(v)]
+
+
+def top_k_rows(sims, k: int):
+    """(Q, N) の類似度から各行の上位K件を (行番号 (Q,k), スコア (Q,k)) で返す。
+
+    全体をソートせず argpartition で上位K件だけ選び、その K 件だけを並べる。
+    """
+    import numpy as np
+
+    k = min(k, sims.shape[1])
+    if k <= 0:
+        return np.zeros((sims.shape[0], 0), dtype=np.int64), np.zeros((sims.shape[0], 0), dtype="float32")
+    part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-vals, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+def search_batch(queries, vectors, k: int, mask=None, max_cells: int = 64 * 1024 * 1024):
+    """複数の質問 (Q, D) を正規化済み vectors に対してまとめて検索する。
+
+    戻り値: (行番号 (Q,k), スコア (Q,k))。mask で除外され K 件に満たない分はスコア -inf。
+    N×Q の類似度行列が max_cells 要素を超えないよう、質問をブロックに分けて行列積を回す。
+    """
+    import numpy as np
+
+    qn = normalize_rows(np.atleast_2d(queries))
+    n = len(vectors)
+    kk = min(k, n)
+    ids = np.zeros((len(qn), kk), dtype=np.int64)
+    scores = np.zeros((len(qn), kk), dtype="float32")
+    step = max(1, max_cells // max(1, n))
+    for s in range(0, len(qn), step):
+        sims = dot_rows(vectors, qn[s : s + step].T).T  # (q, N)
+        if mask is not None:
+            sims[:, ~mask] = -np.inf
+        ids[s : s + step], scores[s : s + step] = top_k_rows(sims, kk)
+    return ids, scores
+
+
+# ---------------------------------------------------------------------------
+# ベクトルストア（.vec）
+#   先頭 VEC_HEADER_SIZE バイト: マジック + JSON ヘッダ長 + JSON ヘッダ（ゼロ埋め）
+#   以降: L2 正規化済みベクトルを行優先（row-major）で連続格納
+# np.memmap で開くため、読み込み・正規化のコストは質問ごとには発生しない。
+# ---------------------------------------------------------------------------
+
+VEC_MAGIC = b"RAGVEC\x00\x00"
+VEC_VERSION = 1
+VEC_HEADER_SIZE = 4096
+VEC_DTYPES = ("float32", "float16")
+
+
+def _pack_vec_header(header: Dict) -> bytes:
+    body = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    raw = VEC_MAGIC + struct.pack("<I", len(body)) + body
+    if len(raw) > VEC_HEADER_SIZE:
+        raise ValueError(f"ベクトルヘッダが大きすぎます: {len(raw)} bytes")
+    return raw + b"\x00" * (VEC_HEADER_SIZE - len(raw))
+
+
+def read_vec_header(path: Path) -> Dict:
+    with Path(path).open("rb") as f:
+        raw = f.read(VEC_HEADER_SIZE)
+    if len(raw) < len(VEC_MAGIC) + 4 or raw[: len(VEC_MAGIC)] != VEC_MAGIC:
+        raise ValueError(f"ベクトルファイルの形式が不正です: {path}")
+    (n,) = struct.unpack("<I", raw[len(VEC_MAGIC) : len(VEC_MAGIC) + 4])
+    header = json.loads(raw[len(VEC_MAGIC) + 4 : len(VEC_MAGIC) + 4 + n].decode("utf-8"))
+    if int(header.get("version", 0)) > VEC_VERSION:
+        raise ValueError(f"未対応のベクトルファイル版です: version={header.get('version')}")
+    return header
+
+
+class VectorWriter:
+    """正規化済みベクトルを .vec へ追記していくライター。
+
+    append=True なら既存ファイルの末尾に追記する（次元・dtype は一致必須）。
+    close() でヘッダの行数を確定させるまで、読み手からは追記分は見えない。
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        dims: int,
+        dtype: str = "float32",
+        model: Optional[str] = None,
+        append: bool = False,
+        keep_rows: Optional[int] = None,
+        dimensions: Optional[int] = None,
+    ) -> None:
+        if dtype not in VEC_DTYPES:
+            raise ValueError(f"dtype は {VEC_DTYPES} のいずれか: {dtype}")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.header: Dict = {
+            "format": "ragvec",
+            "version": VEC_VERSION,
+            "dtype": dtype,
+            "rows": 0,
+            "dims": int(dims),
+            "normalized": True,
+            "model": model,
+            # 埋め込み API に指定した dimensions（None はモデルの既定次元）。質問も同じ次元で埋め込む
+            "dimensions": int(dimensions) if dimensions else None,
+            # ファイルを作り直すたびに変わる識別子（IVF/HNSW などの付随インデックスが古いか判定する）
+            "uid": uuid.uuid4().hex,
+        }
+        if append and self.path.exists():
+            old = read_vec_header(self.path)
+            if int(old["dims"]) != int(dims) or old["dtype"] != dtype:
+                raise ValueError(
+                    f"既存インデックスと次元/dtypeが一致しません: {old['dims']}/{old['dtype']} != {dims}/{dtype}"
+                )
+            if model and old.get("model") and old["model"] != model:
+                raise ValueError(f"既存インデックスと埋め込みモデルが一致しません: {old['model']} != {model}")
+            if (old.get("dimensions") or None) != self.header["dimensions"]:
+                raise ValueError(f"既存インデックスと埋め込みの dimensions が一致しません: {old.get('dimensions')} != {dimensions}")
+            self.header.update(old)
+            if keep_rows is not None and keep_rows < self.rows:
+                # 中断した投入の再開: マニフェストに記録された行数まで巻き戻す
+                self.header["rows"] = int(keep_rows)
+            self._f = self.path.open("r+b")
+            # ヘッダ確定前に書かれた半端な行は捨てる
+            self._f.truncate(VEC_HEADER_SIZE + self.rows * self.row_bytes)
+        else:
+            self._f = self.path.open("wb")
+            self._f.write(_pack_vec_header(self.header))
+        self._f.seek(0, os.SEEK_END)
+
+    @property
+    def rows(self) -> int:
+        return int(self.header["rows"])
+
+    @property
+    def row_bytes(self) -> int:
+        import numpy as np
+
+        return int(self.header["dims"]) * np.dtype(self.header["dtype"]).itemsize
+
+    def append(self, vectors) -> int:
+        """ベクトルを正規化して追記し、先頭行番号を返す"""
+        import numpy as np
+
+        v = normalize_rows(np.atleast_2d(vectors))
+        if v.shape[1] != int(self.header["dims"]):
+            raise ValueError(f"次元が一致しません: {v.shape[1]} != {self.header['dims']}")
+        start = self.rows
+        self._f.write(np.ascontiguousarray(v.astype(self.header["dtype"])).tobytes())
+        self.header["rows"] = start + v.shape[0]
+        return start
+
+    def commit(self) -> None:
+        """ここまでの追記をヘッダに反映する（以降に落ちても、ここまでの行は残る）"""
+        self._f.flush()
+        self._f.seek(0)
+        self._f.write(_pack_vec_header(self.header))
+        self._f.seek(0, os.SEEK_END)
+        self._f.flush()
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        self.commit()
+        self._f.close()
+
+    def __enter__(self) -> "VectorWriter":
+        return self
+
+    def abort(self) -> None:
+        """ヘッダを更新せずに閉じる（行数は開いた時点のまま。途中まで書いた行は次回の追記で捨てられる）"""
+        self._f.close()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def save_vectors(path: Path, vectors, dtype: str = "float32", model: Optional[str] = None, dimensions: Optional[int] = None) -> None:
+    with VectorWriter(path, dims=vectors.shape[1], dtype=dtype, model=model, dimensions=dimensions) as w:
+        if len(vectors):
+            w.append(vectors)
+
+
+def load_vectors(path: Path):
+    """正規化済みベクトルを返す。.vec は np.memmap（読み取り専用・ゼロコピー）で開く。
+
+    旧形式の .npz も読めるが、その場合は全体を読み込んで正規化する。
+    """
+    import numpy as np
+
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"ベクトルが見つかりません: {path}")
+    if path.suffix == ".npz":
+        return normalize_rows(np.load(path)["vectors"])
+    h = read_vec_header(path)
+    rows, dims = int(h["rows"]), int(h["dims"])
+    if rows == 0:
+        return np.zeros((0, dims), dtype=h["dtype"])
+    return np.memmap(path, dtype=h["dtype"], mode="r", offset=VEC_HEADER_SIZE, shape=(rows, dims), order="C")
+
+
+# ---------------------------------------------------------------------------
+# チャンクメタデータ（meta.idx + meta.heap + meta.files.json [+ meta.blocks]）
+#   meta.idx:        4096 バイトのヘッダ（JSON）+ 1行 24 バイトの固定長レコード
+#                    (heap 内の位置, 本文バイト数, 追加属性バイト数, ファイル番号, chunk_index)
+#   meta.heap:       本文（UTF-8）と追加属性（JSON）を連結したもの。圧縮時は zlib ブロックの連結
+#   meta.blocks:     圧縮時のみ。ブロックごとの (先頭行, heap 内の位置, 圧縮後サイズ, 展開後サイズ)
+#   meta.files.json: ファイルパスの辞書（レコードは番号だけを持つ）
+# どちらも memmap で開くので、上位 k 件の本文取得は k 回のランダム読みで済み、
+# 起動時のメモリ・読み込み時間はコーパスの大きさに依存しない。
+# ---------------------------------------------------------------------------
+
+META_MAGIC = b"RAGMETA\x00"
+META_VERSION = 1
+META_HEADER_SIZE = 4096
+META_BLOCK_BYTES = 64 * 1024
+_META_BASE_KEYS = ("file", "chunk_index", "text")
+
+
+def _meta_record_dtype():
+    import numpy as np
+
+    return np.dtype([("offset", "<u8"), ("text_len", "<u4"), ("extra_len", "<u4"), ("file_id", "<u4"), ("chunk_index", "<u4")])
+
+
+def _meta_block_dtype():
+    import numpy as np
+
+    return np.dtype([("first_row", "<u8"), ("offset", "<u8"), ("comp_len", "<u4"), ("raw_len", "<u4")])
+
+
+def _pack_meta_header(header: Dict) -> bytes:
+    body = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    raw = META_MAGIC + struct.pack("<I", len(body)) + body
+    return raw + b"\x00" * (META_HEADER_SIZE - len(raw))
+
+
+def is_meta_store(path: Path) -> bool:
+    try:
+        with Path(path).open("rb") as f:
+            return f.read(len(META_MAGIC)) == META_MAGIC
+    except OSError:
+        return False
+
+
+def read_meta_header(path: Path) -> Dict:
+    with Path(path).open("rb") as f:
+        raw = f.read(META_HEADER_SIZE)
+    if raw[: len(META_MAGIC)] != META_MAGIC:
+        raise ValueError(f"メタデータファイルの形式が不正です: {path}")
+    (n,) = struct.unpack("<I", raw[len(META_MAGIC) : len(META_MAGIC) + 4])
+    header = json.loads(raw[len(META_MAGIC) + 4 : len(META_MAGIC) + 4 + n].decode("utf-8"))
+    if int(header.get("version", 0)) > META_VERSION:
+        raise ValueError(f"未対応のメタデータ版です: version={header.get('version')}")
+    return header
+
+
+class MetaWriter:
+    """チャンクのメタデータ（file, chunk_index, text とその他の属性）を追記していくライター。
+
+    VectorWriter と同じく、close() でヘッダの行数を確定させるまで追記分は読み手から見えない。
+    compress=True なら本文を約 block_bytes ごとに zlib 圧縮する（ブロック単位で独立に展開できる）。
+    """
+
+    def __init__(self, path: Path, append: bool = False, compress: bool = False, block_bytes: int = META_BLOCK_BYTES, keep_rows: Optional[int] = None) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.heap_path = sidecar_path(self.path, ".heap")
+        self.blocks_path = sidecar_path(self.path, ".blocks")
+        self.files_path = sidecar_path(self.path, ".files.json")
+        self.header: Dict = {"format": "ragmeta", "version": META_VERSION, "rows": 0, "heap_bytes": 0, "blocks": 0, "compressed": bool(compress), "files": 0}
+        self.files: List[str] = []
+        append = append and self.path.exists()
+        if append:
+            # 圧縮の有無は既存ファイルの設定に従う
+            self.header.update(read_meta_header(self.path))
+            if self.header["files"]:
+                self.files = json.loads(self.files_path.read_text(encoding="utf-8"))[: self.header["files"]]
+            if keep_rows is not None and keep_rows < self.rows:
+                self._rollback(int(keep_rows))
+
+        def _open(p: Path):
+            return p.open("r+b" if append and p.exists() else "w+b")
+
+        self.block_bytes = int(block_bytes)
+        self._idx = _open(self.path)
+        self._heap = _open(self.heap_path)
+        self._blocks = _open(self.blocks_path) if self.compressed else None
+        # ヘッダ確定前に書かれた半端なレコード・本文は捨てる
+        self._idx.truncate(META_HEADER_SIZE + self.rows * _meta_record_dtype().itemsize)
+        self._heap.truncate(int(self.header["heap_bytes"]))
+        if self._blocks is not None:
+            self._blocks.truncate(int(self.header["blocks"]) * _meta_block_dtype().itemsize)
+        if not append:
+            self._idx.write(_pack_meta_header(self.header))
+        for f in (self._idx, self._heap, self._blocks):
+            if f is not None:
+                f.seek(0, os.SEEK_END)
+        self._file_ids = {p: i for i, p in enumerate(self.files)}
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._block_first = self.rows
+
+    @property
+    def rows(self) -> int:
+        return int(self.header["rows"])
+
+    def _rollback(self, rows: int) -> None:
+        """中断した投入の再開: rows 行目以降を捨てたヘッダにする（ファイルは開くときに切り詰める）"""
+        import numpy as np
+
+        rec = np.fromfile(self.path, dtype=_meta_record_dtype(), count=1, offset=META_HEADER_SIZE + rows * _meta_record_dtype().itemsize)
+        if self.compressed:
+            blocks = np.fromfile(self.blocks_path, dtype=_meta_block_dtype(), count=int(self.header["blocks"]))
+            b = int(np.searchsorted(blocks["first_row"], rows, side="left"))
+            if b >= len(blocks) or int(blocks[b]["first_row"]) != rows:
+                raise ValueError(f"ブロック境界でない行には巻き戻せません: {rows}")
+            self.header.update(rows=rows, blocks=b, heap_bytes=int(blocks[b]["offset"]))
+        else:
+            self.header.update(rows=rows, heap_bytes=int(rec[0]["offset"]))
+
+    @property
+    def compressed(self) -> bool:
+        return bool(self.header["compressed"])
+
+    def append(self, items: Iterable[Dict]) -> int:
+        """items を追記し、先頭行番号を返す"""
+        import numpy as np
+
+        start = self.rows
+        recs = []
+        for it in items:
+            fid = self._file_ids.get(it["file"])
+            if fid is None:
+                fid = self._file_ids[it["file"]] = len(self.files)
+                self.files.append(it["file"])
+            text = it.get("text", "").encode("utf-8")
+            extra = {k: v for k, v in it.items() if k not in _META_BASE_KEYS}
+            blob = text + (json.dumps(extra, ensure_ascii=False).encode("utf-8") if extra else b"")
+            if self.compressed:
+                if not self._pending:
+                    self._block_first = self.rows + len(recs)
+                offset = self._pending_bytes
+                self._pending.append(blob)
+                self._pending_bytes += len(blob)
+            else:
+                offset = int(self.header["heap_bytes"])
+                self._heap.write(blob)
+                self.header["heap_bytes"] = offset + len(blob)
+            recs.append((offset, len(text), len(blob) - len(text), fid, int(it.get("chunk_index", 0))))
+            if self.compressed and self._pending_bytes >= self.block_bytes:
+                self._flush_block()
+        self._idx.write(np.array(recs, dtype=_meta_record_dtype()).tobytes())
+        self.header["rows"] = start + len(recs)
+        return start
+
+    def _flush_block(self) -> None:
+        import zlib
+
+        import numpy as np
+
+        if not self._pending:
+            return
+        comp = zlib.compress(b"".join(self._pending), 6)
+        offset = int(self.header["heap_bytes"])
+        self._heap.write(comp)
+        self._blocks.write(np.array([(self._block_first, offset, len(comp), self._pending_bytes)], dtype=_meta_block_dtype()).tobytes())
+        self.header["heap_bytes"] = offset + len(comp)
+        self.header["blocks"] = int(self.header["blocks"]) + 1
+        self._pending, self._pending_bytes = [], 0
+
+    def commit(self) -> None:
+        """ここまでの追記をヘッダに反映する（圧縮時は書きかけのブロックも閉じる）"""
+        if self.compressed:
+            self._flush_block()
+        for f in (self._heap, self._blocks):
+            if f is not None:
+                f.flush()
+        tmp = self.files_path.with_name(self.files_path.name + ".tmp")
+        tmp.write_text(json.dumps(self.files, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.files_path)
+        self.header["files"] = len(self.files)
+        self._idx.flush()
+        self._idx.seek(0)
+        self._idx.write(_pack_meta_header(self.header))
+        self._idx.seek(0, os.SEEK_END)
+        self._idx.flush()
+
+    def close(self) -> None:
+        if self._idx.closed:
+            return
+        self.commit()
+        for f in (self._idx, self._heap, self._blocks):
+            if f is not None:
+                f.close()
+
+    def abort(self) -> None:
+        for f in (self._idx, self._heap, self._blocks):
+            if f is not None:
+                f.close()
+
+    def __enter__(self) -> "MetaWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class MetaStore:
+    """meta.idx を読み取り専用で開く。list と同じく len() / [i] / [a:b] / for で {file, chunk_index, text, ...} を返す"""
+
+    def __init__(self, path: Path, block_cache: int = 64) -> None:
+        import functools
+
+        import numpy as np
+
+        self.path = Path(path)
+        self.header = read_meta_header(self.path)
+        rows, heap_bytes = int(self.header["rows"]), int(self.header["heap_bytes"])
+        dt = _meta_record_dtype()
+        self.records = np.memmap(self.path, dtype=dt, mode="r", offset=META_HEADER_SIZE, shape=(rows,)) if rows else np.zeros(0, dtype=dt)
+        heap_path = sidecar_path(self.path, ".heap")
+        self.heap = np.memmap(heap_path, dtype=np.uint8, mode="r", shape=(heap_bytes,)) if heap_bytes else np.zeros(0, dtype=np.uint8)
+        self.blocks = None
+        if self.header["compressed"]:
+            n = int(self.header["blocks"])
+            bt = _meta_block_dtype()
+            self.blocks = np.memmap(sidecar_path(self.path, ".blocks"), dtype=bt, mode="r", shape=(n,)) if n else np.zeros(0, dtype=bt)
+            self._block = functools.lru_cache(maxsize=block_cache)(self._decode_block)
+        n_files = int(self.header["files"])
+        self.files: List[str] = json.loads(sidecar_path(self.path, ".files.json").read_text(encoding="utf-8"))[:n_files] if n_files else []
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _decode_block(self, b: int) -> bytes:
+        import zlib
+
+        blk = self.blocks[b]
+        off = int(blk["offset"])
+        return zlib.decompress(self.heap[off : off + int(blk["comp_len"])].tobytes())
+
+    def _blob(self, rec, row: int) -> bytes:
+        off, n = int(rec["offset"]), int(rec["text_len"]) + int(rec["extra_len"])
+        if self.blocks is None:
+            return self.heap[off : off + n].tobytes()
+        import numpy as np
+
+        b = int(np.searchsorted(self.blocks["first_row"], row, side="right")) - 1
+        return self._block(b)[off : off + n]
+
+    def text(self, row: int) -> str:
+        rec = self.records[row]
+        return self._blob(rec, row)[: int(rec["text_len"])].decode("utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        rec = self.records[i]
+        blob = self._blob(rec, i)
+        tl = int(rec["text_len"])
+        item = {"file": self.files[int(rec["file_id"])], "chunk_index": int(rec["chunk_index"]), "text": blob[:tl].decode("utf-8")}
+        if int(rec["extra_len"]):
+            item.update(json.loads(blob[tl:].decode("utf-8")))
+        return item
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def open_meta(path: Path):
+    """メタデータを開く。meta.idx は MetaStore（memmap）、旧形式の meta.jsonl は dict のリストを返す。無ければ空リスト
+
+    index.shards.json を渡すと全シャードのメタデータを通し番号で引く ShardedMeta を返す。
+    """
+    path = Path(path)
+    if not path.exists():
+        return []
+    if is_shard_set(path):
+        from shards import ShardedMeta
+
+        return ShardedMeta(path)
+    if is_meta_store(path):
+        return MetaStore(path)
+    items: List[Dict] = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except Exception:
+                pass
+    return items
+
+
+def meta_rows(path: Path) -> int:
+    """メタデータの行数（meta.idx はヘッダだけ読む）"""
+    path = Path(path)
+    if not path.exists():
+        return 0
+    if is_meta_store(path):
+        return int(read_meta_header(path)["rows"])
+    with path.open("rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+# ---------------------------------------------------------------------------
+# 埋め込み（バッチ分割 + 並列 + リトライ）
+#   応答は base64（float32 のリトルエンディアン）で受け取り、JSON の数値リストを経ずに
+#   行列へ直接展開する。dimensions を指定すると text-embedding-3 系は次元を落として返す。
+# ---------------------------------------------------------------------------
+
+EMBED_BATCH_ITEMS = 1024       # 1リクエストあたりの最大件数（API上限は2048）
+EMBED_BATCH_TOKENS = 200_000   # 1リクエストあたりの最大トークン数（API上限は300k）
+EMBED_WORKERS = 4
+EMBED_RETRIES = 5
+
+
+def token_counter() -> Callable[[str], int]:
+    """tiktoken があれば正確に、無ければ文字数で（日本語では概ね多めに）見積もる"""
+    try:
+        import tiktoken  # type: ignore
+
+        enc = tiktoken.get_encoding("cl100k_base")
+        return lambda t: len(enc.encode(t, disallowed_special=()))
+    except Exception:
+        return len
+
+
+def plan_batches(texts: List[str], max_items: int = EMBED_BATCH_ITEMS, max_tokens: int = EMBED_BATCH_TOKENS) -> List[Tuple[int, int]]:
+    """入力順を保ったまま、件数・トークン予算に収まる [start, end) の区間に分割する"""
+    count = token_counter()
+    batches: List[Tuple[int, int]] = []
+    start, tokens = 0, 0
+    for i, t in enumerate(texts):
+        n = count(t)
+        if i > start and (i - start >= max_items or tokens + n > max_tokens):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def _decode_embeddings(data: List[Any]):
+    """応答の data を (件数, 次元) の float32 行列にする。
+
+    base64 の文字列は確保済みの行列へそのまま展開する（encoding_format を無視して数値リストを返す互換サーバにも対応）。
+    """
     import numpy as np
 
-    q = query_vec.reshape(1, -1)
-    sims = cosine_sim_matrix(q, vectors)[0]
-    idx = np.argsort(-sims)[:k]
-    return [(int(i), float(sims[i])) for i in idx]
+    out = None
+    for i, d in enumerate(data):
+        emb = d.embedding
+        row = np.frombuffer(base64.b64decode(emb), dtype="<f4") if isinstance(emb, str) else np.asarray(emb, dtype="float32")
+        if out is None:
+            out = np.empty((len(data), len(row)), dtype="float32")
+        # 応答の並びは入力順のはずだが、index があればそれに従う
+        idx = getattr(d, "index", None)
+        out[i if idx is None else idx] = row
+    return out if out is not None else np.zeros((0, 0), dtype="float32")
+
+
+def _embed_request(c: Any, texts: List[str], model: str, retries: int, dimensions: Optional[int] = None):
+    payload: Dict[str, Any] = {"model": model, "input": texts, "encoding_format": "base64"}
+    if dimensions:
+        payload["dimensions"] = int(dimensions)
+    for attempt in range(retries + 1):
+        try:
+            return _decode_embeddings(c.embeddings.create(**payload).data)
+        except Exception as e:
+            # 4xx（429 以外）は入力や認証の問題なので再試行しない
+            status = getattr(e, "status_code", None)
+            if attempt >= retries or (status is not None and 400 <= status < 500 and status != 429):
+                raise
+            time.sleep(min(30.0, 0.5 * 2**attempt) * (0.5 + random.random()))
+    raise AssertionError("unreachable")
+
+
+def _request_batches(texts: List[str], model: str, batches: List[Tuple[int, int]], workers: int, retries: int, dimensions: Optional[int] = None) -> Iterator[Tuple[int, Any]]:
+    """バッチを最大 workers 本並列に投げ、入力順に (先頭位置, ベクトル) を返す。
+
+    未消費の結果が溜まりすぎないよう、同時に抱えるバッチは workers*2 本まで。
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
+    if not batches:
+        return
+    c = shared_client()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending: Dict[int, Any] = {}
+        nxt = 0
+        for bi, (s, e) in enumerate(batches):
+            pending[bi] = pool.submit(_embed_request, c, texts[s:e], model, retries, dimensions)
+            while len(pending) >= max(1, workers) * 2:
+                yield batches[nxt][0], pending.pop(nxt).result()
+                nxt += 1
+        while pending:
+            yield batches[nxt][0], pending.pop(nxt).result()
+            nxt += 1
 
-def embed_texts(texts: Iterable[str], model: str, dry_run: bool = False):
+
+def iter_embedding_batches(
+    texts: Iterable[str],
+    model: str,
+    dry_run: bool = False,
+    batch_items: int = EMBED_BATCH_ITEMS,
+    batch_tokens: int = EMBED_BATCH_TOKENS,
+    workers: int = EMBED_WORKERS,
+    retries: int = EMBED_RETRIES,
+    cache: Any = None,
+    dimensions: Optional[int] = None,
+) -> Iterator[Tuple[int, Any]]:
+    """(先頭位置, ベクトル) を入力順に連続したブロックで返すジェネレータ。
+
+    先に埋め込みキャッシュ（emb_cache.py）を引き、未キャッシュのテキストだけを
+    重複を除いてバッチ並列で取得する。cache=None で既定キャッシュ、False で無効。
+    dimensions を指定すると、その次元に落とした埋め込みを返す（None でモデルの既定次元）。
+    """
     import numpy as np
 
+    texts = list(texts)
     if dry_run:
-        # 乾式: ダミー埋め込み（固定次元=1536）
+        # 乾式: ダミー埋め込み（dimensions が無ければ固定次元=1536）
         rng = np.random.default_rng(42)
-        return rng.normal(size=(len(list(texts)), 1536)).astype("float32")
+        for s, e in plan_batches(texts, max_items=batch_items, max_tokens=batch_tokens):
+            yield s, rng.normal(size=(e - s, dimensions or 1536)).astype("float32")
+        return
+
+    from emb_cache import default_cache, text_key
+
+    if cache is None:
+        cache = default_cache()
+    # 次元を落とした埋め込みは別物としてキャッシュする（0 = モデルの既定次元）
+    dims_key = int(dimensions or 0)
+    keys = [text_key(t) for t in texts]
+    got: Dict[bytes, Any] = cache.get_many(model, dims_key, keys) if cache else {}
+    # 未キャッシュのテキスト（同一テキストは1回だけ問い合わせる）
+    todo: Dict[bytes, str] = {}
+    for k, t in zip(keys, texts):
+        if k not in got:
+            todo.setdefault(k, t)
+    todo_keys = list(todo)
+    todo_texts = list(todo.values())
+    batches = plan_batches(todo_texts, max_items=batch_items, max_tokens=batch_tokens)
+
+    cursor = 0
+
+    def ready() -> Iterator[Tuple[int, Any]]:
+        # 先頭から連続して揃った行をまとめて流す
+        nonlocal cursor
+        while cursor < len(keys) and keys[cursor] in got:
+            end = cursor
+            while end < len(keys) and end - cursor < batch_items and keys[end] in got:
+                end += 1
+            yield cursor, np.stack([got[k] for k in keys[cursor:end]]).astype("float32")
+            cursor = end
+
+    yield from ready()
+    for s, vecs in _request_batches(todo_texts, model, batches, workers, retries, dimensions):
+        pairs = list(zip(todo_keys[s : s + len(vecs)], vecs))
+        got.update(pairs)
+        if cache:
+            cache.put_many(model, dims_key, pairs)
+        yield from ready()
+
+
+def embed_texts(texts: Iterable[str], model: str, dry_run: bool = False, **batch_opts):
+    """全件の埋め込みを (N, D) で返す。内部では iter_embedding_batches でバッチ並列に取得する"""
+    import numpy as np
+
+    parts = [v for _, v in iter_embedding_batches(texts, model, dry_run=dry_run, **batch_opts)]
+    if not parts:
+        return np.zeros((0, (batch_opts.get("dimensions") or 1536) if dry_run else 0), dtype="float32")
+    return np.concatenate(parts, axis=0)
+
+
+def is_shard_set(path: Path) -> bool:
+    """シャード分割したインデックスの構成ファイル（index.shards.json）か"""
+    return Path(path).name.endswith(".shards.json")
+
+
+def resolve_meta_path(index_path: Path, meta: str) -> Path:
+    """検索に使うメタデータのパス。シャード分割したインデックスはメタデータも index.shards.json から引く"""
+    return Path(index_path) if is_shard_set(index_path) else Path(meta).resolve()
+
+
+def sidecar_path(index_path: Path, suffix: str) -> Path:
+    """インデックス本体と同じ場所に置く付随ファイルのパス（例: index.vec -> index.manifest.json）"""
+    index_path = Path(index_path)
+    return index_path.with_name(index_path.stem + suffix)
+
+
+def index_stamp(index_path: Path, meta_path: Path) -> Tuple:
+    """index.* と meta.* の (名前, 更新時刻, サイズ) の組。インデックスを更新すると変わる（server.py の再読み込み・回答キャッシュの失効に使う）"""
+    paths = set(index_path.parent.glob(index_path.stem + ".*")) | set(meta_path.parent.glob(meta_path.stem + ".*")) | {meta_path}
+    if is_shard_set(index_path) and index_path.exists():
+        from shards import read_shard_set
+
+        for vec, _ in read_shard_set(index_path):
+            paths |= set(vec.parent.glob("*"))
+    paths = sorted(paths)
+    out = []
+    for p in paths:
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        out.append((p.name, st.st_mtime_ns, st.st_size))
+    return tuple(out)
+
+
+def index_version(index_path: Path, meta_path: Path) -> str:
+    """index_stamp を短い文字列にしたもの（インデックスを更新するたびに変わる）"""
+    return hashlib.sha256(repr(index_stamp(index_path, meta_path)).encode("utf-8")).hexdigest()[:16]
+
+
+def index_embedding(index_path: Path, model: str) -> Optional[int]:
+    """インデックスのヘッダから、質問の埋め込みに指定する dimensions を返す（既定次元なら None）。
+
+    インデックスを作ったモデルと model が違えば ValueError（次元や空間が合わず、検索結果が無意味になる）。
+    """
+    index_path = Path(index_path)
+    if is_shard_set(index_path):
+        from shards import read_shard_set
+
+        vecs = [vec for vec, _ in read_shard_set(index_path) if vec.exists()]
+        if not vecs:
+            return None
+        index_path = vecs[0]
+    if index_path.suffix != ".vec" or not index_path.exists():
+        return None
+    h = read_vec_header(index_path)
+    if h.get("model") and h["model"] != model:
+        raise ValueError(f"インデックスは {h['model']} で作られています（--emb-model {model}）。--emb-model {h['model']} を指定してください。")
+    return h.get("dimensions") or None
+
+
+def query_dimensions(p: Any, index_path: Path, model: str) -> Optional[int]:
+    """CLI 用の index_embedding。質問もインデックスと同じモデル・次元数で埋め込むための値を返し、モデル違いは p.error で止める"""
+    try:
+        return index_embedding(index_path, model)
+    except ValueError as e:
+        p.error(str(e))
+
+
+def load_live_mask(index_path: Path, rows: int):
+    """マニフェストの tombstones（削除済み行）を反映した bool マスクを返す。削除が無ければ None。"""
+    import numpy as np
+
+    manifest = sidecar_path(index_path, ".manifest.json")
+    if not manifest.exists():
+        return None
+    dead = json.loads(manifest.read_text(encoding="utf-8")).get("tombstones") or []
+    if not dead:
+        return None
+    mask = np.ones(rows, dtype=bool)
+    dead_idx = np.asarray(dead, dtype=np.int64)
+    mask[dead_idx[dead_idx < rows]] = False
+    return mask
+
+
+def index_chunk_overlap(index_path: Path) -> Optional[int]:
+    """インデックスを作ったときの隣り合うチャンクの重なり（文字数）。マニフェストが無ければ None。
+
+    chunk_text の刻み幅は max(1, chunk_size - chunk_overlap) なので、実際の重なりは chunk_size - 刻み幅。
+    """
+    if is_shard_set(index_path):
+        from shards import read_shard_set
+
+        vecs = [vec for vec, _ in read_shard_set(index_path) if vec.exists()]
+        if not vecs:
+            return None
+        index_path = vecs[0]
+    manifest = sidecar_path(index_path, ".manifest.json")
+    if not manifest.exists():
+        return None
+    m = json.loads(manifest.read_text(encoding="utf-8"))
+    size, overlap = m.get("chunk_size"), m.get("chunk_overlap")
+    if size is None or overlap is None:
+        return None
+    if size <= 0:
+        return 0
+    return size - max(1, size - max(0, overlap))
+
+
+def load_aliases(index_path: Path) -> Dict[int, List[str]]:
+    """マニフェストの重複除去の記録から 行番号 -> その行と同じ内容で省かれたチャンクのファイル一覧 を返す"""
+    if is_shard_set(index_path):
+        from shards import load_shard_aliases
+
+        return load_shard_aliases(index_path)
+    manifest = sidecar_path(index_path, ".manifest.json")
+    if not manifest.exists():
+        return {}
+    out: Dict[int, List[str]] = {}
+    for path, ent in (json.loads(manifest.read_text(encoding="utf-8")).get("files") or {}).items():
+        for _, row in ent.get("aliases") or ():
+            files = out.setdefault(int(row), [])
+            if path not in files:
+                files.append(path)
+    return out
+
+
+def vectors_for_rows(index_path: Path, rows: List[int]):
+    """指定した行（シャード分割なら通し番号）の正規化済みベクトルを float32 の (len(rows), dims) で返す"""
+    import numpy as np
+
+    if is_shard_set(index_path):
+        from shards import shard_vectors
+
+        return shard_vectors(index_path, rows)
+    vectors = load_vectors(index_path)
+    return np.asarray(vectors[np.asarray(rows, dtype=np.int64)], dtype="float32")
+
+
+# ---------------------------------------------------------------------------
+# 検索バックエンド
+#   どのバックエンドも search(query_vec, k) -> [(行番号, スコア), ...] を返す。
+# ---------------------------------------------------------------------------
+
+SEARCH_BACKENDS = ("exact", "ivf", "hnsw", "pq", "binary")
+
+
+class ExactSearcher:
+    """全件走査（正規化済みベクトルとの内積1回）"""
+
+    def __init__(self, vectors, mask=None) -> None:
+        self.vectors = vectors
+        self.mask = mask
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        return top_k_similar(query_vec, self.vectors, k, normalized=True, mask=self.mask)
+
+    def search_batch(self, queries, k: int) -> List[List[Tuple[int, float]]]:
+        import numpy as np
+
+        ids, scores = search_batch(queries, self.vectors, k, mask=self.mask)
+        return [[(int(i), float(v)) for i, v in zip(ri, rv) if np.isfinite(v)] for ri, rv in zip(ids, scores)]
+
+
+def batch_search(searcher: Any, queries, k: int) -> List[List[Tuple[int, float]]]:
+    """search_batch を持つバックエンドは行列積1回で、それ以外は1件ずつ検索する"""
+    if hasattr(searcher, "search_batch"):
+        return searcher.search_batch(queries, k)
+    return [searcher.search(q, k) for q in queries]
+
+
+def rrf_fuse(rankings: List[List[Tuple[int, float]]], k: int, rrf_k: int = 60) -> List[Tuple[int, float]]:
+    """複数の順位リストを Reciprocal Rank Fusion（sum 1/(rrf_k + 順位)）で1つにまとめる。
+
+    スコアの尺度が違う検索（BM25 と cosine など）を、順位だけで公平に混ぜられる。
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (row, _) in enumerate(ranking, start=1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda x: -x[1])[:k]
+
+
+def add_search_args(p: Any) -> None:
+    """検索バックエンド関連の CLI 引数を追加する（query.py / hyde_query.py / rerank_with_chat.py 共通）"""
+    p.add_argument("--backend", choices=SEARCH_BACKENDS, default="exact", help="検索方式（exact=全件走査, ivf/hnsw/pq/binary=近似）")
+    p.add_argument("--nprobe", type=int, default=8, help="ivf: 走査するリスト数（大きいほど高精度・低速）")
+    p.add_argument("--ef", type=int, default=64, help="hnsw: 探索時の候補幅（大きいほど高精度・低速）")
+    p.add_argument("--rescore", type=int, default=100, help="pq/binary: 元のベクトルで再採点する候補数（pq は 0 で再採点なし）")
+
+
+def search_opts(args: Any) -> Dict[str, Any]:
+    """add_search_args で追加した引数のうち、バックエンドに渡すものを取り出す"""
+    return {"nprobe": args.nprobe, "ef": args.ef, "rescore": args.rescore}
+
+
+def open_searcher(index_path: Path, vectors, backend: str = "exact", mask: Any = None, **opts: Any) -> Any:
+    if backend == "exact":
+        return ExactSearcher(vectors, mask=mask)
+    if backend == "ivf":
+        from ivf_index import IVFSearcher
+
+        return IVFSearcher(index_path, vectors, mask=mask, nprobe=opts.get("nprobe", 8))
+    if backend == "hnsw":
+        from hnsw_index import HNSWSearcher
+
+        return HNSWSearcher(index_path, vectors, mask=mask, ef=opts.get("ef", 64))
+    if backend == "pq":
+        from pq_index import PQSearcher
+
+        return PQSearcher(index_path, vectors, mask=mask, rescore=opts.get("rescore", 100))
+    if backend == "binary":
+        from binary_index import BinarySearcher
+
+        return BinarySearcher(index_path, vectors, mask=mask, rescore=opts.get("rescore", 100))
+    raise ValueError(f"未知の検索バックエンドです: {backend}")
+
+
+def open_index(index_path: Path, backend: str = "exact", **opts: Any) -> Tuple[Any, int]:
+    """インデックスを開いて (検索器, 行数) を返す。
+
+    index.shards.json ならシャードごとの常駐プロセスで並列に検索する ShardedSearcher（shards.py）を返す。
+    """
+    if is_shard_set(index_path):
+        from shards import ShardedSearcher
+
+        searcher = ShardedSearcher(index_path, backend, **opts)
+        return searcher, searcher.rows
+    vectors = load_vectors(index_path)
+    return open_searcher(index_path, vectors, backend, mask=load_live_mask(index_path, len(vectors)), **opts), len(vectors)
+
+
+def eval_recall(searcher: Any, vectors, mask=None, n_queries: int = 200, k: int = 10, seed: int = 0) -> Dict[str, Any]:
+    """インデックス内の行を質問にして、全件走査に対する recall@k と平均レイテンシ（ms）を測る"""
+    import numpy as np
 
-    c = client()
-    # OpenAI SDK v1: embeddings.create は一括で応答
-    resp = c.embeddings.create(model=model, input=list(texts))
-    vecs = [d.embedding for d in resp.data]
-    return np.array(vecs, dtype="float32")
+    rng = np.random.default_rng(seed)
+    pick = np.sort(rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False))
+    qs = np.asarray(vectors[pick], dtype="float32")
+    hit, total, t_exact, t_approx = 0, 0, 0.0, 0.0
+    for q in qs:
+        t0 = time.perf_counter()
+        exact = {i for i, _ in top_k_similar(q, vectors, k, normalized=True, mask=mask)}
+        t1 = time.perf_counter()
+        approx = {i for i, _ in searcher.search(q, k)}
+        t2 = time.perf_counter()
+        hit += len(exact & approx)
+        total += len(exact)
+        t_exact += t1 - t0
+        t_approx += t2 - t1
+    n = max(1, len(qs))
+    return {
+        "queries": len(qs),
+        "k": k,
+        "recall_at_k": hit / max(1, total),
+        "exact_ms": 1000 * t_exact / n,
+        "approx_ms": 1000 * t_approx / n,
+    }
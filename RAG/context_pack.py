@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""回答に渡すコンテキストの組み立て（query.py / server.py から使う）。
+
+- 同じファイルの連続したチャンク（chunk_index が隣り合う）は、インデックス作成時の重なり（マニフェストの chunk_overlap）を除いて1つの区間にまとめる。
+- 区間を hits の並び（検索・再ランクの順位）で優先し、トークン予算（--context-tokens）に収まるだけ詰める。
+- --score-gap を指定すると、スコアが前の候補から大きく落ちたところで打ち切る（固定の k の代わり）。
+"""
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Optional
+
+from common import token_counter
+
+DEFAULT_CONTEXT_TOKENS = 4000
+
+
+def score_gap_cutoff(hits: List[Dict], gap: float, min_hits: int = 1) -> List[Dict]:
+    """スコアを降順に並べ、前の値からの落ち幅が最高スコアの gap 倍を超えたところより下のヒットを除く（gap<=0 なら除かない）
+
+    hits はスコア順でなくてよい（再ランク後の順など）。残すヒットの並びは変えない。
+    """
+    if gap <= 0 or len(hits) <= min_hits:
+        return hits
+    scores = sorted((float(h["score"]) for h in hits), reverse=True)
+    limit = gap * abs(scores[0])
+    for n in range(max(1, min_hits), len(scores)):
+        if scores[n - 1] - scores[n] > limit:
+            return [h for h in hits if float(h["score"]) >= scores[n - 1]]
+    return hits
+
+
+def _join(a: str, b: str, overlap: Optional[int]) -> Optional[str]:
+    """a の末尾と次のチャンク b の先頭の重なり（overlap 文字。b が短ければ b 全体）を1つにしてつなぐ。
+
+    重なりが分からない・記録と本文が合わない場合は None（まとめずに別の区間にする。本文を失うよりよい）。
+    """
+    if overlap is None:
+        return None
+    n = min(overlap, len(b))
+    if not a.endswith(b[:n]):
+        return None
+    return a + b[n:]
+
+
+def merge_spans(hits: List[Dict], overlap: Optional[int] = None) -> List[Dict]:
+    """同じファイルで chunk_index が連続するチャンクを1区間にまとめ、区間内の最上位のヒットの順に返す。
+
+    overlap はインデックス作成時のチャンクの重なり（index_chunk_overlap）。None なら連続していてもまとめない。
+    """
+    by_file: Dict[Any, List[Dict]] = {}
+    for rank, h in enumerate(hits):
+        by_file.setdefault(h.get("file"), []).append((rank, h))
+    spans: List[Dict] = []
+    for file, group in by_file.items():
+        span: Optional[Dict] = None
+        for rank, h in sorted(group, key=lambda x: (x[1].get("chunk_index") is None, x[1].get("chunk_index") or 0)):
+            ci = h.get("chunk_index")
+            if span is not None and ci is not None and span["chunk_end"] is not None and ci <= span["chunk_end"] + 1:
+                text = span["text"] if ci <= span["chunk_end"] else _join(span["text"], h.get("text", ""), overlap)
+                if text is not None:
+                    span["text"] = text
+                    span["chunk_end"] = max(span["chunk_end"], ci)
+                    span["score"] = max(span["score"], float(h["score"]))
+                    span["rank"] = min(span["rank"], rank)
+                    span["rows"].append(h.get("row"))
+                    continue
+            span = {"file": file, "chunk_start": ci, "chunk_end": ci, "score": float(h["score"]), "rank": rank, "text": h.get("text", ""), "rows": [h.get("row")]}
+            spans.append(span)
+    spans.sort(key=lambda s: s["rank"])
+    return spans
+
+
+def pack_contexts(hits: List[Dict], max_tokens: int = DEFAULT_CONTEXT_TOKENS, score_gap: float = 0.0, count: Optional[Callable[[str], int]] = None, overlap: Optional[int] = None) -> List[Dict]:
+    """hits（順位順。file / chunk_index / text / score を持つ）から、予算内に収まる区間のリストを返す。
+
+    score_gap はスコアの大きさで（順位とは別に）低いヒットを除く。score は再ランク後も元の検索のスコアでよい。
+    区間は hits の並びで優先する（再ランク後の順位もそのまま使う）。
+    予算に収まらない区間は飛ばして次を試す。1つも入らない場合は最上位の区間を予算に合わせて切り詰める。
+    max_tokens<=0 なら予算の制限なし。overlap は merge_spans を参照。
+    """
+    count = count or token_counter()
+    spans = merge_spans(score_gap_cutoff(hits, score_gap), overlap)
+    if max_tokens <= 0:
+        for s in spans:
+            s["tokens"] = count(s["text"])
+        return spans
+    out: List[Dict] = []
+    used = 0
+    for s in spans:
+        s["tokens"] = count(s["text"])
+        if used + s["tokens"] <= max_tokens:
+            out.append(s)
+            used += s["tokens"]
+    if not out and spans:
+        s = spans[0]
+        s["text"] = s["text"][: max(1, len(s["text"]) * max_tokens // max(1, s["tokens"]))]
+        s["tokens"] = count(s["text"])
+        out.append(s)
+    return out
+
+
+def add_context_args(p: Any) -> None:
+    p.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS, help="回答に渡すコンテキストのトークン予算（0 で無制限）")
+    p.add_argument("--score-gap", type=float, default=0.0, help="スコアを高い順に並べ、直前から最高スコアのこの割合を超えて落ちた位置より低いヒットを使わない（0 で無効）")
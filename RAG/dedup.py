@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""SimHash による重複・ほぼ重複チャンクの検出（ingest.py --dedup から使う）。
+
+- 署名: チャンクの語（bm25_index.tokenize。英数字は語、日本語は文字 2/3-gram）と隣り合う語の組を 64bit ハッシュし、
+  出現回数で重み付けした各ビットの多数決を取った 64bit の SimHash。似た文章ほどハミング距離が小さい。
+- 検索: 署名を distance+1 個のブロックに分けて表を引く。距離 distance 以内なら、
+  鳩の巣原理でどれか1ブロックは完全一致するので、そのブロックが一致する行だけを比べれば取りこぼさない。
+- 保存: index.simhash（行ごとの署名を uint64 で並べただけのファイル。index.vec と同じ行番号）
+
+使い方（既存インデックスの重複率を見積もる）:
+  python RAG/dedup.py --meta RAG/index/meta.idx --distance 3
+"""
+from __future__ import annotations
+
+import argparse
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bm25_index import term_hash, tokenize
+from common import open_meta, pretty
+
+DEDUP_DISTANCE = 3
+# 語の種類がこれより少ない短いチャンクは偶然の一致が起きやすいので、署名の完全一致だけを重複とみなす
+DEDUP_MIN_FEATURES = 16
+
+
+def simhash(text: str) -> Tuple[int, int]:
+    """(64bit 署名, 異なり語数) を返す"""
+    import numpy as np
+
+    toks = tokenize(text)
+    # 隣り合う語の組も特徴に加え、語の集合が同じでも並びの違う文章は別物として扱う
+    c = Counter(toks)
+    c.update(a + " " + b for a, b in zip(toks, toks[1:]))
+    if not c:
+        return 0, 0
+    h = np.fromiter((term_hash(t) for t in c), dtype=np.uint64, count=len(c))
+    w = np.fromiter(c.values(), dtype=np.float32, count=len(c))
+    bits = ((h[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)).astype(np.float32)
+    v = w @ (2.0 * bits - 1.0)
+    return int(np.packbits(v > 0, bitorder="little").view("<u8")[0]), len(c)
+
+
+class SimHashIndex:
+    """ハミング距離 distance 以内の署名を持つ、最も若い生存行を引く表"""
+
+    def __init__(self, distance: int = DEDUP_DISTANCE, min_features: int = DEDUP_MIN_FEATURES) -> None:
+        if not 0 <= distance < 64:
+            raise ValueError(f"distance は 0..63 で指定してください: {distance}")
+        self.distance = distance
+        self.min_features = min_features
+        bounds = [round(64 * b / (distance + 1)) for b in range(distance + 2)]
+        self.blocks = [(s, (1 << (e - s)) - 1) for s, e in zip(bounds[:-1], bounds[1:])]
+        self.sigs: Dict[int, int] = {}
+        self.base_sigs = ()
+        self._base: List[Tuple] = []
+        self._new: List[Dict[int, List[int]]] = [{} for _ in self.blocks]
+        self.dead: set = set()
+
+    def load(self, sigs, dead: Iterable[int] = ()) -> None:
+        """既存行の署名（行番号順。0 は署名なし）を読み込む"""
+        import numpy as np
+
+        sigs = np.asarray(sigs, dtype=np.uint64)
+        rows = np.flatnonzero(sigs)
+        self.base_sigs = sigs
+        self._base = []
+        for s, m in self.blocks:
+            keys = (sigs[rows] >> np.uint64(s)) & np.uint64(m)
+            order = np.argsort(keys, kind="stable")
+            self._base.append((keys[order], rows[order]))
+        self.dead.update(int(r) for r in dead)
+
+    def _sig(self, row: int) -> int:
+        sig = self.sigs.get(row)
+        return int(self.base_sigs[row]) if sig is None else sig
+
+    def _candidates(self, sig: int) -> Iterable[int]:
+        import numpy as np
+
+        for (s, m), base, new in zip(self.blocks, self._base or [None] * len(self.blocks), self._new):
+            key = (sig >> s) & m
+            if base is not None:
+                keys, rows = base
+                lo, hi = np.searchsorted(keys, np.uint64(key), side="left"), np.searchsorted(keys, np.uint64(key), side="right")
+                yield from rows[lo:hi].tolist()
+            yield from new.get(key, ())
+
+    def find(self, sig: int, n_features: int) -> Optional[int]:
+        if not n_features:
+            return None
+        limit = self.distance if n_features >= self.min_features else 0
+        best = None
+        for row in self._candidates(sig):
+            if row in self.dead or (best is not None and row >= best):
+                continue
+            if bin(self._sig(row) ^ sig).count("1") <= limit:
+                best = row
+        return best
+
+    def add(self, row: int, sig: int) -> None:
+        if not sig:
+            return
+        self.sigs[row] = sig
+        for (s, m), new in zip(self.blocks, self._new):
+            new.setdefault((sig >> s) & m, []).append(row)
+
+    def remove(self, rows: Iterable[int]) -> None:
+        self.dead.update(rows)
+
+
+def read_signatures(path: Path, rows: int):
+    """index.simhash の先頭 rows 行を読む（足りない行は 0 = 署名なし）"""
+    import numpy as np
+
+    out = np.zeros(rows, dtype=np.uint64)
+    path = Path(path)
+    if path.exists():
+        got = np.fromfile(path, dtype="<u8", count=min(rows, path.stat().st_size // 8))
+        out[: len(got)] = got
+    return out
+
+
+class SignatureWriter:
+    """index.simhash への追記。keep_rows より後ろ（前回の中断で書きかけだった分）は開くときに捨てる"""
+
+    def __init__(self, path: Path, keep_rows: int) -> None:
+        import numpy as np
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = self.path.open("r+b" if self.path.exists() else "w+b")
+        size = self._f.seek(0, os.SEEK_END)
+        if size < keep_rows * 8:
+            # 署名の無い古い行は 0 で埋める（重複検出の対象外）
+            self._f.write(np.zeros(keep_rows - size // 8, dtype="<u8").tobytes())
+        self._f.truncate(keep_rows * 8)
+        self._f.seek(keep_rows * 8)
+
+    def append(self, sigs: List[int]) -> None:
+        import numpy as np
+
+        self._f.write(np.asarray(sigs, dtype="<u8").tobytes())
+
+    def commit(self) -> None:
+        self._f.flush()
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+
+    def abort(self) -> None:
+        # 確定していない分は次に開くときに keep_rows で捨てられる
+        self.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: estimate near-duplicate chunks in an index with SimHash")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    p.add_argument("--distance", type=int, default=DEDUP_DISTANCE, help="重複とみなすハミング距離（64bit 中）")
+    p.add_argument("--show", type=int, default=3, help="重複の例を何件表示するか")
+    args = p.parse_args(argv)
+
+    meta = open_meta(Path(args.meta).resolve())
+    if not len(meta):
+        raise RuntimeError(f"メタデータが空です: {args.meta}")
+    index = SimHashIndex(args.distance)
+    dups: List[Tuple[int, int]] = []
+    for row, it in enumerate(meta):
+        sig, nf = simhash(it.get("text", ""))
+        canon = index.find(sig, nf)
+        if canon is None:
+            index.add(row, sig)
+        else:
+            dups.append((row, canon))
+    print(pretty({
+        "rows": len(meta),
+        "duplicates": len(dups),
+        "dedup_ratio": round(len(dups) / len(meta), 4),
+        "examples": [{"row": r, "file": meta[r].get("file"), "same_as": c, "same_as_file": meta[c].get("file")} for r, c in dups[: args.show]],
+    }))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""埋め込みのローカルキャッシュ（(model, dims, sha256(text)) -> ベクトル）。
+
+保存先は標準ライブラリの sqlite3。ベクトルは float32 の生バイト列で持つ。
+最終利用時刻で LRU 管理し、合計サイズが上限を超えたら古いものから捨てる。
+
+環境変数:
+  RAG_EMB_CACHE     キャッシュファイルのパス（"off" で無効化。既定: ./RAG/cache/embeddings.sqlite）
+  RAG_EMB_CACHE_MB  サイズ上限 MB（既定: 1024）
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PATH = "./RAG/cache/embeddings.sqlite"
+DEFAULT_MAX_MB = 1024
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS emb ("
+            " model TEXT NOT NULL, dims INTEGER NOT NULL, key BLOB NOT NULL,"
+            " vec BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, dims, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS emb_lru ON emb (last_used)")
+        self._db.commit()
+        row = self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM emb").fetchone()
+        self._bytes = int(row[0])
+
+    def get_many(self, model: str, dims: int, keys: Iterable[bytes]) -> Dict[bytes, "object"]:
+        """見つかったキーだけを {key: ベクトル} で返し、最終利用時刻を更新する"""
+        with self._lock:
+            return self._get_many(model, dims, keys)
+
+    def put_many(self, model: str, dims: int, pairs: Iterable[Tuple[bytes, "object"]]) -> None:
+        with self._lock:
+            self._put_many(model, dims, pairs)
+
+    def _get_many(self, model: str, dims: int, keys: Iterable[bytes]) -> Dict[bytes, "object"]:
+        import numpy as np
+
+        keys = list(dict.fromkeys(keys))
+        found: Dict[bytes, object] = {}
+        for i in range(0, len(keys), 500):
+            part = keys[i : i + 500]
+            q = "SELECT key, vec FROM emb WHERE model=? AND dims=? AND key IN (%s)" % ",".join("?" * len(part))
+            for k, v in self._db.execute(q, [model, dims, *part]):
+                found[bytes(k)] = np.frombuffer(v, dtype="float32")
+        if found:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE emb SET last_used=? WHERE model=? AND dims=? AND key=?",
+                [(now, model, dims, k) for k in found],
+            )
+            self._db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def _put_many(self, model: str, dims: int, pairs: Iterable[Tuple[bytes, "object"]]) -> None:
+        import numpy as np
+
+        now = time.time()
+        rows: List[Tuple] = []
+        for k, v in pairs:
+            blob = np.ascontiguousarray(v, dtype="float32").tobytes()
+            rows.append((model, dims, k, blob, now))
+        if not rows:
+            return
+        self._db.executemany("INSERT OR REPLACE INTO emb VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+        self._bytes += sum(len(r[3]) for r in rows)
+        if self._bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        """上限の 90% を下回るまで、最終利用が古いものから削除する"""
+        target = int(self.max_bytes * 0.9)
+        row = self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM emb").fetchone()
+        self._bytes = int(row[0])
+        while self._bytes > target:
+            cur = self._db.execute("SELECT rowid, LENGTH(vec) FROM emb ORDER BY last_used LIMIT 1000").fetchall()
+            if not cur:
+                break
+            drop: List[int] = []
+            for rowid, n in cur:
+                if self._bytes <= target:
+                    break
+                drop.append(rowid)
+                self._bytes -= int(n)
+            self._db.executemany("DELETE FROM emb WHERE rowid=?", [(r,) for r in drop])
+        self._db.commit()
+        self._db.execute("PRAGMA incremental_vacuum")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_default: Optional[EmbeddingCache] = None
+
+
+def default_cache() -> Optional[EmbeddingCache]:
+    """環境変数に従った既定キャッシュ（プロセス内で1つ）。無効化されていれば None"""
+    global _default
+    path = os.getenv("RAG_EMB_CACHE", DEFAULT_PATH)
+    if path.strip().lower() in ("", "0", "off", "none", "false"):
+        return None
+    if _default is None or _default.path != Path(path):
+        max_mb = float(os.getenv("RAG_EMB_CACHE_MB", DEFAULT_MAX_MB))
+        _default = EmbeddingCache(Path(path), max_bytes=int(max_mb * 1024 * 1024))
+    return _default
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ファイル形式ごとのテキスト抽出（ingest.py から使う）。
+
+- 拡張子 -> 抽出関数 の登録制。新しい形式は register_extractor / register_paged_extractor で追加する。
+- 重い形式（PDF・HTML）は ProcessPoolExecutor で並列に抽出する（GIL の影響を受けない）。
+- ページのある形式（PDF）は大きな文書をページ範囲に分けて並列に抽出し、
+  (ファイルの SHA-256, ページ番号) ごとの抽出結果とページ数を sqlite3 にキャッシュする。
+  チャンク設定や埋め込みモデルを変えて --rebuild しても、同じ PDF を再解析しない（ページ数を数えるための解析もしない）。
+- ページ数の計数も抽出も子プロセスで行う。子プロセスはファイルを読み直し、SHA-256 が投入時と同じことを確かめてから解析する
+  （途中でファイルが変わっても、別の内容を古いハッシュでキャッシュしない）。
+
+環境変数:
+  RAG_PAGE_CACHE  ページキャッシュのパス（"off" で無効化。既定: ./RAG/cache/pages.sqlite）
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_PAGE_CACHE = "./RAG/cache/pages.sqlite"
+PAGES_PER_TASK = 8
+
+# 拡張子 -> (path, data) から本文を返す関数
+EXTRACTORS: Dict[str, Callable[[Path, bytes], str]] = {}
+# 拡張子 -> (data からページ数を返す関数, (data, ページ番号のリスト) から各ページの本文を返す関数, 抽出器の版)
+PAGED_EXTRACTORS: Dict[str, Tuple[Callable[[bytes], int], Callable[[bytes, List[int]], List[str]], str]] = {}
+# プロセスプールで実行する拡張子
+POOLED: set = set()
+
+
+def register_extractor(suffixes: Tuple[str, ...], pooled: bool = False):
+    def deco(fn: Callable[[Path, bytes], str]) -> Callable[[Path, bytes], str]:
+        for s in suffixes:
+            EXTRACTORS[s.lower()] = fn
+            if pooled:
+                POOLED.add(s.lower())
+        return fn
+
+    return deco
+
+
+def register_paged_extractor(suffixes: Tuple[str, ...], page_count: Callable[[bytes], int], version: str):
+    """ページ単位で並列化・キャッシュする抽出器を登録する（関数はプロセスプールへ渡すのでモジュール直下に定義すること）"""
+
+    def deco(fn: Callable[[bytes, List[int]], List[str]]) -> Callable[[bytes, List[int]], List[str]]:
+        for s in suffixes:
+            PAGED_EXTRACTORS[s.lower()] = (page_count, fn, version)
+            POOLED.add(s.lower())
+        return fn
+
+    return deco
+
+
+def supported_suffixes() -> List[str]:
+    return sorted(set(EXTRACTORS) | set(PAGED_EXTRACTORS))
+
+
+# ---- テキスト系 ----
+@register_extractor((".md", ".txt"))
+def extract_text(path: Path, data: bytes) -> str:
+    return data.decode("utf-8", errors="ignore")
+
+
+# ---- HTML ----
+class _HTMLText(HTMLParser):
+    SKIP = {"script", "style", "noscript", "template", "svg"}
+    BLOCK = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "pre", "table", "ul", "ol", "header", "footer"}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs) -> None:
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag) -> None:
+        if tag in self.SKIP:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_data(self, data) -> None:
+        if not self._skip:
+            self.parts.append(data)
+
+
+@register_extractor((".html", ".htm"), pooled=True)
+def extract_html(path: Path, data: bytes) -> str:
+    p = _HTMLText()
+    p.feed(data.decode("utf-8", errors="ignore"))
+    p.close()
+    lines = (" ".join(line.split()) for line in "".join(p.parts).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+# ---- PDF ----
+def _pdf_reader(src):
+    try:
+        from pypdf import PdfReader  # type: ignore
+    except Exception as e:
+        raise RuntimeError("PDF の抽出には pypdf が必要です。pip install pypdf") from e
+    return PdfReader(src)
+
+
+def pdf_page_count(data: bytes) -> int:
+    return len(_pdf_reader(io.BytesIO(data)).pages)
+
+
+@register_paged_extractor((".pdf",), page_count=pdf_page_count, version="pypdf-1")
+def extract_pdf_pages(data: bytes, pages: List[int]) -> List[str]:
+    reader = _pdf_reader(io.BytesIO(data))
+    return [reader.pages[i].extract_text() or "" for i in pages]
+
+
+def _run_extractor(suffix: str, path: str, data: bytes) -> str:
+    # プロセスプールから呼ぶ入口（登録はモジュール読み込み時に行われるので、子プロセスでも引ける）
+    return EXTRACTORS[suffix](Path(path), data)
+
+
+def _read_checked(path: str, digest: str, data: Optional[bytes]) -> bytes:
+    """data が無ければ path を読み直し、投入時に計算した SHA-256 と同じ内容か確かめて返す"""
+    if data is not None:
+        return data
+    data = Path(path).read_bytes()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise RuntimeError(f"抽出中にファイルが変更されました。もう一度 ingest.py を実行してください: {path}")
+    return data
+
+
+def _run_page_count(suffix: str, path: str, digest: str, data: Optional[bytes]) -> int:
+    return PAGED_EXTRACTORS[suffix][0](_read_checked(path, digest, data))
+
+
+def _run_paged(suffix: str, path: str, digest: str, data: Optional[bytes], pages: List[int]) -> List[str]:
+    return PAGED_EXTRACTORS[suffix][1](_read_checked(path, digest, data), pages)
+
+
+# ---- ページキャッシュ ----
+class PageCache:
+    """(文書の SHA-256, ページ番号, 抽出器の版) -> 本文、(文書の SHA-256, 抽出器の版) -> ページ数"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages (doc TEXT NOT NULL, version TEXT NOT NULL, page INTEGER NOT NULL,"
+            " text TEXT NOT NULL, PRIMARY KEY (doc, version, page))"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS docs (doc TEXT NOT NULL, version TEXT NOT NULL, pages INTEGER NOT NULL, PRIMARY KEY (doc, version))")
+        self._db.commit()
+
+    def get_count(self, doc: str, version: str) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute("SELECT pages FROM docs WHERE doc=? AND version=?", (doc, version)).fetchone()
+        return None if row is None else int(row[0])
+
+    def put_count(self, doc: str, version: str, pages: int) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)", (doc, version, int(pages)))
+            self._db.commit()
+
+    def get(self, doc: str, version: str) -> Dict[int, str]:
+        with self._lock:
+            rows = self._db.execute("SELECT page, text FROM pages WHERE doc=? AND version=?", (doc, version)).fetchall()
+        return {int(p): t for p, t in rows}
+
+    def put(self, doc: str, version: str, pages: Dict[int, str]) -> None:
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", [(doc, version, p, t) for p, t in pages.items()])
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def default_page_cache() -> Optional[PageCache]:
+    path = os.getenv("RAG_PAGE_CACHE", DEFAULT_PAGE_CACHE)
+    if path.strip().lower() in ("", "0", "off", "none", "false"):
+        return None
+    return PageCache(Path(path))
+
+
+# ---- 並列抽出 ----
+class ExtractPool:
+    """submit() はすぐに戻り、呼ぶと本文を返す関数を返す（結果待ちは呼び出し側が好きな順で行う）。
+
+    workers<=1 なら子プロセスを使わずその場で抽出する。
+    """
+
+    def __init__(self, workers: int = 0, cache: Optional[PageCache] = None, pages_per_task: int = PAGES_PER_TASK) -> None:
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.cache = cache
+        self.pages_per_task = max(1, pages_per_task)
+        self._pool = None
+        if self.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def _call(self, fn, *a):
+        if self._pool is None:
+            value = fn(*a)
+            return lambda: value
+        fut = self._pool.submit(fn, *a)
+        return fut.result
+
+    def submit(self, path: Path, data: bytes, digest: str) -> Callable[[], str]:
+        suffix = path.suffix.lower()
+        if suffix in PAGED_EXTRACTORS:
+            return self._submit_paged(suffix, path, data, digest)
+        if suffix not in EXTRACTORS:
+            raise ValueError(f"未対応のファイル形式です: {path}（対応: {', '.join(supported_suffixes())}）")
+        if suffix in POOLED:
+            return self._call(_run_extractor, suffix, str(path), data)
+        text = EXTRACTORS[suffix](path, data)
+        return lambda: text
+
+    def _submit_paged(self, suffix: str, path: Path, data: bytes, digest: str) -> Callable[[], str]:
+        version = PAGED_EXTRACTORS[suffix][2]
+        cached = self.cache.get(digest, version) if self.cache else {}
+        known = self.cache.get_count(digest, version) if self.cache else None
+        # 子プロセスにはバイト列を送らず、パスとハッシュを渡して読み直させる（その場で抽出するときはそのまま使う）
+        src = (suffix, str(path), digest, data if self._pool is None else None)
+
+        def submit_missing(n: int) -> List[Tuple[List[int], Callable[[], List[str]]]]:
+            missing = [i for i in range(n) if i not in cached]
+            if self.cache:
+                self.cache.hits += n - len(missing)
+                self.cache.misses += len(missing)
+            # 大きな文書はページ範囲ごとに別プロセスで抽出する
+            return [(missing[s : s + self.pages_per_task], self._call(_run_paged, *src, missing[s : s + self.pages_per_task])) for s in range(0, len(missing), self.pages_per_task)]
+
+        # ページ数がキャッシュにあれば、すぐに足りないページの抽出を投げる。無ければ先にページ数を子プロセスで数える
+        tasks = submit_missing(known) if known is not None else None
+        count = None if known is not None else self._call(_run_page_count, *src)
+
+        def result() -> str:
+            n = known
+            todo = tasks
+            if n is None:
+                n = count()
+                if self.cache:
+                    self.cache.put_count(digest, version, n)
+                todo = submit_missing(n)
+            got = dict(cached)
+            new: Dict[int, str] = {}
+            for pages, res in todo:
+                new.update(zip(pages, res()))
+            if new and self.cache:
+                self.cache.put(digest, version, new)
+            got.update(new)
+            return "\n".join(got[i] for i in range(n))
+
+        return result
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self) -> "ExtractPool":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
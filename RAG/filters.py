@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""メタデータの条件で検索対象を絞り込む（query.py / hyde_query.py / rerank_with_chat.py --filter、server.py の "filter"）。
+
+- 条件式: 空白区切りの項をすべて満たす行だけを検索する（--filter を複数指定しても AND）。
+    path=GLOB       ファイルパス（絶対パスの末尾に一致すればよい。例: path='manuals/*'）
+    type=pdf,md     拡張子（, 区切りはいずれか）
+    mtime>=2024-01-01   投入時のファイル更新時刻（ISO 形式の日付・日時か UNIX 時刻。> >= < <= が使える）
+    KEY=VALUE       ingest.py --tag KEY=VALUE で付けたタグ（VALUE は glob。, 区切りはいずれか）
+  = の代わりに != で否定。タグは > >= < <= でも比べられる（両方数値なら数値、そうでなければ文字列として）。
+- 条件はファイル単位で1回だけ評価し、メタデータの file_id から行ごとの bool マスクにする。
+  マスクは検索器の削除済み行マスクと合成して走査の中で使う（上位 k 件を取ってから捨てるのではない）。
+- 作ったマスクはプロセス内（server.py では以降のリクエスト）と、ディスクにビット列で保存して使い回す。
+  インデックスの版（common.index_version）が変わると別のキーになる。
+- 条件に合う行が少ないときは、近似検索の代わりにその行だけを全件走査する（速く、取りこぼしもない）。
+
+環境変数:
+  RAG_FILTER_CACHE      マスクの保存先ディレクトリ（"off" で無効化。既定: ./RAG/cache/filters）
+  RAG_FILTER_CACHE_MAX  保存するマスクの最大個数（既定: 256）
+
+使い方（条件に合う行数の確認）:
+  python RAG/filters.py --filter "type=pdf product=alpha"
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from common import ExactSearcher, MetaStore, index_version, is_shard_set, open_meta, pretty, read_vec_header, search_batch, sidecar_path
+
+DEFAULT_CACHE_DIR = "./RAG/cache/filters"
+DEFAULT_CACHE_MAX = 256
+# 条件に合う行がこれ以下なら、近似検索をやめてその行だけを全件走査する
+FILTER_EXACT_ROWS = 4096
+RESERVED_KEYS = ("path", "type", "mtime")
+
+_TERM = re.compile(r"^([A-Za-z_][\w.-]*)\s*(!=|>=|<=|=|>|<)(.*)$")
+_MEMORY: "OrderedDict[Tuple[str, str, str], Any]" = OrderedDict()
+_MEMORY_MAX = 32
+_lock = threading.Lock()
+
+Clause = Tuple[str, str, str]
+
+
+def parse_filters(exprs: Optional[Sequence[str]]) -> List[Clause]:
+    """条件式（のリスト）を (キー, 演算子, 値) の並びにする。順序と重複は正規化する"""
+    clauses = set()
+    for expr in exprs or ():
+        for term in shlex.split(expr):
+            m = _TERM.match(term)
+            if not m:
+                raise ValueError(f"絞り込み条件の形式が不正です: {term!r}（例: path=docs/* type=pdf mtime>=2024-01-01 product=alpha）")
+            key, op, value = m.group(1), m.group(2), m.group(3).strip()
+            if key in ("path", "type") and op not in ("=", "!="):
+                raise ValueError(f"{key} には = か != を使ってください: {term!r}")
+            if key == "mtime":
+                if op in ("=", "!="):
+                    raise ValueError(f"mtime には > >= < <= を使ってください: {term!r}")
+                _timestamp(value)
+            clauses.add((key, op, value))
+    return sorted(clauses)
+
+
+def _timestamp(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"mtime の値は ISO 形式の日付・日時か UNIX 時刻にしてください: {value!r}")
+
+
+def _compare(a: Any, op: str, b: str) -> bool:
+    try:
+        x, y = float(a), float(b)
+    except (TypeError, ValueError):
+        x, y = str(a), b
+    return {">": x > y, ">=": x >= y, "<": x < y, "<=": x <= y}[op]
+
+
+def _match_any(value: str, patterns: str, fold: bool = False) -> bool:
+    if fold:
+        value, patterns = value.lower(), patterns.lower()
+    return any(fnmatch.fnmatchcase(value, p.strip()) for p in patterns.split(",") if p.strip())
+
+
+def match_file(path: str, entry: Dict, clauses: Sequence[Clause]) -> bool:
+    """ファイル1つ（パスとマニフェストの files エントリ）が条件をすべて満たすか"""
+    posix = Path(path).as_posix()
+    for key, op, value in clauses:
+        if key == "path":
+            ok = _match_any(posix, value) or _match_any(posix, ",".join("*/" + p.strip() for p in value.split(",")))
+        elif key == "type":
+            ok = _match_any(Path(path).suffix.lstrip("."), value, fold=True)
+        elif key == "mtime":
+            ok = entry.get("mtime") is not None and _compare(entry["mtime"], op, str(_timestamp(value)))
+        else:
+            tags = entry.get("tags") or {}
+            if key not in tags:
+                ok = False
+            elif op in ("=", "!="):
+                ok = _match_any(str(tags[key]), value)
+            else:
+                ok = _compare(tags[key], op, value)
+        # != は一致しないこと、それ以外は一致すること（タグが無いファイルは = では外れ、!= では残る）
+        if ok == (op == "!="):
+            return False
+    return True
+
+
+def _file_ids(meta_items) -> Tuple[List[str], Any]:
+    """(ファイルの一覧, 行ごとの file_id)。meta.idx はそのまま、旧形式の meta.jsonl はここで振る"""
+    import numpy as np
+
+    if isinstance(meta_items, MetaStore):
+        return meta_items.files, np.asarray(meta_items.records["file_id"])
+    files: List[str] = []
+    ids: Dict[str, int] = {}
+    rows = []
+    for it in meta_items:
+        f = it.get("file")
+        if f not in ids:
+            ids[f] = len(files)
+            files.append(f)
+        rows.append(ids[f])
+    return files, np.asarray(rows, dtype=np.int64)
+
+
+def build_mask(index_path: Path, meta_items, clauses: Sequence[Clause], rows: int):
+    """条件を満たす行を True にした bool マスク（長さ rows）を作る"""
+    import numpy as np
+
+    manifest = sidecar_path(index_path, ".manifest.json")
+    entries = (json.loads(manifest.read_text(encoding="utf-8")).get("files") or {}) if manifest.exists() else {}
+    files, file_ids = _file_ids(meta_items)
+    ok = np.asarray([match_file(f, entries.get(f) or {}, clauses) for f in files], dtype=bool)
+    mask = np.zeros(rows, dtype=bool)
+    n = min(rows, len(file_ids))
+    if n and len(ok):
+        mask[:n] = ok[file_ids[:n]]
+    return mask
+
+
+def _cache_dir() -> Optional[Path]:
+    path = os.getenv("RAG_FILTER_CACHE", DEFAULT_CACHE_DIR)
+    if path.strip().lower() in ("", "0", "off", "none", "false"):
+        return None
+    return Path(path)
+
+
+def _load_cached(path: Path, rows: int):
+    import numpy as np
+
+    try:
+        bits = np.load(path)
+    except (OSError, ValueError):
+        return None
+    if len(bits) != (rows + 7) // 8:
+        return None
+    os.utime(path)
+    return np.unpackbits(bits, count=rows).astype(bool)
+
+
+def _save_cached(d: Path, path: Path, mask) -> None:
+    import numpy as np
+
+    d.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with tmp.open("wb") as f:
+        np.save(f, np.packbits(mask))
+    os.replace(tmp, path)
+    limit = int(os.getenv("RAG_FILTER_CACHE_MAX", DEFAULT_CACHE_MAX))
+    saved = sorted(d.glob("*.npy"), key=lambda p: p.stat().st_mtime)
+    for old in saved[: max(0, len(saved) - limit)]:
+        old.unlink(missing_ok=True)
+
+
+def filter_mask(index_path: Path, meta_path: Path, filters: Optional[Sequence[str]], rows: int, meta_items=None):
+    """条件式に合う行の bool マスク（長さ rows）。条件が無ければ None。
+
+    (インデックス, 版, 条件) ごとにプロセス内とディスクにキャッシュする。
+    """
+    clauses = parse_filters(filters)
+    if not clauses:
+        return None
+    key = (str(index_path), index_version(index_path, meta_path), json.dumps(clauses, ensure_ascii=False))
+    with _lock:
+        if key in _MEMORY and len(_MEMORY[key]) == rows:
+            _MEMORY.move_to_end(key)
+            return _MEMORY[key]
+    d = _cache_dir()
+    path = d / (hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:24] + ".npy") if d is not None else None
+    mask = _load_cached(path, rows) if path is not None and path.exists() else None
+    if mask is None:
+        mask = build_mask(index_path, open_meta(meta_path) if meta_items is None else meta_items, clauses, rows)
+        if path is not None:
+            _save_cached(d, path, mask)
+    mask.flags.writeable = False
+    with _lock:
+        _MEMORY[key] = mask
+        while len(_MEMORY) > _MEMORY_MAX:
+            _MEMORY.popitem(last=False)
+    return mask
+
+
+def and_masks(a, b):
+    """マスクの AND（どちらかが None ならもう一方）"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a & b
+
+
+class SubsetSearcher:
+    """選んだ行だけを全件走査する検索器（条件に合う行が少ないとき、近似検索の代わりに使う）"""
+
+    def __init__(self, vectors, rows) -> None:
+        self.vectors = vectors
+        self.rows = rows
+
+    def search_batch(self, queries, k: int) -> List[List[Tuple[int, float]]]:
+        import numpy as np
+
+        if not len(self.rows):
+            return [[] for _ in range(len(queries))]
+        # rows は昇順なので、memmap からは前から順に読むことになる
+        ids, scores = search_batch(queries, self.vectors[self.rows], k)
+        return [[(int(self.rows[i]), float(v)) for i, v in zip(ri, rv) if np.isfinite(v)] for ri, rv in zip(ids, scores)]
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        return self.search_batch(np.asarray(query_vec, dtype="float32").reshape(1, -1), k)[0]
+
+
+def filtered_searcher(searcher: Any, index_path: Path, meta_path: Path, filters: Optional[Sequence[str]], meta_items=None) -> Any:
+    """searcher を条件に合う行だけ検索する検索器にして返す（元の searcher は変えない。条件が無ければそのまま）
+
+    シャード分割したインデックスでは、各シャードの検索プロセスがそれぞれ自分のマスクを作る。
+    """
+    import numpy as np
+
+    if not parse_filters(filters):
+        return searcher
+    if is_shard_set(index_path):
+        return searcher.with_filters(list(filters))
+    vectors = searcher.vectors
+    mask = and_masks(getattr(searcher, "mask", None), filter_mask(index_path, meta_path, filters, len(vectors), meta_items))
+    selected = int(mask.sum())
+    if selected <= FILTER_EXACT_ROWS and not isinstance(searcher, ExactSearcher):
+        return SubsetSearcher(vectors, np.flatnonzero(mask))
+    # 各バックエンドはマスクを走査の中で使う（IVF は k 件たまるまでリストを開き足し、HNSW は除外点も経由して辿る）
+    out = copy.copy(searcher)
+    out.mask = mask
+    return out
+
+
+def add_filter_args(p: Any) -> None:
+    p.add_argument("--filter", action="append", metavar="EXPR", help="検索対象を絞り込む条件（例: \"type=pdf path='manuals/*' product=alpha\"。複数指定は AND）")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: count rows matching a metadata filter")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    add_filter_args(p)
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    clauses = parse_filters(args.filter)
+    if is_shard_set(index_path):
+        from shards import read_shard_set
+
+        parts = [(vec, meta) for vec, meta in read_shard_set(index_path) if vec.exists()]
+    else:
+        parts = [(index_path, Path(args.meta).resolve())]
+    total = matched = 0
+    for vec, meta in parts:
+        rows = int(read_vec_header(vec)["rows"])
+        mask = filter_mask(vec, meta, args.filter, rows)
+        total += rows
+        matched += rows if mask is None else int(mask.sum())
+    print(pretty({"filter": [list(c) for c in clauses], "rows": total, "matched": matched}))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
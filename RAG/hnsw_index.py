@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""HNSW（階層型ナビゲーブル・スモールワールド）グラフによる近似最近傍検索（NumPy のみ）。
+
+- ノード番号 = index.vec の行番号。ベクトル本体は index.vec（memmap）をそのまま使う。
+- 保存: index.hnsw.npz（パラメータ・各ノードの層・上位層の隣接リスト）
+        index.hnsw.l0.npy（第0層の隣接表 (rows, 2M) int32。検索時は memmap で開く）
+- 追加入力: 既存グラフに含まれない末尾の行だけを挿入する（作り直し不要）。
+  ingest.py --update-hnsw か、このスクリプトを再実行すれば差分だけ挿入される。
+
+使い方:
+  python RAG/hnsw_index.py --index RAG/index/index.vec --eval 200
+"""
+from __future__ import annotations
+
+import argparse
+import heapq
+import math
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from common import eval_recall, load_live_mask, load_vectors, normalize_rows, pretty, read_vec_header, sidecar_path
+
+HNSW_VERSION = 1
+
+
+class HNSW:
+    def __init__(self, vectors, M: int = 16, ef_construction: int = 100, seed: int = 0) -> None:
+        import numpy as np
+
+        self.vectors = vectors
+        self.M = int(M)
+        self.M0 = 2 * self.M
+        self.ef_construction = int(ef_construction)
+        self.ml = 1.0 / math.log(max(2, self.M))
+        self.rng = np.random.default_rng(seed)
+        self.rows = 0
+        self.levels = np.zeros(0, dtype=np.int8)
+        self.l0 = np.full((0, self.M0), -1, dtype=np.int32)
+        self.upper: List[Dict[int, "object"]] = []  # upper[l-1][node] -> 隣接ノード配列
+        self.entry = -1
+        self.max_level = -1
+        self.source_uid: Optional[str] = None
+
+    # --- 内部ユーティリティ ---
+
+    def _vecs(self, ids):
+        import numpy as np
+
+        return np.asarray(self.vectors[ids], dtype="float32")
+
+    def _neighbors(self, node: int, level: int):
+        import numpy as np
+
+        if level == 0:
+            row = self.l0[node]
+            return row[row >= 0]
+        return self.upper[level - 1].get(node, np.zeros(0, dtype=np.int32))
+
+    def _set_neighbors(self, node: int, level: int, nbrs) -> None:
+        import numpy as np
+
+        nbrs = np.asarray(nbrs, dtype=np.int32)
+        if level == 0:
+            self.l0[node, :] = -1
+            self.l0[node, : len(nbrs)] = nbrs
+        else:
+            self.upper[level - 1][node] = nbrs
+
+    def _search_layer(self, q, entry_points: List[int], ef: int, level: int, mask=None) -> List[Tuple[float, int]]:
+        """貪欲探索。(類似度, ノード) を類似度の高い順に最大 ef 件返す
+
+        mask を渡すと、除外された点も経由して辿るが結果には mask の立った点だけを入れる
+        （条件に合う点が質問から遠くても、結果が ef 件埋まるまで探索を続ける）。
+        """
+        visited = set(entry_points)
+        sims = self._vecs(entry_points) @ q
+        cands = [(-float(s), int(n)) for s, n in zip(sims, entry_points)]
+        heapq.heapify(cands)
+        results = [(float(s), int(n)) for s, n in zip(sims, entry_points) if mask is None or mask[n]]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while cands:
+            neg, c = heapq.heappop(cands)
+            if len(results) >= ef and -neg < results[0][0]:
+                break
+            nbrs = [n for n in self._neighbors(c, level).tolist() if n not in visited]
+            if not nbrs:
+                continue
+            visited.update(nbrs)
+            for s, n in zip((self._vecs(nbrs) @ q).tolist(), nbrs):
+                if len(results) < ef or s > results[0][0]:
+                    heapq.heappush(cands, (-s, n))
+                    if mask is None or mask[n]:
+                        heapq.heappush(results, (s, n))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _select(self, cands: List[Tuple[float, int]], m: int) -> List[int]:
+        """近傍選択ヒューリスティック: 既に選んだ点より質問に近い候補だけを採り、足りなければ類似度順に補う"""
+        import numpy as np
+
+        if len(cands) <= m:
+            return [n for _, n in cands]
+        ids = [n for _, n in cands]
+        vecs = self._vecs(ids)
+        chosen: List[int] = []
+        skipped: List[int] = []
+        for i, (s, _) in enumerate(cands):
+            if len(chosen) >= m:
+                break
+            if chosen and float(np.max(vecs[chosen] @ vecs[i])) > s:
+                skipped.append(i)
+                continue
+            chosen.append(i)
+        chosen += skipped[: m - len(chosen)]
+        return [ids[i] for i in chosen]
+
+    def _ensure_capacity(self, rows: int) -> None:
+        import numpy as np
+
+        if rows <= len(self.l0):
+            return
+        cap = max(rows, int(len(self.l0) * 1.5) + 1024)
+        grown = np.full((cap, self.M0), -1, dtype=np.int32)
+        grown[: self.rows] = self.l0[: self.rows]
+        self.l0 = grown
+        lv = np.zeros(cap, dtype=np.int8)
+        lv[: self.rows] = self.levels[: self.rows]
+        self.levels = lv
+
+    # --- 挿入・検索 ---
+
+    def insert(self, node: int) -> None:
+        self._ensure_capacity(node + 1)
+        level = int(-math.log(1.0 - self.rng.random()) * self.ml)
+        self.levels[node] = level
+        self.rows = max(self.rows, node + 1)
+        while len(self.upper) < level:
+            self.upper.append({})
+        if self.entry < 0:
+            self.entry, self.max_level = node, level
+            return
+
+        q = normalize_rows(self._vecs(node))
+        ep = [self.entry]
+        for lv in range(self.max_level, level, -1):
+            ep = [self._search_layer(q, ep, 1, lv)[0][1]]
+        for lv in range(min(level, self.max_level), -1, -1):
+            w = self._search_layer(q, ep, self.ef_construction, lv)
+            m_max = self.M0 if lv == 0 else self.M
+            nbrs = self._select(w, self.M)
+            self._set_neighbors(node, lv, nbrs)
+            for n in nbrs:
+                cur = self._neighbors(n, lv).tolist()
+                cur.append(node)
+                if len(cur) > m_max:
+                    # 上限を超えたら n から見た近傍として選び直す
+                    s = self._vecs(cur) @ self._vecs(n)
+                    cur = self._select(sorted(zip(s.tolist(), cur), reverse=True), m_max)
+                self._set_neighbors(n, lv, cur)
+            ep = [n for _, n in w]
+        if level > self.max_level:
+            self.entry, self.max_level = node, level
+
+    def add_rows(self, start: int, end: int, progress: bool = False) -> None:
+        t0 = time.perf_counter()
+        for i in range(start, end):
+            self.insert(i)
+            if progress and (i + 1 - start) % 10000 == 0:
+                print(f"  hnsw: {i + 1 - start}/{end - start} inserted ({time.perf_counter() - t0:.0f}s)")
+
+    def search(self, q, k: int, ef: int = 64, mask=None) -> List[Tuple[float, int]]:
+        """(類似度, ノード) を最大 max(ef, k) 件返す。mask があれば最下層の探索の中で除外する"""
+        if self.entry < 0:
+            return []
+        q = normalize_rows(q)
+        ep = [self.entry]
+        for lv in range(self.max_level, 0, -1):
+            ep = [self._search_layer(q, ep, 1, lv)[0][1]]
+        if mask is not None:
+            mask = mask[: self.rows]
+        return self._search_layer(q, ep, max(ef, k), 0, mask)
+
+    # --- 保存・読み込み ---
+
+    def save(self, index_path: Path) -> None:
+        import numpy as np
+
+        upper: Dict[str, "object"] = {}
+        for li, layer in enumerate(self.upper, start=1):
+            nodes = np.array(sorted(layer), dtype=np.int32)
+            lens = np.array([len(layer[n]) for n in nodes], dtype=np.int64)
+            offs = np.zeros(len(nodes) + 1, dtype=np.int64)
+            np.cumsum(lens, out=offs[1:])
+            flat = np.concatenate([layer[n] for n in nodes]) if len(nodes) else np.zeros(0, dtype=np.int32)
+            upper[f"l{li}_nodes"] = nodes
+            upper[f"l{li}_offsets"] = offs
+            upper[f"l{li}_nbrs"] = flat.astype(np.int32)
+        np.save(sidecar_path(index_path, ".hnsw.l0.npy"), self.l0[: self.rows])
+        np.savez(
+            sidecar_path(index_path, ".hnsw.npz"),
+            version=HNSW_VERSION,
+            rows=self.rows,
+            M=self.M,
+            ef_construction=self.ef_construction,
+            entry=self.entry,
+            max_level=self.max_level,
+            n_upper=len(self.upper),
+            levels=self.levels[: self.rows],
+            source_uid=np.array(self.source_uid or ""),
+            **upper,
+        )
+
+    @classmethod
+    def load(cls, index_path: Path, vectors, writable: bool = False) -> "HNSW":
+        """グラフを読み込む。writable=False なら第0層は memmap（読み取り専用）のまま使う"""
+        import numpy as np
+
+        meta_path = sidecar_path(index_path, ".hnsw.npz")
+        if not meta_path.exists():
+            raise FileNotFoundError(f"HNSW インデックスが見つかりません: {meta_path}（hnsw_index.py か ingest.py --update-hnsw で作成）")
+        data = np.load(meta_path)
+        if int(data["version"]) > HNSW_VERSION:
+            raise ValueError(f"未対応の HNSW 版です: {int(data['version'])}")
+        g = cls(vectors, M=int(data["M"]), ef_construction=int(data["ef_construction"]))
+        g.rows = int(data["rows"])
+        g.entry = int(data["entry"])
+        g.max_level = int(data["max_level"])
+        g.levels = np.array(data["levels"])
+        g.source_uid = str(data["source_uid"]) or None
+        l0 = np.load(sidecar_path(index_path, ".hnsw.l0.npy"), mmap_mode=None if writable else "r")
+        g.l0 = np.array(l0) if writable else l0
+        for li in range(1, int(data["n_upper"]) + 1):
+            nodes, offs, flat = data[f"l{li}_nodes"], data[f"l{li}_offsets"], data[f"l{li}_nbrs"]
+            g.upper.append({int(n): flat[offs[j] : offs[j + 1]] for j, n in enumerate(nodes)})
+        return g
+
+
+def _vec_uid(index_path: Path) -> Optional[str]:
+    try:
+        return read_vec_header(index_path).get("uid")
+    except Exception:
+        return None
+
+
+def update_hnsw(index_path: Path, M: int = 16, ef_construction: int = 100, rebuild: bool = False, progress: bool = True) -> Tuple[int, int]:
+    """グラフに未登録の行を挿入して保存する。index.vec が作り直されていれば最初から構築。
+
+    戻り値: (挿入した行数, グラフの総行数)
+    """
+    index_path = Path(index_path)
+    vectors = load_vectors(index_path)
+    uid = _vec_uid(index_path)
+    g: Optional[HNSW] = None
+    if not rebuild and sidecar_path(index_path, ".hnsw.npz").exists():
+        g = HNSW.load(index_path, vectors, writable=True)
+        if g.source_uid != uid or g.rows > len(vectors):
+            g = None
+    if g is None:
+        g = HNSW(vectors, M=M, ef_construction=ef_construction)
+    g.source_uid = uid
+    start = g.rows
+    g.add_rows(start, len(vectors), progress=progress)
+    g.save(index_path)
+    return len(vectors) - start, g.rows
+
+
+class HNSWSearcher:
+    """top_k_similar と同じ (行番号, スコア) のリストを返す HNSW 検索器"""
+
+    def __init__(self, index_path: Path, vectors, mask=None, ef: int = 64) -> None:
+        self.graph = HNSW.load(index_path, vectors)
+        if self.graph.source_uid and self.graph.source_uid != _vec_uid(index_path):
+            raise RuntimeError("HNSW グラフが現在の index.vec と一致しません。hnsw_index.py --rebuild で作り直してください。")
+        self.vectors = vectors
+        self.mask = mask
+        self.ef = max(1, int(ef))
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        q = normalize_rows(np.asarray(query_vec).reshape(-1))
+        found = self.graph.search(q, k, ef=self.ef, mask=self.mask)
+        out = [(n, s) for s, n in found]
+        # グラフ構築後に追記された行は全件走査で補う（除外する行は上位 k を取る前に落とす）
+        g_rows = self.graph.rows
+        if len(self.vectors) > g_rows:
+            tail = np.asarray(self.vectors[g_rows:], dtype="float32") @ q
+            if self.mask is not None:
+                tail = np.where(self.mask[g_rows : len(self.vectors)], tail, -np.inf)
+            for i in np.argsort(-tail)[:k]:
+                if np.isfinite(tail[i]):
+                    out.append((g_rows + int(i), float(tail[i])))
+        out.sort(key=lambda x: -x[1])
+        return [(int(n), float(s)) for n, s in out[:k]]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: build / extend HNSW graph index for approximate search")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--M", type=int, default=16, help="各層の最大近傍数（第0層は 2M）")
+    p.add_argument("--ef-construction", type=int, default=100)
+    p.add_argument("--rebuild", action="store_true", help="差分挿入ではなく最初から構築する")
+    p.add_argument("--eval", type=int, default=0, help="構築後に N 件の質問で recall@k を測る")
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--ef", type=int, default=64, help="検索時の候補幅")
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    t0 = time.perf_counter()
+    added, rows = update_hnsw(index_path, M=args.M, ef_construction=args.ef_construction, rebuild=args.rebuild)
+    print(f"saved hnsw: {sidecar_path(index_path, '.hnsw.npz')} (+{added} rows, total {rows}, {time.perf_counter() - t0:.1f}s)")
+    if args.eval:
+        vectors = load_vectors(index_path)
+        mask = load_live_mask(index_path, len(vectors))
+        searcher = HNSWSearcher(index_path, vectors, mask=mask, ef=args.ef)
+        print(pretty(dict(eval_recall(searcher, vectors, mask, n_queries=args.eval, k=args.k), ef=args.ef)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
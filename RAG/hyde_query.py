@@ -1,45 +1,88 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""HyDE（仮想文書）による検索の強化。
+
+- 1回の Chat リクエストで仮想文書を --hypotheses 件（n 個の候補）生成し、その間に元の質問の埋め込みを並行して取る。
+- 仮想文書はまとめて1回で埋め込み、元の質問と合わせた全ベクトルを1回の検索（全件走査なら行列積1回）で引く。
+- 質問ごとの順位を RRF で融合する（元の質問の検索結果も捨てずに混ぜる）。直列の往復は Chat 1回 + 埋め込み1回のまま。
+"""
 from __future__ import annotations
 
 import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import add_search_args, batch_search, client, embed_texts, open_index, open_meta, pretty, query_dimensions, resolve_meta_path, rrf_fuse, search_opts
+from filters import add_filter_args, filtered_searcher
+
 
-from common import client, embed_texts, pretty, top_k_similar
+HYDE_SYSTEM = (
+    "あなたは検索支援のための要約者です。以下の質問に対する理想的な短い要約文だけを日本語で出力してください。"
+    "箇条書きや前置きは不要です。"
+)
+
+
+def _hyde_payload(args, question: str, n: int = 1) -> Dict:
+    messages = [
+        {"role": "system", "content": HYDE_SYSTEM},
+        {"role": "user", "content": question},
+    ]
+    payload = {"model": args.chat_model, "messages": messages, "max_tokens": 256}
+    if n > 1:
+        payload["n"] = n
+    if not args.no_temperature:
+        payload["temperature"] = args.temperature
+    return payload
 
 
-def _load_meta(meta_path: Path):
-    import json
+def _hyde_documents(c, payload: Dict) -> List[str]:
+    """仮想文書を生成する（n 個の候補を1回のリクエストで受け取る）"""
+    try:
+        resp = c.chat.completions.create(**payload)
+    except Exception as e:
+        if "temperature" in payload and "temperature" in str(e).lower():
+            payload.pop("temperature", None)
+            resp = c.chat.completions.create(**payload)
+        else:
+            raise
+    docs = [(ch.message.content or "").strip() for ch in resp.choices]
+    # 温度なしなどで同じ文書が返ることがあるので、重複と空を除く
+    return [d for d in dict.fromkeys(docs) if d]
 
-    items = []
-    if not meta_path.exists():
-        return items
-    with meta_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                items.append(json.loads(line))
-            except Exception:
-                pass
-    return items
 
+def hyde_retrieve(args, searcher: Any, question: str, k: int, n: int, rrf_k: int = 60, c: Any = None, dimensions: Optional[int] = None) -> Tuple[List[Tuple[int, float]], List[str]]:
+    """(融合した上位 k 件, 生成した仮想文書) を返す。
 
-def _load_vectors(npz_path: Path):
+    仮想文書の生成と元の質問の埋め込みは並行に行い、仮想文書は1回でまとめて埋め込む。
+    生成に失敗した・空だった場合は元の質問だけで検索する。
+    """
     import numpy as np
-    if not npz_path.exists():
-        raise FileNotFoundError(f"ベクトルが見つかりません: {npz_path}")
-    data = np.load(npz_path)
-    return data["vectors"]
+
+    c = c or client()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        q_future = pool.submit(embed_texts, [question], model=args.emb_model, dry_run=False, dimensions=dimensions)
+        try:
+            hypos = _hyde_documents(c, _hyde_payload(args, question, n))
+        except Exception as e:
+            print(f"[hyde] 仮想文書の生成に失敗したため、質問だけで検索します: {e}", file=sys.stderr)
+            hypos = []
+        q_vecs = q_future.result()
+    if hypos:
+        q_vecs = np.concatenate([q_vecs, embed_texts(hypos, model=args.emb_model, dry_run=False, dimensions=dimensions)])
+    # 融合で下位が入れ替わるので、各質問は k より深く取る
+    rankings = batch_search(searcher, q_vecs, max(k * 5, 20) if len(q_vecs) > 1 else k)
+    if len(rankings) == 1:
+        return rankings[0][:k], hypos
+    return rrf_fuse(rankings, k, rrf_k=rrf_k), hypos
 
 
 def main(argv: Optional[List[str]] = None) -> int:
     p = argparse.ArgumentParser(description="RAG: HyDE query (generate hypothetical doc -> retrieve)")
     p.add_argument("--question", required=True)
-    p.add_argument("--index", default="./RAG/index/index.npz")
-    p.add_argument("--meta", default="./RAG/index/meta.jsonl")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
     p.add_argument("--k", type=int, default=4)
     p.add_argument("--emb-model", default="text-embedding-3-small")
     p.add_argument("--chat-model", default="gpt-5")
@@ -49,55 +92,35 @@ def main(argv: Optional[List[str]] = None) -> int:
     p.add_argument("--max-tokens", type=int, default=512)
     p.add_argument("--temperature", type=float, default=0.2)
     p.add_argument("--no-temperature", action="store_true")
+    p.add_argument("--hypotheses", type=int, default=3, help="1回の生成で作る仮想文書の数（元の質問と合わせて RRF で融合）")
+    p.add_argument("--rrf-k", type=int, default=60, help="RRF の定数（大きいほど下位の順位も効く）")
+    add_search_args(p)
+    add_filter_args(p)
     p.add_argument("--dry-run", action="store_true")
     args = p.parse_args(argv)
 
     index_path = Path(args.index).resolve()
-    meta_path = Path(args.meta).resolve()
-
-    # 1) HyDE: 質問から仮想文書を生成
-    system_prompt = (
-        "あなたは検索支援のための要約者です。以下の質問に対する理想的な短い要約文だけを日本語で出力してください。"
-        "箇条書きや前置きは不要です。"
-    )
-    hyde_messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": args.question},
-    ]
-    hyde_payload = {"model": args.chat_model, "messages": hyde_messages, "max_tokens": 256}
-    if not args.no_temperature:
-        hyde_payload["temperature"] = args.temperature
+    meta_path = resolve_meta_path(index_path, args.meta)
+    dimensions = query_dimensions(p, index_path, args.emb_model)
 
     if args.dry_run:
         print("[DRY-RUN] HyDE chat payload:")
-        print(pretty(hyde_payload))
-        print("[DRY-RUN] Retrieval would embed the hypothetical doc and search top-k.")
+        print(pretty(_hyde_payload(args, args.question, args.hypotheses)))
+        print(f"[DRY-RUN] Retrieval would embed the question (in parallel) and {args.hypotheses} hypothetical docs (one batch), search them together and fuse top-k with RRF.")
         return 0
 
+    # 1) HyDE: 仮想文書の生成と質問の埋め込みを並行に行い、全ベクトルをまとめて検索して融合
     c = client()
-    try:
-        hyde_resp = c.chat.completions.create(**hyde_payload)
-    except Exception as e:
-        if "temperature" in hyde_payload and "temperature" in str(e).lower():
-            hyde_payload.pop("temperature", None)
-            hyde_resp = c.chat.completions.create(**hyde_payload)
-        else:
-            raise
-    hypo = (hyde_resp.choices[0].message.content or "").strip()
-    if not hypo:
-        hypo = args.question
-
-    # 2) 仮想文書の埋め込みで検索
-    vectors = _load_vectors(index_path)
-    meta_items = _load_meta(meta_path)
-    q_vec = embed_texts([hypo], model=args.emb_model, dry_run=False)[0]
-    top = top_k_similar(q_vec, vectors, args.k)
+    meta_items = open_meta(meta_path)
+    searcher, _ = open_index(index_path, args.backend, **search_opts(args))
+    searcher = filtered_searcher(searcher, index_path, meta_path, args.filter, meta_items)
+    top, _ = hyde_retrieve(args, searcher, args.question, args.k, args.hypotheses, rrf_k=args.rrf_k, c=c, dimensions=dimensions)
     contexts: List[str] = []
     for i, score in top:
         if 0 <= i < len(meta_items):
             contexts.append(meta_items[i].get("text", ""))
 
-    # 3) 回答
+    # 2) 回答
     messages = [
         {"role": "system", "content": args.system},
         {
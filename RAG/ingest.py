@@ -3,85 +3,506 @@
 from __future__ import annotations
 
 import argparse
+import fnmatch
+import hashlib
 import json
+import os
+import queue
+import re
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from common import chunk_text, embed_texts, pretty
+from common import (
+    EMBED_BATCH_ITEMS,
+    EMBED_BATCH_TOKENS,
+    EMBED_WORKERS,
+    MetaWriter,
+    VectorWriter,
+    chunk_text,
+    is_meta_store,
+    iter_embedding_batches,
+    meta_rows,
+    plan_batches,
+    pretty,
+    read_vec_header,
+    sidecar_path,
+)
+from dedup import DEDUP_DISTANCE, SignatureWriter, SimHashIndex, read_signatures, simhash
+from extractors import ExtractPool, default_page_cache, supported_suffixes
+from shards import shard_of, shard_paths, write_shard_set
 
+MANIFEST_VERSION = 1
+SEGMENT_ITEMS = 4096
+DEFAULT_PATTERN = "**/*.md,**/*.txt,**/*.html,**/*.htm,**/*.pdf"
 
-def _read_text(path: Path) -> str:
-    return path.read_text(encoding="utf-8", errors="ignore")
 
-
-def _gather_chunks(input_dir: Path, patterns: List[str], chunk_size: int, chunk_overlap: int) -> List[Dict]:
-    items: List[Dict] = []
+def _match_any(rel: str, patterns: List[str]) -> bool:
     for pat in patterns:
-        for p in input_dir.rglob(pat):
-            if not p.is_file():
-                continue
-            text = _read_text(p)
-            chunks = chunk_text(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-            for i, ch in enumerate(chunks):
-                items.append({
-                    "file": str(p.resolve()),
-                    "chunk_index": i,
-                    "text": ch,
-                })
-    return items
+        # "**/*.md" は直下のファイルにも一致させる（rglob と同じ挙動）
+        if fnmatch.fnmatch(rel, pat) or (pat.startswith("**/") and fnmatch.fnmatch(rel, pat[3:])):
+            return True
+    return False
+
+
+def _iter_files(input_dir: Path, patterns: List[str], shard: Optional[Tuple[int, int]] = None) -> Iterator[Path]:
+    """ディレクトリを1回だけ走査し、いずれかのパターンに一致するファイルを重複なく順に返す（shard=(i, n) ならシャード i の分だけ）"""
+    for root, dirs, names in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(names):
+            p = Path(root) / name
+            rel = p.relative_to(input_dir).as_posix()
+            if _match_any(rel, patterns) and (shard is None or shard_of(rel, shard[1]) == shard[0]) and p.is_file():
+                yield p
+
+
+def _chunk_items(path: Path, text: str, chunk_size: int, chunk_overlap: int) -> List[Dict]:
+    chunks = chunk_text(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [{"file": str(path.resolve()), "chunk_index": i, "text": ch} for i, ch in enumerate(chunks)]
+
+
+def _parse_tags(specs: List[str]) -> Dict[str, str]:
+    """--tag KEY=VALUE の並びを dict にする（キーは filters.py の条件式で使える名前に限る）"""
+    from filters import RESERVED_KEYS
+
+    tags: Dict[str, str] = {}
+    for spec in specs:
+        key, sep, value = spec.partition("=")
+        key = key.strip()
+        if not sep or not re.fullmatch(r"[A-Za-z_][\w.-]*", key) or key in RESERVED_KEYS:
+            raise ValueError(f"--tag は KEY=VALUE の形で、KEY は英数字・_ . - と {', '.join(RESERVED_KEYS)} 以外にしてください: {spec!r}")
+        tags[key] = value.strip()
+    return tags
+
+
+def _load_manifest(path: Path) -> Dict:
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _save_manifest(path: Path, manifest: Dict) -> None:
+    # 途中で落ちても壊れたマニフェストが残らないよう、一時ファイル経由で置き換える
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _manifest_usable(manifest: Dict, settings: Dict, out_vec: Path, meta_path: Path) -> bool:
+    """既存のマニフェスト/インデックスに追記してよいか（設定一致・行数整合）。
+
+    中断した投入ではマニフェスト確定後の行がベクトル/メタに残っていることがあるが、
+    その分は追記時に捨てる（keep_rows）ので、マニフェストの行数以上あれば再開できる。
+    """
+    if manifest.get("version") != MANIFEST_VERSION:
+        return False
+    if any(manifest.get(k) != v for k, v in settings.items()):
+        return False
+    if not out_vec.exists() or not is_meta_store(meta_path):
+        return False
+    try:
+        rows = int(read_vec_header(out_vec)["rows"])
+    except Exception:
+        return False
+    n = manifest.get("rows")
+    return isinstance(n, int) and rows >= n and meta_rows(meta_path) >= n
+
+
+def _in_scope(key: str, input_dir: Path, patterns: List[str], shard: Optional[Tuple[int, int]] = None) -> bool:
+    """今回の実行で走査対象になるファイルか（対象外のファイルは削除扱いにしない）"""
+    try:
+        rel = Path(key).relative_to(input_dir).as_posix()
+    except ValueError:
+        return False
+    return _match_any(rel, patterns) and (shard is None or shard_of(rel, shard[1]) == shard[0])
+
+
+def _scan(files: Iterable[Path], old_files: Dict, chunk_size: int, chunk_overlap: int, pool: ExtractPool) -> Iterator[Tuple[str, Dict, Optional[List[Dict]]]]:
+    """ファイルを順に読み、(キー, files エントリ, チャンク) を返す。未変更ファイルのチャンクは None。
+
+    本文の抽出は pool に投げ、最大 2*workers ファイル分を先行させる（返す順序は入力順のまま）。
+    """
+    pending: Deque[Tuple[str, Path, Dict, Optional[Callable[[], str]]]] = deque()
+
+    def finish(key: str, p: Path, ent: Dict, text: Optional[Callable[[], str]]) -> Tuple[str, Dict, Optional[List[Dict]]]:
+        if text is None:
+            return key, ent, None
+        new_items = _chunk_items(p, text(), chunk_size, chunk_overlap)
+        return key, dict(ent, row_count=len(new_items)), new_items
+
+    for p in files:
+        key = str(p.resolve())
+        st = p.stat()
+        ent = old_files.get(key)
+        # mtime とサイズが同じなら中身を読まずに未変更とみなす
+        if ent and ent.get("mtime") == st.st_mtime and ent.get("size") == st.st_size:
+            pending.append((key, p, ent, None))
+        else:
+            data = p.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()
+            if ent and ent.get("sha256") == digest:
+                pending.append((key, p, dict(ent, mtime=st.st_mtime, size=st.st_size), None))
+            else:
+                new_ent = {"mtime": st.st_mtime, "size": st.st_size, "sha256": digest, "row_start": -1, "row_count": 0}
+                pending.append((key, p, new_ent, pool.submit(p, data, digest)))
+        while len(pending) > 2 * pool.workers:
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
 
 
-def _save_index(out_npz: Path, meta_jsonl: Path, vectors, items: List[Dict]) -> None:
-    import numpy as np
+def _segments(scan: Iterable[Tuple[str, Dict, Optional[List[Dict]]]], segment_items: int) -> Iterator[List[Tuple[str, Dict, Optional[List[Dict]]]]]:
+    """ファイル単位のまま、チャンク数がおよそ segment_items になるように区切る（チェックポイントの単位）"""
+    seg: List[Tuple[str, Dict, Optional[List[Dict]]]] = []
+    n = 0
+    for rec in scan:
+        seg.append(rec)
+        n += len(rec[2] or ())
+        if n >= segment_items:
+            yield seg
+            seg, n = [], 0
+    if seg:
+        yield seg
 
-    out_npz.parent.mkdir(parents=True, exist_ok=True)
-    meta_jsonl.parent.mkdir(parents=True, exist_ok=True)
 
-    np.savez(out_npz, vectors=vectors)
-    with meta_jsonl.open("w", encoding="utf-8") as f:
-        for it in items:
-            f.write(json.dumps(it, ensure_ascii=False) + "\n")
+def _dedup_segment(seg: List[Tuple[str, Dict, Optional[List[Dict]]]], files_out: Dict, index: SimHashIndex, start: int) -> Tuple[List[int], int]:
+    """変更ファイルのチャンクのうち、既存の行（とこのセグメントで先に残した行）と同じ・ほぼ同じものを除く。
+
+    除いたチャンクは files エントリの aliases に [chunk_index, 正規行] として記録する。
+    seg をその場で書き換え、(残したチャンクの署名, 除いた数) を返す。
+    """
+    # 変更されたファイル自身の旧行とは照合しない（直後に tombstone になる）
+    for key, _, its in seg:
+        prev = files_out.get(key)
+        if its is not None and prev and prev.get("row_start", -1) >= 0:
+            index.remove(range(prev["row_start"], prev["row_start"] + prev["row_count"]))
+    sigs: List[int] = []
+    n_dup = 0
+    for i, (key, ent, its) in enumerate(seg):
+        if its is None:
+            continue
+        kept, aliases = [], []
+        for it in its:
+            sig, n_features = simhash(it["text"])
+            row = index.find(sig, n_features)
+            if row is None:
+                index.add(start + len(sigs), sig)
+                sigs.append(sig)
+                kept.append(it)
+            else:
+                aliases.append([it["chunk_index"], row])
+        n_dup += len(aliases)
+        ent["row_count"] = len(kept)
+        if aliases:
+            ent["aliases"] = aliases
+        seg[i] = (key, ent, kept)
+    return sigs, n_dup
+
+
+def _prefetch(it: Iterable, depth: int) -> Iterator:
+    """別スレッドで it を先読みする。キューは depth 個までなので、読み込みが埋め込みより速くてもメモリは増えない"""
+    q: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+    done = object()
+    stop = threading.Event()
+
+    def run() -> None:
+        try:
+            for x in it:
+                while not stop.is_set():
+                    try:
+                        q.put((None, x), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            q.put((None, done))
+        except BaseException as e:
+            q.put((e, None))
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    try:
+        while True:
+            err, x = q.get()
+            if err is not None:
+                raise err
+            if x is done:
+                return
+            yield x
+    finally:
+        stop.set()
 
 
 def main(argv: Optional[List[str]] = None) -> int:
     p = argparse.ArgumentParser(description="RAG: ingest documents -> build simple local index")
     p.add_argument("--input-dir", default="./RAG/data", help="入力ディレクトリ")
-    p.add_argument("--pattern", default="**/*.md,**/*.txt", help="カンマ区切りのglob")
+    p.add_argument("--pattern", default=DEFAULT_PATTERN, help="カンマ区切りのglob（対応形式: " + ", ".join(supported_suffixes()) + "）")
     p.add_argument("--chunk-size", type=int, default=800)
     p.add_argument("--chunk-overlap", type=int, default=200)
     p.add_argument("--emb-model", default="text-embedding-3-small")
-    p.add_argument("--out", default="./RAG/index/index.npz")
-    p.add_argument("--meta", default="./RAG/index/meta.jsonl")
+    p.add_argument("--dimensions", type=int, default=None, help="埋め込みの次元を落とす（text-embedding-3 系のみ。0 でモデルの既定次元。省略時は既存インデックスに合わせる）。変えると全件作り直し")
+    p.add_argument("--out", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    p.add_argument("--compress-meta", action="store_true", help="メタデータの本文を zlib ブロック圧縮して保存する（新規作成・--rebuild 時に有効）")
+    p.add_argument("--dtype", choices=["float32", "float16"], default="float32", help="ベクトルの保存精度")
+    p.add_argument("--rebuild", action="store_true", help="差分を使わず全件を作り直す")
+    p.add_argument("--batch-size", type=int, default=EMBED_BATCH_ITEMS, help="埋め込み1リクエストの最大件数")
+    p.add_argument("--batch-tokens", type=int, default=EMBED_BATCH_TOKENS, help="埋め込み1リクエストの最大トークン数")
+    p.add_argument("--workers", type=int, default=EMBED_WORKERS, help="埋め込みリクエストの同時実行数")
+    p.add_argument("--extract-workers", type=int, default=0, help="PDF/HTML の抽出に使うプロセス数（0 で CPU 数、1 で並列化しない）")
+    p.add_argument("--segment-items", type=int, default=SEGMENT_ITEMS, help="チェックポイント1回あたりのチャンク数の目安（ファイル単位で区切る）")
+    p.add_argument("--prefetch", type=int, default=2, help="埋め込みと並行して先読みしておくセグメント数")
+    p.add_argument("--dedup", action="store_true", help="既存の行と同じ・ほぼ同じチャンク（SimHash）を埋め込まず、正規の行の別名として記録する")
+    p.add_argument("--dedup-distance", type=int, default=DEDUP_DISTANCE, help="--dedup で重複とみなす SimHash のハミング距離（64bit 中）")
+    p.add_argument("--build-ivf", action="store_true", help="投入後に IVF 近似検索インデックスを作り直す")
+    p.add_argument("--ivf-lists", type=int, default=0, help="IVF のリスト数（0 で 4*sqrt(行数)）")
+    p.add_argument("--update-hnsw", action="store_true", help="投入後に HNSW グラフへ新しい行を挿入する（未作成なら構築）")
+    p.add_argument("--build-pq", action="store_true", help="投入後に PQ 圧縮コードを作り直す")
+    p.add_argument("--pq-m", type=int, default=0, help="PQ の部分ベクトル数（0 で 次元/16）")
+    p.add_argument("--build-binary", action="store_true", help="投入後に1ビット符号（ハミング前段フィルタ）を作り直す")
+    p.add_argument("--build-bm25", action="store_true", help="投入後に BM25 語彙検索インデックスを作り直す")
+    p.add_argument("--tag", action="append", default=[], metavar="KEY=VALUE", help="今回走査したファイルに付けるタグ（query.py --filter KEY=VALUE で絞り込める。複数指定可。省略時は既存のタグを保つ）")
+    p.add_argument("--shards", type=int, default=0, help="インデックスを N 個のシャードに分けて投入する（index.shards.json と shard-000/ など）")
+    p.add_argument("--shard", type=int, default=-1, help="--shards 指定時にこのシャードだけ投入する（既定: 全シャードを順に）")
     p.add_argument("--dry-run", action="store_true")
     args = p.parse_args(argv)
+    try:
+        args.tags = _parse_tags(args.tag)
+    except ValueError as e:
+        p.error(str(e))
 
+    if args.shards:
+        if not -1 <= args.shard < args.shards:
+            p.error(f"--shard は 0..{args.shards - 1} で指定してください")
+        out_vec, meta_path = Path(args.out).resolve(), Path(args.meta).resolve()
+        if not args.dry_run:
+            write_shard_set(out_vec, meta_path, args.shards)
+        for i in range(args.shards) if args.shard < 0 else [args.shard]:
+            vec, meta = shard_paths(out_vec, meta_path, i)
+            print(f"== shard {i}/{args.shards}: {vec.parent}")
+            _ingest(argparse.Namespace(**dict(vars(args), out=str(vec), meta=str(meta))), shard=(i, args.shards))
+        if not args.dry_run:
+            print(f"saved shards: {sidecar_path(out_vec, '.shards.json')}")
+        return 0
+    return _ingest(args)
+
+
+def _ingest(args, shard: Optional[Tuple[int, int]] = None) -> int:
     input_dir = Path(args.input_dir).resolve()
     patterns = [s.strip() for s in args.pattern.split(",") if s.strip()]
-    out_npz = Path(args.out).resolve()
-    meta_jsonl = Path(args.meta).resolve()
-
-    items = _gather_chunks(input_dir, patterns, args.chunk_size, args.chunk_overlap)
+    out_vec = Path(args.out).resolve()
+    meta_path = Path(args.meta).resolve()
+    manifest_path = sidecar_path(out_vec, ".manifest.json")
+    sig_path = sidecar_path(out_vec, ".simhash")
 
-    if args.dry_run:
-        preview = {
-            "input_dir": str(input_dir),
-            "patterns": patterns,
-            "chunks": len(items),
+    with ExtractPool(args.extract_workers, cache=default_page_cache()) as pool:
+        settings = {
             "emb_model": args.emb_model,
-            "out_npz": str(out_npz),
-            "meta_jsonl": str(meta_jsonl),
-            "sample": items[:2],
+            "chunk_size": args.chunk_size,
+            "chunk_overlap": args.chunk_overlap,
+            "dtype": args.dtype,
         }
-        print("[DRY-RUN] ingest preview:")
-        print(pretty(preview))
-        return 0
+        old = _load_manifest(manifest_path)
+        # 省略時は既存インデックスの次元を引き継ぐ（うっかり全件作り直しにならないように）。
+        # 既定次元は None で、dimensions を持たない従来のマニフェストとも一致する
+        dimensions = args.dimensions if args.dimensions is not None else old.get("dimensions")
+        settings["dimensions"] = int(dimensions) if dimensions else None
+        dimensions = settings["dimensions"]
+        incremental = not args.rebuild and _manifest_usable(old, settings, out_vec, meta_path)
+        old_files: Dict = old.get("files", {}) if incremental else {}
+
+        scan = _scan(_iter_files(input_dir, patterns, shard), old_files, args.chunk_size, args.chunk_overlap, pool)
+        dedup: Optional[SimHashIndex] = None
+        if args.dedup:
+            dedup = SimHashIndex(args.dedup_distance)
+            if incremental:
+                dedup.load(read_signatures(sig_path, int(old.get("rows", 0))), dead=old.get("tombstones", []))
 
-    # 埋め込み実行
-    vectors = embed_texts((it["text"] for it in items), model=args.emb_model, dry_run=False)
-    _save_index(out_npz, meta_jsonl, vectors, items)
-    print(f"saved index: {out_npz}")
-    print(f"saved meta:  {meta_jsonl}")
-    return 0
+        if args.dry_run:
+            n_files = n_changed = n_chunks = n_batches = n_segments = n_dup = 0
+            sim_rows = int(old.get("rows", 0)) if incremental else 0
+            seen = set()
+            sample: List[Dict] = []
+            for seg in _segments(scan, args.segment_items):
+                if dedup is not None:
+                    sigs, dup = _dedup_segment(seg, old_files, dedup, sim_rows)
+                    sim_rows += len(sigs)
+                    n_dup += dup
+                texts = [it["text"] for _, _, its in seg if its for it in its]
+                n_segments += 1
+                n_files += len(seg)
+                n_changed += sum(1 for _, _, its in seg if its is not None)
+                n_chunks += len(texts)
+                n_batches += len(plan_batches(texts, args.batch_size, args.batch_tokens))
+                seen.update(k for k, _, _ in seg)
+                sample += [it for _, _, its in seg if its for it in its][: 2 - len(sample)]
+            preview = {
+                "input_dir": str(input_dir),
+                "patterns": patterns,
+                "mode": "incremental" if incremental else "rebuild",
+                "files": n_files,
+                "changed_files": n_changed,
+                "removed_files": sum(1 for k in old_files if k not in seen and _in_scope(k, input_dir, patterns, shard)),
+                "chunks_to_embed": n_chunks,
+                "duplicate_chunks": n_dup if dedup is not None else None,
+                "dedup_ratio": round(n_dup / max(1, n_chunks + n_dup), 4) if dedup is not None else None,
+                "segments": n_segments,
+                "embed_batches": n_batches,
+                "emb_model": args.emb_model,
+                "dimensions": dimensions,
+                "tags": args.tags or None,
+                "out_vec": str(out_vec),
+                "meta": str(meta_path),
+                "sample": sample,
+            }
+            print("[DRY-RUN] ingest preview:")
+            print(pretty(preview))
+            return 0
+
+        # 投入はセグメント（ファイル単位で約 --segment-items チャンク）ごとに
+        # 読み込み → 埋め込み → ベクトル/メタへ追記 → ヘッダ確定 → マニフェスト保存（チェックポイント）
+        # を繰り返す。途中で止まっても、次回の実行は保存済みのファイルを未変更として飛ばして続きから再開する。
+        # 保持するのは先読み分を含めて数セグメント分だけなので、メモリはコーパスの大きさに依存しない。
+        files_out: Dict[str, Dict] = dict(old_files)
+        tombstones: List[int] = list(old.get("tombstones", [])) if incremental else []
+        rows = int(old.get("rows", 0)) if incremental else 0
+        if incremental and (int(read_vec_header(out_vec)["rows"]) > rows or meta_rows(meta_path) > rows):
+            # 前回の中断でマニフェスト確定後に書かれた行を捨て、チェックポイントの状態に戻す
+            h = read_vec_header(out_vec)
+            print(f"resume: discard {int(h['rows']) - rows} uncommitted rows")
+            VectorWriter(out_vec, dims=int(h["dims"]), dtype=h["dtype"], model=h.get("model"), append=True, keep_rows=rows, dimensions=h.get("dimensions")).close()
+            MetaWriter(meta_path, append=True, keep_rows=rows).close()
+        seen = set()
+        n_items = n_changed = n_dup = 0
+        vw: Optional[VectorWriter] = None
+        mw: Optional[MetaWriter] = None
+        sw: Optional[SignatureWriter] = None
+
+        def checkpoint() -> None:
+            _save_manifest(manifest_path, dict(settings, version=MANIFEST_VERSION, rows=rows, files=files_out, tombstones=sorted(set(tombstones))))
+
+        def run(scan) -> None:
+            nonlocal rows, vw, mw, sw, n_items, n_changed, n_dup
+            for seg in _prefetch(_segments(scan, args.segment_items), depth=args.prefetch):
+                sigs: List[int] = []
+                if dedup is not None:
+                    sigs, dup = _dedup_segment(seg, files_out, dedup, rows)
+                    n_dup += dup
+                items = [it for _, _, its in seg if its for it in its]
+                start = rows
+                if items:
+                    for _, vecs in iter_embedding_batches(
+                        [it["text"] for it in items],
+                        model=args.emb_model,
+                        batch_items=args.batch_size,
+                        batch_tokens=args.batch_tokens,
+                        workers=args.workers,
+                        dimensions=dimensions,
+                    ):
+                        if vw is None:
+                            vw = VectorWriter(out_vec, dims=vecs.shape[1], dtype=args.dtype, model=args.emb_model, append=incremental, keep_rows=rows, dimensions=dimensions)
+                            mw = MetaWriter(meta_path, append=incremental, compress=args.compress_meta, keep_rows=rows)
+                        vw.append(vecs)
+                    mw.append(items)
+                    if dedup is not None:
+                        if sw is None:
+                            sw = SignatureWriter(sig_path, keep_rows=start)
+                        sw.append(sigs)
+                        sw.commit()
+                    vw.commit()
+                    mw.commit()
+                    rows = vw.rows
+                dirty = False
+                for key, ent, its in seg:
+                    seen.add(key)
+                    prev = files_out.get(key)
+                    # タグは --tag 指定時に付け替え、省略時（と重複除去のやり直しで読み込んだ範囲外のファイル）は前回のものを引き継ぐ
+                    tags = args.tags if args.tags and _in_scope(key, input_dir, patterns, shard) else (prev or {}).get("tags")
+                    if tags and ent.get("tags") != tags:
+                        ent = dict(ent, tags=tags)
+                    if its is not None:
+                        # 変更されたファイルの旧行は tombstone（検索対象外）にする
+                        if prev and prev.get("row_start", -1) >= 0:
+                            tombstones.extend(range(prev["row_start"], prev["row_start"] + prev["row_count"]))
+                        ent["row_start"] = start
+                        start += ent["row_count"]
+                        n_changed += 1
+                    dirty = dirty or ent is not prev
+                    files_out[key] = ent
+                n_items += len(items)
+                if dirty:
+                    checkpoint()
+
+        try:
+            run(scan)
+            # 削除されたファイルの旧行も tombstone にする（別の --input-dir/--pattern で入れたファイルはそのまま残す）
+            removed = [k for k in files_out if k not in seen and _in_scope(k, input_dir, patterns, shard)]
+            for key in removed:
+                ent = files_out.pop(key)
+                if ent.get("row_start", -1) >= 0:
+                    tombstones.extend(range(ent["row_start"], ent["row_start"] + ent["row_count"]))
+            # 別名の指す正規の行が今回 tombstone になったファイルは、重複除去をやり直すため読み込み直す
+            dead = set(tombstones)
+            if dedup is not None:
+                dedup.remove(dead)
+            orphans = [k for k, ent in files_out.items() if any(row in dead for _, row in ent.get("aliases") or ())]
+            for key in orphans:
+                if not Path(key).is_file():
+                    files_out[key]["aliases"] = [a for a in files_out[key]["aliases"] if a[1] not in dead]
+            if orphans:
+                run(_scan((Path(k) for k in orphans if Path(k).is_file()), {}, args.chunk_size, args.chunk_overlap, pool))
+        except BaseException:
+            for w in (vw, mw, sw):
+                if w is not None:
+                    w.abort()
+            raise
+        for w in (vw, mw, sw):
+            if w is not None:
+                w.close()
+
+        if not incremental and vw is None:
+            if shard is not None:
+                # ファイルの少ないコーパスでは空のシャードもありうる（検索時は 0 行として扱う）
+                print(f"shard {shard[0]}: no documents")
+                return 0
+            raise RuntimeError(f"投入対象のテキストがありません: {input_dir} ({', '.join(patterns)})")
+        checkpoint()
+        print(f"{'incremental' if incremental else 'rebuild'}: embedded {n_items} chunks "
+              f"({n_changed} changed, {len(removed)} removed files, {len(set(tombstones))} tombstoned rows)")
+        if dedup is not None:
+            print(f"dedup: {n_dup} of {n_items + n_dup} chunks were duplicates ({n_dup / max(1, n_items + n_dup):.1%}), "
+                  f"{len(orphans)} files re-checked")
+        if pool.cache is not None and pool.cache.hits + pool.cache.misses:
+            print(f"page cache: {pool.cache.hits} hit / {pool.cache.misses} extracted pages")
+        print(f"saved index: {out_vec}")
+        print(f"saved meta:  {meta_path}")
+        if args.build_ivf:
+            from ivf_index import build_ivf
+
+            print(f"saved ivf:   {build_ivf(out_vec, n_lists=args.ivf_lists)}")
+        if args.update_hnsw:
+            from hnsw_index import update_hnsw
+
+            added, total = update_hnsw(out_vec)
+            print(f"saved hnsw:  +{added} rows (total {total})")
+        if args.build_pq:
+            from pq_index import build_pq
+
+            print(f"saved pq:    {build_pq(out_vec, m=args.pq_m)}")
+        if args.build_binary:
+            from binary_index import build_binary
+
+            print(f"saved bin1:  {build_binary(out_vec)}")
+        if args.build_bm25:
+            from bm25_index import build_bm25
+
+            print(f"saved bm25:  {build_bm25(out_vec, meta_path)}")
+        return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""IVF（k-means で分割した転置ファイル）による近似最近傍検索。
+
+構築: 正規化済みベクトルを球面 k-means で n_lists 個のリストに分け、
+      リスト順に並べ替えたベクトルを index.ivf.vec に連続ブロックとして保存する。
+検索: 質問に近いセントロイド上位 nprobe 個のリストだけを内積で走査する。
+
+インデックス構築後に ingest で追記された行（IVF 未登録の末尾）は全件走査で補うので、
+差分投入のたびに作り直さなくても結果は欠けない。
+
+使い方:
+  python RAG/ivf_index.py --index RAG/index/index.vec --lists 0 --eval 200
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from common import VectorWriter, eval_recall, load_live_mask, load_vectors, normalize_rows, pretty, read_vec_header, sidecar_path
+
+IVF_VERSION = 1
+
+
+def auto_lists(rows: int) -> int:
+    return max(1, min(rows, int(4 * rows**0.5)))
+
+
+def _assign(vectors, centroids, block_rows: int = 65536):
+    """各行を最も近いセントロイドに割り当てる"""
+    import numpy as np
+
+    out = np.empty(len(vectors), dtype=np.int32)
+    for s in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[s : s + block_rows], dtype="float32")
+        out[s : s + block_rows] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def train_kmeans(vectors, n_lists: int, iters: int = 20, sample_per_list: int = 256, max_sample: int = 131072, seed: int = 0):
+    """球面 k-means（内積最大で割り当て、平均を再正規化）。学習はサンプルで行う"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    n_sample = min(n, max(n_lists, min(n_lists * sample_per_list, max_sample)))
+    idx = np.sort(rng.choice(n, size=n_sample, replace=False))
+    xs = normalize_rows(vectors[idx])
+    centroids = xs[rng.choice(n_sample, size=n_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(xs, centroids)
+        counts = np.bincount(assign, minlength=n_lists)
+        sums = np.zeros_like(centroids)
+        o = np.argsort(assign, kind="stable")
+        nonempty = counts > 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums[nonempty] = np.add.reduceat(xs[o], starts, axis=0)
+        empty = counts == 0
+        if empty.any():
+            # 空リストはランダムな点で再初期化
+            sums[empty] = xs[rng.choice(n_sample, size=int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def build_ivf(index_path: Path, n_lists: int = 0, iters: int = 20, seed: int = 0) -> Path:
+    """index.vec から IVF を構築し、index.ivf.npz / index.ivf.vec を書く"""
+    import numpy as np
+
+    index_path = Path(index_path)
+    vectors = load_vectors(index_path)
+    rows = len(vectors)
+    if rows == 0:
+        raise RuntimeError(f"ベクトルが空です: {index_path}")
+    n_lists = n_lists or auto_lists(rows)
+    n_lists = min(n_lists, rows)
+    centroids = train_kmeans(vectors, n_lists, iters=iters, seed=seed)
+    assign = _assign(vectors, centroids)
+    order = np.argsort(assign, kind="stable").astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+
+    h = read_vec_header(index_path) if index_path.suffix == ".vec" else {"dtype": "float32", "model": None}
+    with VectorWriter(sidecar_path(index_path, ".ivf.vec"), dims=vectors.shape[1], dtype=h["dtype"], model=h.get("model")) as w:
+        for s in range(0, rows, 65536):
+            chunk = order[s : s + 65536]
+            # メモリマップ上のランダムアクセスを減らすため行番号の昇順に読み、リスト順に並べ直す
+            srt = np.argsort(chunk)
+            block = np.empty((len(chunk), vectors.shape[1]), dtype="float32")
+            block[srt] = vectors[chunk[srt]]
+            w.append(block)
+    out = sidecar_path(index_path, ".ivf.npz")
+    np.savez(
+        out,
+        version=IVF_VERSION,
+        rows=rows,
+        centroids=centroids,
+        offsets=offsets,
+        ids=order.astype(np.int32 if rows < 2**31 else np.int64),
+        source_uid=np.array(h.get("uid") or ""),
+    )
+    return out
+
+
+class IVFSearcher:
+    """top_k_similar と同じ (行番号, スコア) のリストを返す IVF 検索器"""
+
+    def __init__(self, index_path: Path, vectors, mask=None, nprobe: int = 8) -> None:
+        import numpy as np
+
+        index_path = Path(index_path)
+        path = sidecar_path(index_path, ".ivf.npz")
+        if not path.exists():
+            raise FileNotFoundError(f"IVF インデックスが見つかりません: {path}（ivf_index.py か ingest.py --build-ivf で作成）")
+        data = np.load(path)
+        if int(data["version"]) > IVF_VERSION:
+            raise ValueError(f"未対応の IVF 版です: {int(data['version'])}")
+        self.centroids = data["centroids"]
+        self.offsets = data["offsets"]
+        self.ids = data["ids"]
+        self.ivf_rows = int(data["rows"])
+        uid = str(data["source_uid"]) if "source_uid" in data else ""
+        if uid and index_path.suffix == ".vec" and uid != read_vec_header(index_path).get("uid"):
+            raise RuntimeError("IVF インデックスが現在の index.vec と一致しません。ivf_index.py で作り直してください。")
+        self.list_vectors = load_vectors(sidecar_path(index_path, ".ivf.vec"))
+        self.vectors = vectors
+        self.mask = mask
+        self.nprobe = max(1, int(nprobe))
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        q = normalize_rows(np.asarray(query_vec).reshape(-1))
+        nprobe = min(self.nprobe, len(self.centroids))
+        cent = self.centroids @ q
+        if self.mask is None:
+            lists = np.argpartition(-cent, nprobe - 1)[:nprobe]
+        else:
+            # 除外する行があるときは、マスクを通る行が k 件たまるまで近い順に次のリストも開く
+            # （条件に合う行が質問から遠いクラスタにしか無くても取りこぼさない）
+            lists = np.argsort(-cent)
+        ids_parts, sims_parts = [], []
+        passed = 0
+        for n, l in enumerate(lists):
+            if n >= nprobe and (self.mask is None or passed >= k):
+                break
+            s, e = int(self.offsets[l]), int(self.offsets[l + 1])
+            if s == e:
+                continue
+            ids_parts.append(self.ids[s:e])
+            sims_parts.append(np.asarray(self.list_vectors[s:e], dtype="float32") @ q)
+            if self.mask is not None:
+                passed += int(np.count_nonzero(self.mask[ids_parts[-1]]))
+        # IVF 構築後に追記された行は全件走査で補う
+        if len(self.vectors) > self.ivf_rows:
+            ids_parts.append(np.arange(self.ivf_rows, len(self.vectors)))
+            sims_parts.append(np.asarray(self.vectors[self.ivf_rows :], dtype="float32") @ q)
+        if not ids_parts:
+            return []
+        ids = np.concatenate(ids_parts)
+        sims = np.concatenate(sims_parts)
+        if self.mask is not None:
+            sims = np.where(self.mask[ids], sims, -np.inf)
+        k = min(k, len(sims))
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(int(ids[i]), float(sims[i])) for i in top if np.isfinite(sims[i])]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: build IVF (k-means partitioned) index for approximate search")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--lists", type=int, default=0, help="リスト数（0 で 4*sqrt(行数)）")
+    p.add_argument("--iters", type=int, default=20, help="k-means の反復回数")
+    p.add_argument("--eval", type=int, default=0, help="構築後に N 件の質問で recall@k を測る")
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--nprobe", type=int, default=8)
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    t0 = time.perf_counter()
+    out = build_ivf(index_path, n_lists=args.lists, iters=args.iters)
+    print(f"saved ivf: {out} ({time.perf_counter() - t0:.1f}s)")
+    if args.eval:
+        vectors = load_vectors(index_path)
+        mask = load_live_mask(index_path, len(vectors))
+        searcher = IVFSearcher(index_path, vectors, mask=mask, nprobe=args.nprobe)
+        print(pretty(dict(eval_recall(searcher, vectors, mask, n_queries=args.eval, k=args.k), nprobe=args.nprobe)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
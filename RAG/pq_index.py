@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""直積量子化（Product Quantization, PQ）による圧縮ベクトルと非対称距離（ADC）検索。
+
+- 次元 D を m 個の部分ベクトルに分け、それぞれ 256 個の代表点（コードブック）で量子化する。
+  1行あたり m バイト（uint8 × m）。1536 次元 float32（6144B）なら m=96 で 64 分の1。
+- 検索: 質問ごとに部分ベクトル×代表点の内積表（m×256）を作り、符号を引いて足し合わせるだけで採点。
+- 再採点: ADC の上位 rescore 件だけ index.vec（memmap）の元ベクトルで内積を取り直す。
+  常駐するのは符号だけなので、元ベクトルはほぼページインされない。
+
+保存: index.pq.npz（コードブック等）+ index.pq.codes.npy（(m, rows) uint8。部分空間ごとに連続。memmap で開く）
+
+使い方:
+  python RAG/pq_index.py --index RAG/index/index.vec --m 0 --eval 200
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from common import eval_recall, load_live_mask, load_vectors, normalize_rows, pretty, read_vec_header, sidecar_path
+
+PQ_VERSION = 1
+PQ_KS = 256
+
+
+def auto_m(dims: int) -> int:
+    """既定の部分ベクトル数（部分次元がおよそ 16 になる D の約数）"""
+    for dsub in (16, 8, 12, 24, 32, 4, 6, 2, 1):
+        if dims % dsub == 0:
+            return dims // dsub
+    return dims
+
+
+def _kmeans_l2(x, k: int, iters: int, rng):
+    """ユークリッド距離の k-means（PQ の各部分空間用）"""
+    import numpy as np
+
+    c = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        # argmin ||x - c||^2 = argmax (x·c - ||c||^2 / 2)
+        assign = np.argmax(x @ c.T - 0.5 * np.sum(c * c, axis=1), axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(c)
+        o = np.argsort(assign, kind="stable")
+        nonempty = counts > 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums[nonempty] = np.add.reduceat(x[o], starts, axis=0)
+        c[nonempty] = sums[nonempty] / counts[nonempty, None]
+        empty = ~nonempty
+        if empty.any():
+            c[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+    return c
+
+
+def train_codebooks(vectors, m: int, iters: int = 15, max_sample: int = 65536, seed: int = 0):
+    """(m, ks, dsub) のコードブックを学習する"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    n, d = vectors.shape
+    if d % m:
+        raise ValueError(f"次元 {d} は m={m} で割り切れません")
+    dsub = d // m
+    ks = min(PQ_KS, n)
+    idx = np.sort(rng.choice(n, size=min(n, max_sample), replace=False))
+    xs = np.asarray(vectors[idx], dtype="float32")
+    books = np.empty((m, ks, dsub), dtype="float32")
+    for j in range(m):
+        books[j] = _kmeans_l2(np.ascontiguousarray(xs[:, j * dsub : (j + 1) * dsub]), ks, iters, rng)
+    return books
+
+
+def encode(vectors, books, block_rows: int = 65536):
+    """各部分ベクトルを最も近い代表点の番号（uint8）に変換する"""
+    import numpy as np
+
+    m, ks, dsub = books.shape
+    half_norms = 0.5 * np.sum(books * books, axis=2)  # (m, ks)
+    codes = np.empty((len(vectors), m), dtype=np.uint8)
+    for s in range(0, len(vectors), block_rows):
+        block = np.asarray(vectors[s : s + block_rows], dtype="float32")
+        for j in range(m):
+            sub = block[:, j * dsub : (j + 1) * dsub]
+            codes[s : s + block_rows, j] = np.argmax(sub @ books[j].T - half_norms[j], axis=1)
+    return codes
+
+
+def build_pq(index_path: Path, m: int = 0, iters: int = 15, seed: int = 0) -> Path:
+    import numpy as np
+
+    index_path = Path(index_path)
+    vectors = load_vectors(index_path)
+    if len(vectors) == 0:
+        raise RuntimeError(f"ベクトルが空です: {index_path}")
+    m = m or auto_m(vectors.shape[1])
+    books = train_codebooks(vectors, m, iters=iters, seed=seed)
+    codes = encode(vectors, books)
+    # 採点時は部分空間ごとに全行を舐めるので、列方向（部分空間）を連続させて保存する
+    np.save(sidecar_path(index_path, ".pq.codes.npy"), np.ascontiguousarray(codes.T))
+    uid = read_vec_header(index_path).get("uid") if index_path.suffix == ".vec" else None
+    out = sidecar_path(index_path, ".pq.npz")
+    np.savez(out, version=PQ_VERSION, rows=len(vectors), codebooks=books, source_uid=np.array(uid or ""))
+    return out
+
+
+class PQSearcher:
+    """top_k_similar と同じ (行番号, スコア) のリストを返す PQ（ADC）検索器"""
+
+    def __init__(self, index_path: Path, vectors, mask=None, rescore: int = 100, block_rows: int = 262144) -> None:
+        import numpy as np
+
+        index_path = Path(index_path)
+        path = sidecar_path(index_path, ".pq.npz")
+        if not path.exists():
+            raise FileNotFoundError(f"PQ インデックスが見つかりません: {path}（pq_index.py か ingest.py --build-pq で作成）")
+        data = np.load(path)
+        if int(data["version"]) > PQ_VERSION:
+            raise ValueError(f"未対応の PQ 版です: {int(data['version'])}")
+        uid = str(data["source_uid"])
+        if uid and index_path.suffix == ".vec" and uid != read_vec_header(index_path).get("uid"):
+            raise RuntimeError("PQ インデックスが現在の index.vec と一致しません。pq_index.py で作り直してください。")
+        self.books = data["codebooks"]
+        self.pq_rows = int(data["rows"])
+        self.codes = np.load(sidecar_path(index_path, ".pq.codes.npy"), mmap_mode="r")  # (m, rows)
+        self.vectors = vectors
+        self.mask = mask
+        self.rescore = max(0, int(rescore))
+        self.block_rows = block_rows
+
+    def adc_scores(self, q):
+        """非対称距離: 質問は元のまま、コーパス側だけ量子化した内積の近似値を返す"""
+        import numpy as np
+
+        m, ks, dsub = self.books.shape
+        lut = np.einsum("jkd,jd->jk", self.books, q.reshape(m, dsub)).astype("float32")  # (m, ks)
+        out = np.zeros(self.pq_rows, dtype="float32")
+        for s in range(0, self.pq_rows, self.block_rows):
+            acc = out[s : s + self.block_rows]
+            for j in range(m):
+                acc += lut[j].take(self.codes[j, s : s + self.block_rows])
+        return out
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        q = normalize_rows(np.asarray(query_vec).reshape(-1))
+        sims = self.adc_scores(q)
+        ids = np.arange(self.pq_rows)
+        # PQ 構築後に追記された行は元ベクトルで全件走査
+        if len(self.vectors) > self.pq_rows:
+            ids = np.arange(len(self.vectors))
+            sims = np.concatenate([sims, np.asarray(self.vectors[self.pq_rows :], dtype="float32") @ q])
+        if self.mask is not None:
+            sims = np.where(self.mask[: len(sims)], sims, -np.inf)
+        n_short = min(len(sims), max(k, self.rescore))
+        if n_short == 0:
+            return []
+        short = np.argpartition(-sims, n_short - 1)[:n_short]
+        short = short[np.isfinite(sims[short])]
+        if self.rescore:
+            # 候補だけ元ベクトルで厳密に再採点（行番号順に読むとページインが少ない）
+            short = np.sort(short)
+            sims_short = np.asarray(self.vectors[ids[short]], dtype="float32") @ q
+        else:
+            sims_short = sims[short]
+        order = np.argsort(-sims_short)[:k]
+        return [(int(ids[short[i]]), float(sims_short[i])) for i in order]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: build product-quantized (PQ) codes for compressed search")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--m", type=int, default=0, help="部分ベクトル数（1行あたりのバイト数。0 で 次元/16）")
+    p.add_argument("--iters", type=int, default=15, help="k-means の反復回数")
+    p.add_argument("--eval", type=int, default=0, help="構築後に N 件の質問で recall@k を測る")
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--rescore", type=int, default=100, help="再採点する候補数（0 で ADC のみ）")
+    args = p.parse_args(argv)
+
+    index_path = Path(args.index).resolve()
+    t0 = time.perf_counter()
+    out = build_pq(index_path, m=args.m, iters=args.iters)
+    codes = sidecar_path(index_path, ".pq.codes.npy")
+    print(f"saved pq: {out} ({codes.stat().st_size / 1e6:.1f} MB codes, {time.perf_counter() - t0:.1f}s)")
+    if args.eval:
+        vectors = load_vectors(index_path)
+        mask = load_live_mask(index_path, len(vectors))
+        searcher = PQSearcher(index_path, vectors, mask=mask, rescore=args.rescore)
+        print(pretty(dict(eval_recall(searcher, vectors, mask, n_queries=args.eval, k=args.k), rescore=args.rescore)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,42 +4,313 @@ from __future__ import annotations
 
 import argparse
 import json
+import sys
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from common import client, embed_texts, pretty, top_k_similar
+from common import add_search_args, batch_search, client, embed_texts, index_chunk_overlap, index_version, is_shard_set, load_aliases, load_live_mask, load_vectors, open_index, open_meta, pretty, query_dimensions, resolve_meta_path, rrf_fuse, search_opts, token_counter
+from context_pack import add_context_args, pack_contexts
+from filters import add_filter_args, and_masks, filter_mask, filtered_searcher, parse_filters
 
 
-def _load_meta(meta_path: Path) -> List[Dict]:
-    items: List[Dict] = []
-    if not meta_path.exists():
-        return items
-    with meta_path.open("r", encoding="utf-8") as f:
-        for line in f:
+def _messages(system: str, contexts: List[str], question: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": system},
+        {
+            "role": "user",
+            "content": (
+                "以下のコンテキストを参照して質問に答えてください。\n\n"
+                + "\n\n".join(f"- {c}" for c in contexts)
+                + f"\n\n質問: {question}"
+            ),
+        },
+    ]
+
+
+def chat_create(c, payload: Dict):
+    """chat.completions.create を呼ぶ。temperature を受け付けないモデルのときだけ外して1度だけ送り直す（rerank_with_chat.py からも使う）"""
+    try:
+        return c.chat.completions.create(**payload)
+    except Exception as e:
+        if "temperature" in payload and "temperature" in str(e).lower():
+            payload.pop("temperature", None)
+            return c.chat.completions.create(**payload)
+        raise
+
+
+def chat_answer(c, payload: Dict) -> str:
+    """payload で Chat を呼び、回答本文を返す（server.py からも使う）"""
+    return (chat_create(c, payload).choices[0].message.content or "").strip()
+
+
+def _gen_stats(text: str, usage, started: float, first: Optional[float]) -> Dict:
+    """生成の所要時間・トークン数・速度（usage が無ければトークン数は見積もり）"""
+    end = time.perf_counter()
+    tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+    if tokens is None:
+        tokens = token_counter()(text)
+    # 速度は最初のトークン以降の区間で測る（ストリームでなければ全体）
+    span = end - (first if first is not None else started)
+    return {
+        "ttft": round((first - started) * 1000, 1) if first is not None else None,
+        "generation": round((end - started) * 1000, 1),
+        "completion_tokens": tokens,
+        "tokens_per_sec": round(tokens / span, 1) if span > 0 else None,
+    }
+
+
+def _chat_timed(c, payload: Dict) -> Tuple[str, Dict]:
+    t0 = time.perf_counter()
+    resp = chat_create(c, payload)
+    text = (resp.choices[0].message.content or "").strip()
+    return text, _gen_stats(text, getattr(resp, "usage", None), t0, None)
+
+
+def _chat_stream(c, payload: Dict, out=None) -> Tuple[str, Dict]:
+    """回答を届いた順に out（既定: 標準出力）へ書き出し、(回答全体, 生成の計測値) を返す"""
+    out = out or sys.stdout
+    t0 = time.perf_counter()
+    stream = chat_create(c, dict(payload, stream=True, stream_options={"include_usage": True}))
+    parts: List[str] = []
+    first = None
+    usage = None
+    for event in stream:
+        # include_usage の最後のイベントは choices が空で usage だけを持つ
+        usage = getattr(event, "usage", None) or usage
+        for choice in event.choices or ():
+            piece = getattr(choice.delta, "content", None)
+            if piece:
+                if first is None:
+                    first = time.perf_counter()
+                parts.append(piece)
+                out.write(piece)
+                out.flush()
+    out.write("\n")
+    out.flush()
+    text = "".join(parts).strip()
+    return text, _gen_stats(text, usage, t0, first)
+
+
+@contextmanager
+def _stage(timings: Dict[str, float], name: str):
+    """with ブロックの所要時間（ミリ秒）を timings[name] に足し込む"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(timings.get(name, 0.0) + (time.perf_counter() - t0) * 1000, 1)
+
+
+def _emit_timings(args, record: Dict) -> None:
+    """--timings: 1質問1行の JSON を標準エラー（または指定ファイルへ追記）に出す"""
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    if args.timings == "-":
+        sys.stderr.write(line)
+        sys.stderr.flush()
+    else:
+        with open(args.timings, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def _timing_record(args, question: str, stages: Dict[str, float], gen: Optional[Dict], started: float, **extra) -> Dict:
+    stages = dict(stages)
+    rec = {"ts": time.time(), "question": question, **extra, "retrieval": args.retrieval, "backend": args.backend, "k": args.k}
+    if gen is not None:
+        stages["ttft"] = gen["ttft"]
+        stages["generation"] = gen["generation"]
+        rec["completion_tokens"] = gen["completion_tokens"]
+        rec["tokens_per_sec"] = gen["tokens_per_sec"]
+    stages["total"] = round((time.perf_counter() - started) * 1000, 1)
+    rec["stages_ms"] = stages
+    return rec
+
+
+def chat_payload(args, contexts: List[str], question: str) -> Dict:
+    """回答生成の chat.completions.create に渡す payload（server.py からも使う）"""
+    payload = {"model": args.chat_model, "messages": _messages(args.system, contexts, question), "max_tokens": args.max_tokens}
+    if not args.no_temperature:
+        payload["temperature"] = args.temperature
+    return payload
+
+
+RETRIEVAL_MODES = ("dense", "hybrid", "lexical", "auto")
+
+
+def _retrieve(args, index_path: Path, meta_items, questions: List[str], q_vecs=None, timings: Optional[Dict[str, float]] = None) -> List[List[Tuple[int, float]]]:
+    """--retrieval に従って各質問の上位 k 行を返す。
+
+    dense=埋め込みのみ / lexical=BM25 のみ（埋め込み API を呼ばない）/ hybrid=両方を RRF で融合 /
+    auto=BM25 の1位が質問の語を --lexical-coverage 以上含めば BM25 のみ、足りなければ hybrid
+    q_vecs を渡すと（回答キャッシュで埋め込み済みの場合）質問の埋め込みを省く。
+    timings を渡すと index_load / embed / search の所要時間（ミリ秒）を足し込む。
+    --filter があれば、条件に合う行だけを検索する（マスクの用意は index_load に含める）。
+    """
+    timings = {} if timings is None else timings
+    meta_path = resolve_meta_path(index_path, args.meta)
+    depth = args.k if args.retrieval == "dense" else max(args.k * 5, 20)
+    lexical: List[Optional[List[Tuple[int, float]]]] = [None] * len(questions)
+    tops: List[Optional[List[Tuple[int, float]]]] = [None] * len(questions)
+    if args.retrieval != "dense":
+        from bm25_index import BM25Searcher, token_coverage
+
+        if is_shard_set(index_path):
+            raise ValueError("シャード分割したインデックスは --retrieval dense のみ対応です")
+        with _stage(timings, "index_load"):
+            rows = len(load_vectors(index_path))
+            mask = and_masks(load_live_mask(index_path, rows), filter_mask(index_path, meta_path, args.filter, rows, meta_items))
+            bm25 = BM25Searcher(index_path, meta_items, mask=mask)
+        for n, q in enumerate(questions):
+            with _stage(timings, "search"):
+                lex = bm25.search(q, depth)
+            lexical[n] = lex
+            if args.retrieval == "lexical":
+                tops[n] = lex[: args.k]
+            elif args.retrieval == "auto" and lex and token_coverage(q, meta_items[lex[0][0]].get("text", "")) >= args.lexical_coverage:
+                tops[n] = lex[: args.k]
+    need = [n for n, t in enumerate(tops) if t is None]
+    if need:
+        if q_vecs is None:
+            with _stage(timings, "embed"):
+                q_vecs = embed_texts([questions[n] for n in need], model=args.emb_model, dry_run=False, dimensions=args.dimensions)
+        else:
+            q_vecs = q_vecs[need]
+        with _stage(timings, "index_load"):
+            searcher, _ = open_index(index_path, args.backend, **search_opts(args))
+            searcher = filtered_searcher(searcher, index_path, meta_path, args.filter, meta_items)
+        with _stage(timings, "search"):
+            dense_tops = batch_search(searcher, q_vecs, depth)
+        for n, dense in zip(need, dense_tops):
+            tops[n] = dense[: args.k] if lexical[n] is None else rrf_fuse([dense, lexical[n]], args.k, rrf_k=args.rrf_k)
+    return tops
+
+
+def hits_for_rows(top: List[Tuple[int, float]], meta_items, aliases: Dict[int, List[str]]) -> List[Dict]:
+    """検索結果の (行, スコア) にメタデータ（ファイル・チャンク番号・本文・別名）を付ける（server.py からも使う）"""
+    hits = []
+    for i, score in top:
+        if 0 <= i < len(meta_items):
+            it = meta_items[i]
+            hit = {"row": i, "score": score, "file": it.get("file"), "chunk_index": it.get("chunk_index"), "text": it.get("text", "")}
+            if i in aliases:
+                hit["aliases"] = aliases[i]
+            hits.append(hit)
+    return hits
+
+
+def answer_contexts(args, hits: List[Dict], overlap: Optional[int] = None) -> List[str]:
+    """連続するチャンクを（overlap 文字の重なりを除いて）まとめ、順位の高い順にトークン予算に収まる分だけを回答に渡す"""
+    return [s["text"] for s in pack_contexts(hits, args.context_tokens, args.score_gap, overlap=overlap)]
+
+
+def _answer_cache(args, index_path: Path, meta_path: Path):
+    """--answer-cache が有効なら (キャッシュ, 設定のハッシュ, インデックスの版) を、無効なら None を返す"""
+    if not args.answer_cache:
+        return None
+    from answer_cache import config_key, default_answer_cache
+
+    cache = default_answer_cache()
+    if cache is None:
+        return None
+    # 回答を変えうる設定はすべてキーに含める（どれかを変えた質問は別扱い）
+    settings = {
+        "emb_model": args.emb_model, "chat_model": args.chat_model, "system": args.system, "k": args.k,
+        "max_tokens": args.max_tokens, "temperature": None if args.no_temperature else args.temperature,
+        "retrieval": args.retrieval, "backend": args.backend, "search": search_opts(args),
+        "rrf_k": args.rrf_k, "lexical_coverage": args.lexical_coverage,
+        "context_tokens": args.context_tokens, "score_gap": args.score_gap, "filter": args.filter,
+    }
+    return cache, config_key(settings), index_version(index_path, meta_path)
+
+
+def _read_questions(path: Path) -> List[Dict]:
+    """1行1件の JSONL（{"question": ..., "id": ...} または文字列）を読む"""
+    rows: List[Dict] = []
+    with path.open("r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
             line = line.strip()
             if not line:
                 continue
-            try:
-                items.append(json.loads(line))
-            except Exception:
-                pass
-    return items
+            obj = json.loads(line)
+            rows.append(obj if isinstance(obj, dict) else {"question": str(obj)})
+            rows[-1].setdefault("id", n)
+    return rows
+
+
+def _run_batch(args, index_path: Path, meta_path: Path) -> int:
+    """質問ファイルを一括処理: 埋め込み1回 → 行列積でまとめて検索 → 結果を JSONL で出力"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    rows = _read_questions(Path(args.questions_file))
+    if args.dry_run:
+        print("[DRY-RUN] batch query preview:")
+        print(pretty({"questions": len(rows), "k": args.k, "backend": args.backend, "retrieval": args.retrieval, "filter": args.filter, "answer": args.answer, "answer_cache": args.answer_cache, "sample": rows[:2]}))
+        return 0
+
+    started = time.perf_counter()
+    # 埋め込み・検索は全質問まとめて行うので、計測値も一括分（各質問の記録に同じ値が入る）
+    timings: Dict[str, float] = {}
+    with _stage(timings, "index_load"):
+        meta_items = open_meta(meta_path)
+    if not len(meta_items):
+        raise RuntimeError("メタデータが空です。先に ingest.py を実行してください。")
+    questions = [r["question"] for r in rows]
+    cached = _answer_cache(args, index_path, meta_path) if args.answer else None
+    found: List[Optional[Dict]] = [None] * len(rows)
+    q_vecs = None
+    if cached:
+        cache, config, version = cached
+        with _stage(timings, "embed"):
+            q_vecs = embed_texts(questions, model=args.emb_model, dry_run=False, dimensions=args.dimensions)
+        found = cache.lookup(str(index_path), config, version, q_vecs, args.cache_similarity)
+    todo = [n for n, f in enumerate(found) if f is None]
+    tops = _retrieve(args, index_path, meta_items, [questions[n] for n in todo], None if q_vecs is None else q_vecs[todo], timings) if todo else []
+    aliases = load_aliases(index_path)
 
+    results: List[Dict] = [{} for _ in rows]
+    for n, top in zip(todo, tops):
+        results[n] = {"id": rows[n]["id"], "question": questions[n], "hits": hits_for_rows(top, meta_items, aliases)}
+    for n, f in enumerate(found):
+        if f is not None:
+            results[n] = {"id": rows[n]["id"], "question": questions[n], "hits": f["contexts"], "answer": f["answer"], "cached": {"question": f["question"], "similarity": round(f["similarity"], 4)}}
 
-def _load_vectors(npz_path: Path):
-    import numpy as np
+    gens: Dict[int, Dict] = {}
+    if args.answer:
+        c = client()
+        overlap = index_chunk_overlap(index_path)
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+            answers = pool.map(lambda n: _chat_timed(c, chat_payload(args, answer_contexts(args, results[n]["hits"], overlap), questions[n])), todo)
+            for n, (ans, gen) in zip(todo, answers):
+                results[n]["answer"] = ans
+                gens[n] = gen
+        if cached:
+            cache.put(str(index_path), config, version, [(questions[n], q_vecs[n], results[n]["answer"], results[n]["hits"]) for n in todo])
+            print(f"[answer-cache] hit {cache.hits}/{len(rows)} ({cache.hits / len(rows):.1%})", file=sys.stderr)
 
-    if not npz_path.exists():
-        raise FileNotFoundError(f"ベクトルが見つかりません: {npz_path}")
-    data = np.load(npz_path)
-    return data["vectors"]
+    out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+    try:
+        for res in results:
+            out.write(json.dumps(res, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if args.timings:
+        for n, r in enumerate(rows):
+            _emit_timings(args, _timing_record(args, questions[n], timings, gens.get(n), started, id=r["id"], batch=len(rows), cached=found[n] is not None))
+    return 0
 
 
 def main(argv: Optional[List[str]] = None) -> int:
     p = argparse.ArgumentParser(description="RAG: query with simple local index")
-    p.add_argument("--index", default="./RAG/index/index.npz")
-    p.add_argument("--meta", default="./RAG/index/meta.jsonl")
-    p.add_argument("--question", required=True)
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    q = p.add_mutually_exclusive_group(required=True)
+    q.add_argument("--question")
+    q.add_argument("--questions-file", help="質問を1行1件で並べた JSONL（一括モード）")
+    p.add_argument("--out", help="一括モードの結果 JSONL の出力先（省略時は標準出力）")
+    p.add_argument("--answer", action="store_true", help="一括モードで回答も生成する")
+    p.add_argument("--workers", type=int, default=4, help="一括モードで回答生成を並列に行う数")
     p.add_argument("--k", type=int, default=4)
     p.add_argument("--emb-model", default="text-embedding-3-small")
     p.add_argument("--chat-model", default="gpt-5")
@@ -47,71 +318,76 @@ def main(argv: Optional[List[str]] = None) -> int:
     p.add_argument("--max-tokens", type=int, default=512)
     p.add_argument("--temperature", type=float, default=0.2)
     p.add_argument("--no-temperature", action="store_true")
+    add_context_args(p)
+    add_search_args(p)
+    add_filter_args(p)
+    p.add_argument("--retrieval", choices=RETRIEVAL_MODES, default="dense", help="dense=埋め込み, lexical=BM25 のみ, hybrid=RRF 融合, auto=BM25 で足りれば埋め込みを省略")
+    p.add_argument("--rrf-k", type=int, default=60, help="hybrid: RRF の定数（大きいほど下位の順位も効く）")
+    p.add_argument("--lexical-coverage", type=float, default=1.0, help="auto: BM25 の1位が質問の語をこの割合以上含めば BM25 のみで答える")
+    p.add_argument("--answer-cache", action="store_true", help="似た質問への回答を再利用する（answer_cache.py。インデックスを更新すると失効）")
+    p.add_argument("--cache-similarity", type=float, default=0.95, help="--answer-cache: 同じ質問とみなす質問ベクトルのコサイン類似度")
+    p.add_argument("--stream", action="store_true", help="回答を生成しながら表示する（単発の質問のみ）")
+    p.add_argument("--timings", nargs="?", const="-", metavar="PATH", help="段階ごとの所要時間を1質問1行の JSON で出す（PATH に追記。省略時は標準エラー）")
     p.add_argument("--dry-run", action="store_true")
     args = p.parse_args(argv)
+    if args.stream and args.questions_file:
+        p.error("--stream は --question と一緒に使ってください")
 
     index_path = Path(args.index).resolve()
-    meta_path = Path(args.meta).resolve()
+    meta_path = resolve_meta_path(index_path, args.meta)
+    if is_shard_set(index_path) and args.retrieval != "dense":
+        p.error("シャード分割したインデックスは --retrieval dense のみ対応です")
+    try:
+        parse_filters(args.filter)
+    except ValueError as e:
+        p.error(str(e))
+    args.dimensions = query_dimensions(p, index_path, args.emb_model)
+
+    if args.questions_file:
+        return _run_batch(args, index_path, meta_path)
 
     if args.dry_run:
-        meta_items = _load_meta(meta_path)
+        meta_items = open_meta(meta_path)
         contexts = [it.get("text", "")[:200] for it in meta_items[:args.k]] or ["<no-meta>"]
-        messages = [
-            {"role": "system", "content": args.system},
-            {
-                "role": "user",
-                "content": (
-                    "以下のコンテキストを参照して質問に答えてください。\n\n"
-                    + "\n\n".join(f"- {c}" for c in contexts)
-                    + f"\n\n質問: {args.question}"
-                ),
-            },
-        ]
-        payload = {"model": args.chat_model, "messages": messages, "max_tokens": args.max_tokens}
-        if not args.no_temperature:
-            payload["temperature"] = args.temperature
         print("[DRY-RUN] chat.completions.create payload (RAG):")
-        print(pretty(payload))
+        print(pretty(chat_payload(args, contexts, args.question)))
         return 0
 
     # 実行: 埋め込み→検索→Chat
-    vectors = _load_vectors(index_path)
-    meta_items = _load_meta(meta_path)
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
+    with _stage(timings, "index_load"):
+        meta_items = open_meta(meta_path)
     if not len(meta_items):
-        raise RuntimeError("meta.jsonl が空です。先に ingest.py を実行してください。")
+        raise RuntimeError("メタデータが空です。先に ingest.py を実行してください。")
 
-    q_vec = embed_texts([args.question], model=args.emb_model, dry_run=False)[0]
-    top = top_k_similar(q_vec, vectors, args.k)
-    contexts: List[str] = []
-    for i, score in top:
-        if 0 <= i < len(meta_items):
-            contexts.append(meta_items[i].get("text", ""))
+    cached = _answer_cache(args, index_path, meta_path)
+    q_vecs = None
+    if cached:
+        cache, config, version = cached
+        with _stage(timings, "embed"):
+            q_vecs = embed_texts([args.question], model=args.emb_model, dry_run=False, dimensions=args.dimensions)
+        hit = cache.lookup(str(index_path), config, version, q_vecs, args.cache_similarity)[0]
+        if hit is not None:
+            print(f"[answer-cache] hit: similarity={hit['similarity']:.3f} question={hit['question']!r}", file=sys.stderr)
+            print(hit["answer"], flush=True)
+            if args.timings:
+                _emit_timings(args, _timing_record(args, args.question, timings, None, started, cached=True))
+            return 0
 
-    messages = [
-        {"role": "system", "content": args.system},
-        {
-            "role": "user",
-            "content": (
-                "以下のコンテキストを参照して質問に答えてください。\n\n"
-                + "\n\n".join(f"- {c}" for c in contexts)
-                + f"\n\n質問: {args.question}"
-            ),
-        },
-    ]
-    payload = {"model": args.chat_model, "messages": messages, "max_tokens": args.max_tokens}
-    if not args.no_temperature:
-        payload["temperature"] = args.temperature
+    top = _retrieve(args, index_path, meta_items, [args.question], q_vecs, timings)[0]
+    hits = hits_for_rows(top, meta_items, {})
 
-    c = client()
-    try:
-        resp = c.chat.completions.create(**payload)
-    except Exception as e:
-        if "temperature" in payload and "temperature" in str(e).lower():
-            payload.pop("temperature", None)
-            resp = c.chat.completions.create(**payload)
-        else:
-            raise
-    print((resp.choices[0].message.content or "").strip())
+    payload = chat_payload(args, answer_contexts(args, hits, index_chunk_overlap(index_path)), args.question)
+    if args.stream:
+        answer, gen = _chat_stream(client(), payload)
+    else:
+        answer, gen = _chat_timed(client(), payload)
+        print(answer, flush=True)
+    if cached:
+        cache.put(str(index_path), config, version, [(args.question, q_vecs[0], answer, hits)])
+    if args.timings:
+        _emit_timings(args, _timing_record(args, args.question, timings, gen, started, cached=False))
     return 0
 
 
@@ -1,88 +1,196 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""検索結果の再ランク付け。
+
+- local: 読み込み済みのベクトルだけで並べ替える（ネットワーク往復なし）。
+  関連度 = 質問との cosine + 質問の語の含有率（--lexical-weight）。
+  MMR（Maximal Marginal Relevance）で、似た候補ばかりが上位に並ばないように選ぶ（--mmr-lambda）。
+- chat: Chat に候補を採点させる（質問ごとに Chat が増える）。候補は --rerank-group-size 件ずつに分けて
+  最大 --rerank-workers 本の並列リクエストで採点し、0..1 に正規化した点で並べる。
+- auto: local で並べ、残す最後の候補（final_k 件目）と落とす最初の候補の関連度の差が --ambiguity 未満（境目が曖昧）のときだけ、
+  境目の前後 --rerank-group-size 件を chat で並べ直す（それより上位は MMR の順のまま）。
+"""
 from __future__ import annotations
 
 import argparse
 import json
+import random
+import sys
+import time
 from pathlib import Path
-from typing import Dict, List, Optional
-
-from common import client, embed_texts, pretty, top_k_similar
+from typing import Any, Dict, List, Optional, Tuple
 
+from common import add_search_args, client, embed_texts, normalize_rows, open_index, open_meta, pretty, query_dimensions, resolve_meta_path, search_opts, vectors_for_rows
+from filters import add_filter_args, filtered_searcher
+from query import chat_create
 
-def _load_meta(meta_path: Path) -> List[Dict]:
-    items: List[Dict] = []
-    if not meta_path.exists():
-        return items
-    with meta_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                items.append(json.loads(line))
-            except Exception:
-                pass
-    return items
+RERANK_MODES = ("local", "auto", "chat")
+RERANK_GROUP_SIZE = 10
+RERANK_WORKERS = 4
+RERANK_RETRIES = 2
 
 
-def _load_vectors(npz_path: Path):
-    import numpy as np
-    if not npz_path.exists():
-        raise FileNotFoundError(f"ベクトルが見つかりません: {npz_path}")
-    data = np.load(npz_path)
-    return data["vectors"]
-
-
-def _chat_rerank(question: str, candidates: List[str], model: str, max_tokens: int, temperature: Optional[float]) -> List[int]:
-    """Chatに候補を採点させ、上位のインデックスを返す。解析失敗時は元順序を返す。"""
-    c = client()
+def _score_group(c: Any, question: str, texts: List[str], model: str, max_tokens: int, temperature: Optional[float]) -> Dict[int, float]:
+    """1グループ分の候補を Chat に採点させ、{グループ内の番号: 0..1 に正規化した点} を返す。解析できなければ例外"""
     # シンプルなJSON出力を要求
     system = "あなたは問い合わせと候補テキストの関連度を0..10で採点する評価者です。"
     user = (
         "次の質問に対して、各候補の関連度を整数0..10で採点し、JSONで返してください。\n"
         "JSON形式: {\"scores\": [{\"index\": <int>, \"score\": <int>}, ...]}\n"
         f"質問: {question}\n"
-        "候補:\n" + "\n".join(f"[{i}] {txt[:500]}" for i, txt in enumerate(candidates))
+        "候補:\n" + "\n".join(f"[{i}] {txt[:500]}" for i, txt in enumerate(texts))
     )
     messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
     payload: Dict = {"model": model, "messages": messages, "max_tokens": max_tokens, "response_format": {"type": "json_object"}}
     if temperature is not None:
         payload["temperature"] = temperature
-    try:
-        resp = c.chat.completions.create(**payload)
-    except Exception:
-        # フォールバック: 温度なし
-        payload.pop("temperature", None)
-        resp = c.chat.completions.create(**payload)
+    # temperature 以外のエラー（429・5xx など）はそのまま上げ、呼び出し側の再試行とバックオフに任せる
+    resp = chat_create(c, payload)
 
-    text = (resp.choices[0].message.content or "").strip()
-    try:
-        data = json.loads(text)
-        scores = data.get("scores") or []
-        # 高得点順に index を返す
-        ordered = sorted(scores, key=lambda x: int(x.get("score", 0)), reverse=True)
-        idxs = [int(x.get("index")) for x in ordered if 0 <= int(x.get("index", -1)) < len(candidates)]
-        # 重複除去して返す（足りない分は元順序で補完）
-        seen = set()
-        result = []
-        for i in idxs:
-            if i not in seen:
-                seen.add(i)
-                result.append(i)
-        for i in range(len(candidates)):
-            if i not in seen:
-                result.append(i)
-        return result
-    except Exception:
+    data = json.loads((resp.choices[0].message.content or "").strip())
+    out: Dict[int, float] = {}
+    for x in data.get("scores") or []:
+        i = int(x.get("index", -1))
+        if 0 <= i < len(texts) and i not in out:
+            out[i] = min(max(float(x.get("score", 0)), 0.0), 10.0) / 10.0
+    if not out:
+        raise ValueError("採点結果がありません")
+    return out
+
+
+def _chat_rerank(
+    question: str,
+    candidates: List[str],
+    model: str,
+    max_tokens: int,
+    temperature: Optional[float],
+    c=None,
+    group_size: int = RERANK_GROUP_SIZE,
+    workers: int = RERANK_WORKERS,
+    retries: int = RERANK_RETRIES,
+) -> List[int]:
+    """Chatに候補を採点させ、上位のインデックスを返す。
+
+    候補は group_size 件ずつのグループに分け、最大 workers 本の並列リクエストで採点する（k が増えても1回のプロンプトは伸びない）。
+    失敗したグループはそのグループだけ retries 回まで再試行する。採点できなかった候補は採点済みの候補の平均点として扱い、
+    どのグループも採点できなければ元順序を返す。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not candidates:
+        return []
+    c = c or client()
+    groups = [list(range(s, min(s + group_size, len(candidates)))) for s in range(0, len(candidates), max(1, group_size))]
+
+    def score(group: List[int]) -> Dict[int, float]:
+        for attempt in range(retries + 1):
+            try:
+                return _score_group(c, question, [candidates[i] for i in group], model, max_tokens, temperature)
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if attempt >= retries or (status is not None and 400 <= status < 500 and status != 429):
+                    print(f"[rerank] 候補 {group[0]}..{group[-1]} の採点に失敗しました: {e}", file=sys.stderr)
+                    return {}
+                time.sleep(min(30.0, 0.5 * 2**attempt) * (0.5 + random.random()))
+        return {}
+
+    scores: Dict[int, float] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(groups)))) as pool:
+        for group, got in zip(groups, pool.map(score, groups)):
+            scores.update((group[j], s) for j, s in got.items())
+    if not scores:
         return list(range(len(candidates)))
+    neutral = sum(scores.values()) / len(scores)
+    # 高得点順（同点は元順序）
+    return sorted(range(len(candidates)), key=lambda i: (-scores.get(i, neutral), i))
+
+
+def local_rerank(question: str, q_vec, cand_vecs, texts: List[str], final_k: int, mmr_lambda: float = 0.7, lexical_weight: float = 0.1):
+    """(並べ替えた候補の番号, 各候補の関連度) を返す。
+
+    上位 final_k 件は MMR で選び、残りは関連度の順に続ける。
+    """
+    import numpy as np
+
+    from bm25_index import tokenize
+
+    n = len(texts)
+    if not n:
+        return [], np.zeros(0, dtype="float32")
+    c = normalize_rows(cand_vecs)
+    rel = c @ normalize_rows(np.asarray(q_vec, dtype="float32").reshape(-1))
+    terms = list(dict.fromkeys(tokenize(question)))
+    if terms and lexical_weight:
+        # 候補 x 質問の語 の出現行列の行平均 = 質問の語の含有率
+        col = {t: j for j, t in enumerate(terms)}
+        present = np.zeros((n, len(terms)), dtype="float32")
+        for i, text in enumerate(texts):
+            for t in col.keys() & set(tokenize(text)):
+                present[i, col[t]] = 1.0
+        rel = rel + lexical_weight * present.mean(axis=1)
+    sim = c @ c.T
+    chosen = np.zeros(n, dtype=bool)
+    max_sim = np.zeros(n, dtype="float32")
+    order: List[int] = []
+    for _ in range(min(final_k, n)):
+        # 関連度が高く、既に選んだ候補とは似ていないものを選ぶ
+        mmr = np.where(chosen, -np.inf, mmr_lambda * rel - (1.0 - mmr_lambda) * max_sim)
+        i = int(mmr.argmax())
+        order.append(i)
+        chosen[i] = True
+        max_sim = np.maximum(max_sim, sim[i])
+    rest = np.flatnonzero(~chosen)
+    order.extend(rest[np.argsort(-rel[rest], kind="stable")].tolist())
+    return order, rel
+
+
+def is_ambiguous(rel, order: List[int], final_k: int, margin: float) -> bool:
+    """local_rerank の順 order で、残す最後の候補と落とす最初の候補の関連度の差が margin 未満なら曖昧とみなす
+
+    MMR は多様性のために関連度の順を入れ替えるので、関連度を並べ直した順位ではなく order の境目で比べる。
+    """
+    if len(order) <= final_k or final_k <= 0:
+        return False
+    return bool(rel[order[final_k - 1]] - rel[order[final_k]] < margin)
+
+
+def boundary_window(order: List[int], final_k: int, size: int) -> Tuple[int, int]:
+    """境目（final_k）をまたぐ size 件の [start, end)。Chat にはこの範囲だけを並べ直させる"""
+    half = max(1, size // 2)
+    start = max(0, final_k - half)
+    return start, min(len(order), start + max(2, size))
+
+
+def rerank_candidates(args, question: str, q_vec, index_path: Path, rows: List[int], texts: List[str], final_k: int, c: Any = None) -> Tuple[List[int], bool]:
+    """--rerank に従って候補を並べ替え、(候補の番号の順, Chat を使ったか) を返す"""
+    temperature = None if args.no_temperature else args.temperature
+    opts = {"group_size": args.rerank_group_size, "workers": args.rerank_workers}
+    if args.rerank == "chat":
+        return _chat_rerank(question, texts, args.chat_model, max_tokens=256, temperature=temperature, c=c, **opts), True
+    order, rel = local_rerank(question, q_vec, vectors_for_rows(index_path, rows), texts, final_k, args.mmr_lambda, args.lexical_weight)
+    if args.rerank == "auto" and is_ambiguous(rel, order, final_k, args.ambiguity):
+        # Chat には境目の前後だけを渡す。それより上は MMR で選んだ順（多様化）をそのまま残す
+        s, e = boundary_window(order, final_k, args.rerank_group_size)
+        window = order[s:e]
+        chat_order = _chat_rerank(question, [texts[i] for i in window], args.chat_model, max_tokens=256, temperature=temperature, c=c, **opts)
+        return order[:s] + [window[j] for j in chat_order] + order[e:], True
+    return order, False
+
+
+def add_rerank_args(p: Any) -> None:
+    p.add_argument("--rerank", choices=RERANK_MODES, default="auto", help="local=ベクトルと語の一致のみ / chat=毎回 Chat で採点 / auto=境目が曖昧なときだけ Chat")
+    p.add_argument("--mmr-lambda", type=float, default=0.7, help="MMR: 関連度の重み（1.0 で多様化なし）")
+    p.add_argument("--lexical-weight", type=float, default=0.1, help="関連度に足す、質問の語の含有率の重み")
+    p.add_argument("--ambiguity", type=float, default=0.01, help="auto: 残す最後の候補と次の候補の関連度の差がこれ未満なら Chat で並べ直す")
+    p.add_argument("--rerank-group-size", type=int, default=RERANK_GROUP_SIZE, help="Chat 採点: 1リクエストで採点する候補数")
+    p.add_argument("--rerank-workers", type=int, default=RERANK_WORKERS, help="Chat 採点: 同時に送るリクエスト数の上限")
 
 
 def main(argv: Optional[List[str]] = None) -> int:
     p = argparse.ArgumentParser(description="RAG: re-rank top-K with Chat and answer")
     p.add_argument("--question", required=True)
-    p.add_argument("--index", default="./RAG/index/index.npz")
-    p.add_argument("--meta", default="./RAG/index/meta.jsonl")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
     p.add_argument("--k", type=int, default=8, help="初回取得K")
     p.add_argument("--final-k", type=int, default=4, help="最終的に使うK")
     p.add_argument("--emb-model", default="text-embedding-3-small")
@@ -91,30 +199,34 @@ def main(argv: Optional[List[str]] = None) -> int:
     p.add_argument("--max-tokens", type=int, default=512)
     p.add_argument("--temperature", type=float, default=0.2)
     p.add_argument("--no-temperature", action="store_true")
+    add_rerank_args(p)
+    add_search_args(p)
+    add_filter_args(p)
     p.add_argument("--dry-run", action="store_true")
     args = p.parse_args(argv)
 
     index_path = Path(args.index).resolve()
-    meta_path = Path(args.meta).resolve()
+    meta_path = resolve_meta_path(index_path, args.meta)
+    dimensions = query_dimensions(p, index_path, args.emb_model)
 
     if args.dry_run:
-        print("[DRY-RUN] rerank flow: embeddings -> top-K -> chat scoring -> final-K -> answer")
+        scoring = {"local": "local MMR scoring", "chat": "chat scoring", "auto": "local MMR scoring (chat only if ambiguous)"}[args.rerank]
+        print(f"[DRY-RUN] rerank flow: embeddings -> top-K -> {scoring} -> final-K -> answer")
         return 0
 
-    vectors = _load_vectors(index_path)
-    meta_items = _load_meta(meta_path)
+    meta_items = open_meta(meta_path)
     if not len(meta_items):
-        raise RuntimeError("meta.jsonl が空です。先に ingest.py を実行してください。")
+        raise RuntimeError("メタデータが空です。先に ingest.py を実行してください。")
 
-    q_vec = embed_texts([args.question], model=args.emb_model, dry_run=False)[0]
-    top = top_k_similar(q_vec, vectors, args.k)
-    candidates: List[str] = []
-    for i, score in top:
-        if 0 <= i < len(meta_items):
-            candidates.append(meta_items[i].get("text", ""))
+    q_vec = embed_texts([args.question], model=args.emb_model, dry_run=False, dimensions=dimensions)[0]
+    searcher, _ = open_index(index_path, args.backend, **search_opts(args))
+    searcher = filtered_searcher(searcher, index_path, meta_path, args.filter, meta_items)
+    top = [(i, score) for i, score in searcher.search(q_vec, args.k) if 0 <= i < len(meta_items)]
+    candidates: List[str] = [meta_items[i].get("text", "") for i, _ in top]
 
-    temp_val = None if args.no_temperature else args.temperature
-    order = _chat_rerank(args.question, candidates, args.chat_model, max_tokens=256, temperature=temp_val)
+    order, used_chat = rerank_candidates(args, args.question, q_vec, index_path, [i for i, _ in top], candidates, args.final_k)
+    if used_chat and args.rerank == "auto":
+        print("[rerank] 上位の境目が曖昧なため Chat で並べ直しました", file=sys.stderr)
 
     chosen = [candidates[i] for i in order[: args.final_k]]
     messages = [
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""常駐型の RAG 検索・回答サーバ（標準ライブラリの asyncio のみ）。
+
+- 起動時にインデックス（index.vec / meta.idx / manifest / 各バックエンドの補助ファイル）を1度だけ読み込み、
+  以降の質問は埋め込み1回 + 検索だけで返す（スクリプトを毎回起動する場合の読み込みコストが消える）。
+- インデックス関連ファイルの更新時刻を定期的に監視し、書き込みが落ち着いたら裏で読み込み直して差し替える。
+  読み込み中・失敗時も古いインデックスで応答を続ける。
+  差し替えた古いインデックスは、それを使う処理中のリクエストがすべて終わってから閉じる（シャードの検索プロセスなど）。
+- 埋め込み・検索・Chat はスレッドプールで実行し、複数リクエストを並行に処理する。
+  OpenAI クライアントはプロセスで1つ（shared_client）を共有し、HTTP 接続を使い回す。
+
+エンドポイント（JSON）:
+  GET  /health   読み込み済みインデックスの情報
+  POST /search   {"question": "...", "k": 4} または {"questions": [...]} -> 上位チャンク
+  POST /answer   {"question": "...", "k": 4, "mode": "plain" | "hyde" | "rerank", "final_k": 4} -> 回答 + 根拠
+                 /search と /answer は "filter": "type=pdf product=alpha"（filters.py の条件式。リストも可）で絞り込める
+  POST /reload   インデックスを即時に読み込み直す
+
+使い方:
+  python RAG/server.py --index RAG/index/index.vec --port 8000
+  curl -s localhost:8000/search -d '{"question": "RAG とは？"}'
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from common import add_search_args, batch_search, embed_texts, index_chunk_overlap, index_embedding, index_stamp, load_aliases, open_index, open_meta, pretty, resolve_meta_path, search_opts, shared_client
+from context_pack import add_context_args
+from filters import filtered_searcher, parse_filters
+from hyde_query import hyde_retrieve
+from query import answer_contexts, chat_answer, chat_payload, hits_for_rows
+from rerank_with_chat import add_rerank_args, rerank_candidates
+
+MAX_BODY = 1 << 20
+ANSWER_MODES = ("plain", "hyde", "rerank")
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class IndexState:
+    rows: int
+    meta_items: Any
+    searcher: Any
+    aliases: Dict[int, List[str]]
+    stamp: Tuple
+    loaded_at: float
+    dimensions: Optional[int] = None
+    chunk_overlap: Optional[int] = None
+    users: int = 0  # この state を使っている処理中のリクエスト数（イベントループ上でだけ増減する）
+    retired: bool = False
+
+
+class RagServer:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.index_path = Path(args.index).resolve()
+        self.meta_path = resolve_meta_path(self.index_path, args.meta)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, args.workers))
+        self.state: Optional[IndexState] = None
+        self._reload_lock = asyncio.Lock()
+
+    # ---- インデックス ----
+    def load(self) -> IndexState:
+        stamp = index_stamp(self.index_path, self.meta_path)
+        meta_items = open_meta(self.meta_path)
+        if not len(meta_items):
+            raise RuntimeError("メタデータが空です。先に ingest.py を実行してください。")
+        searcher, rows = open_index(self.index_path, self.args.backend, **search_opts(self.args))
+        aliases = load_aliases(self.index_path)
+        # 質問の埋め込みはインデックスのヘッダーに記録された次元数に合わせる（再読み込みで変わることもある）
+        dimensions = index_embedding(self.index_path, self.args.emb_model)
+        return IndexState(
+            rows=rows, meta_items=meta_items, searcher=searcher, aliases=aliases, stamp=stamp, loaded_at=time.time(),
+            dimensions=dimensions, chunk_overlap=index_chunk_overlap(self.index_path),
+        )
+
+    async def reload(self) -> IndexState:
+        async with self._reload_lock:
+            state = await self._run(self.load)
+            old, self.state = self.state, state
+            # 処理中のリクエストは古い state を参照し続けるので、閉じるのは最後の1件が終わってから
+            if old is not None:
+                old.retired = True
+                if not old.users:
+                    self._close_state(old)
+            print(f"[reload] rows={state.rows} (was {old.rows if old else 0})", flush=True)
+            return state
+
+    def _close_state(self, st: IndexState) -> None:
+        close = getattr(st.searcher, "close", None)
+        if close is not None:
+            # シャードの検索プロセスの終了待ちでイベントループを止めないよう、スレッドプールで閉じる
+            self.pool.submit(close)
+
+    async def watch(self) -> None:
+        """更新時刻を監視し、2回続けて同じ値（書き込み完了）になったら読み込み直す"""
+        seen = self.state.stamp if self.state else None
+        while True:
+            await asyncio.sleep(self.args.reload_interval)
+            stamp = await self._run(index_stamp, self.index_path, self.meta_path)
+            if self.state is not None and stamp == self.state.stamp:
+                seen = stamp
+                continue
+            if stamp != seen:
+                seen = stamp
+                continue
+            try:
+                await self.reload()
+            except Exception as e:
+                print(f"[reload] failed, keep serving the previous index: {e}", file=sys.stderr, flush=True)
+                seen = None
+
+    async def _run(self, fn, *a):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *a)
+
+    def _state(self) -> IndexState:
+        if self.state is None:
+            raise HTTPError(503, "index is not loaded")
+        return self.state
+
+    async def _run_with_state(self, fn, *a):
+        """現在の state を fn(state, *a) の実行中だけ使用中にする（reload 後に閉じられないように）"""
+        st = self._state()
+        st.users += 1
+        try:
+            return await self._run(fn, st, *a)
+        finally:
+            st.users -= 1
+            if st.retired and not st.users:
+                self._close_state(st)
+
+    # ---- 処理本体（スレッドプール上で実行） ----
+    def _searcher(self, st: IndexState, filters: Optional[List[str]]) -> Any:
+        # マスクは filters.py がインデックスの版ごとにキャッシュするので、同じ条件の2回目以降は作り直さない
+        return filtered_searcher(st.searcher, self.index_path, self.meta_path, filters, st.meta_items)
+
+    def _search(self, st: IndexState, questions: List[str], k: int, filters: Optional[List[str]] = None) -> List[List[Dict]]:
+        q_vecs = embed_texts(questions, model=self.args.emb_model, dry_run=False, dimensions=st.dimensions)
+        return [hits_for_rows(top, st.meta_items, st.aliases) for top in batch_search(self._searcher(st, filters), q_vecs, k)]
+
+    def _answer(self, st: IndexState, question: str, k: int, mode: str, final_k: int, filters: Optional[List[str]] = None) -> Dict:
+        c = shared_client()
+        searcher = self._searcher(st, filters)
+        if mode == "hyde":
+            top, _ = hyde_retrieve(self.args, searcher, question, k, self.args.hypotheses, c=c, dimensions=st.dimensions)
+        else:
+            q_vecs = embed_texts([question], model=self.args.emb_model, dry_run=False, dimensions=st.dimensions)
+            top = batch_search(searcher, q_vecs, k)[0]
+        hits = hits_for_rows(top, st.meta_items, st.aliases)
+        if mode == "rerank":
+            rows, texts = [h["row"] for h in hits], [h["text"] for h in hits]
+            order, _ = rerank_candidates(self.args, question, q_vecs[0], self.index_path, rows, texts, final_k, c=c)
+            hits = [hits[i] for i in order[:final_k]]
+        answer = chat_answer(c, chat_payload(self.args, answer_contexts(self.args, hits, st.chunk_overlap), question))
+        return {"question": question, "mode": mode, "answer": answer, "hits": hits}
+
+    # ---- エンドポイント ----
+    async def route(self, method: str, path: str, body: Dict) -> Dict:
+        if path == "/health":
+            st = self.state
+            return {
+                "status": "ok" if st else "loading",
+                "rows": st.rows if st else 0,
+                "chunks": len(st.meta_items) if st else 0,
+                "backend": self.args.backend,
+                "loaded_at": st.loaded_at if st else None,
+            }
+        if path not in ("/search", "/answer", "/reload"):
+            raise HTTPError(404, f"unknown path: {path}")
+        if method != "POST":
+            raise HTTPError(405, f"{path} は POST のみです")
+        if path == "/reload":
+            st = await self.reload()
+            return {"status": "ok", "rows": st.rows, "loaded_at": st.loaded_at}
+        k = int(body.get("k", self.args.k))
+        filters = body.get("filter")
+        if isinstance(filters, str):
+            filters = [filters]
+        if filters is not None and not (isinstance(filters, list) and all(isinstance(f, str) for f in filters)):
+            raise HTTPError(400, '"filter" は条件式の文字列かそのリストにしてください')
+        parse_filters(filters)
+        if path == "/search":
+            questions = body.get("questions") or ([body["question"]] if body.get("question") else [])
+            if not questions or not all(isinstance(q, str) and q for q in questions):
+                raise HTTPError(400, '"question" か "questions" を指定してください')
+            results = await self._run_with_state(self._search, questions, k, filters)
+            return {"results": [{"question": q, "hits": h} for q, h in zip(questions, results)]}
+        # /answer
+        question = body.get("question")
+        mode = body.get("mode", "plain")
+        if not isinstance(question, str) or not question:
+            raise HTTPError(400, '"question" を指定してください')
+        if mode not in ANSWER_MODES:
+            raise HTTPError(400, f"mode は {ANSWER_MODES} のいずれかです")
+        final_k = int(body.get("final_k", self.args.k))
+        if mode == "rerank" and "k" not in body:
+            k = max(k, final_k * 2)
+        return await self._run_with_state(self._answer, question, k, mode, final_k, filters)
+
+    # ---- HTTP/1.1（keep-alive 対応の最小実装） ----
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.decode("latin-1").split()
+                headers: Dict[str, str] = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = h.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close" and (len(parts) < 3 or parts[2] != "HTTP/1.0")
+                t0 = time.perf_counter()
+                try:
+                    if len(parts) < 2:
+                        raise HTTPError(400, "bad request line")
+                    method, path = parts[0].upper(), parts[1].split("?", 1)[0]
+                    length = int(headers.get("content-length", "0") or 0)
+                    if length > MAX_BODY:
+                        keep_alive = False
+                        raise HTTPError(413, f"body は {MAX_BODY} バイトまでです")
+                    raw = await reader.readexactly(length) if length else b""
+                    try:
+                        body = json.loads(raw) if raw.strip() else {}
+                    except ValueError:
+                        raise HTTPError(400, "body が JSON ではありません")
+                    if not isinstance(body, dict):
+                        raise HTTPError(400, "body は JSON オブジェクトにしてください")
+                    status, out = 200, await self.route(method, path, body)
+                except HTTPError as e:
+                    status, out = e.status, {"error": str(e)}
+                except (KeyError, TypeError, ValueError) as e:
+                    status, out = 400, {"error": str(e)}
+                except Exception as e:
+                    status, out = 500, {"error": f"{type(e).__name__}: {e}"}
+                data = json.dumps(out, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                        "Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if self.args.verbose:
+                    print(f"{parts[0] if parts else '-'} {parts[1] if len(parts) > 1 else '-'} {status} {(time.perf_counter() - t0) * 1000:.1f}ms", flush=True)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        await self.reload()
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        print(f"serving on http://{self.args.host}:{self.args.port} (backend={self.args.backend})", flush=True)
+        watcher = asyncio.create_task(self.watch()) if self.args.reload_interval > 0 else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher:
+                watcher.cancel()
+            self.pool.shutdown(wait=False)
+            close = getattr(self.state.searcher, "close", None) if self.state else None
+            if close is not None:
+                close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: long-running HTTP server for search / answer")
+    p.add_argument("--index", default="./RAG/index/index.vec")
+    p.add_argument("--meta", default="./RAG/index/meta.idx")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--workers", type=int, default=8, help="埋め込み・検索・Chat を並列に処理するスレッド数")
+    p.add_argument("--reload-interval", type=float, default=2.0, help="インデックス更新の監視間隔（秒。0 で監視しない）")
+    p.add_argument("--k", type=int, default=4)
+    p.add_argument("--emb-model", default="text-embedding-3-small")
+    p.add_argument("--chat-model", default="gpt-5")
+    p.add_argument("--system", default="あなたは有能な日本語アシスタントです。提供されたコンテキストのみを根拠に、誠実に回答してください。根拠がなければ『不明です』と答えてください。")
+    p.add_argument("--max-tokens", type=int, default=512)
+    p.add_argument("--temperature", type=float, default=0.2)
+    p.add_argument("--no-temperature", action="store_true")
+    p.add_argument("--hypotheses", type=int, default=3, help="mode=hyde: 1回の生成で作る仮想文書の数")
+    add_rerank_args(p)
+    add_context_args(p)
+    add_search_args(p)
+    p.add_argument("--verbose", action="store_true", help="リクエストごとにログを出す")
+    p.add_argument("--dry-run", action="store_true")
+    args = p.parse_args(argv)
+
+    if args.dry_run:
+        print("[DRY-RUN] server config:")
+        print(pretty({k: v for k, v in vars(args).items() if k != "system"}))
+        print("[DRY-RUN] endpoints: GET /health, POST /search, POST /answer, POST /reload")
+        return 0
+
+    try:
+        asyncio.run(RagServer(args).serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
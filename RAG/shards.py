@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""シャード分割したインデックス（ingest.py --shards N で作る）。
+
+- 構成: index.shards.json に各シャードの index.vec / meta.idx の場所を並べる。
+  シャードはそれぞれ普通のインデックス（マニフェスト・tombstone・IVF などの付随ファイルも個別）なので、
+  別プロセス・別マシンで独立に投入できる（ingest.py --shards N --shard I）。
+  ファイルは入力ディレクトリからの相対パスのハッシュでシャードに振り分ける（どの実行でも同じシャードに入る）。
+- 検索: シャードごとに常駐プロセスを1つ起動し、それぞれが自分のシャードを memmap で開いて検索する。
+  各シャードの上位 k 件（スコア降順）をヒープでマージして全体の上位 k 件にする。
+  要求には番号を付けてパイプに流し、シャードごとの受信スレッドが番号で呼び出し元へ振り分ける。
+  検索プロセスも要求をスレッドで並行に処理するので、server.py の同時リクエストが1本ずつに並ばない。
+- 行番号: シャードを順に並べた通し番号（シャード s の r 行目 = s より前のシャードの行数の合計 + r）。
+
+使い方:
+  python RAG/ingest.py --shards 4                # 全シャードを順に投入
+  python RAG/ingest.py --shards 4 --shard 2      # シャード 2 だけ（複数プロセスで並行に流せる）
+  python RAG/query.py --index RAG/index/index.shards.json --question "..."
+  python RAG/shards.py --index RAG/index/index.shards.json   # 各シャードの行数を表示
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from common import batch_search, load_live_mask, load_vectors, open_meta, open_searcher, pretty, read_vec_header, sidecar_path
+
+SHARDS_VERSION = 1
+# 検索プロセス1つが同時に処理する要求の数（行列積は GIL を離すのでスレッドで並行に進む）
+SHARD_THREADS = 4
+
+
+def shard_of(rel: str, n_shards: int) -> int:
+    """入力ディレクトリからの相対パス（/ 区切り）から、ファイルを入れるシャード番号を決める"""
+    return int.from_bytes(hashlib.blake2b(rel.encode("utf-8"), digest_size=8).digest(), "little") % n_shards
+
+
+def shard_paths(out_vec: Path, meta_path: Path, shard: int) -> Tuple[Path, Path]:
+    """シャード shard の (index.vec, meta.idx)。index.vec と同じ場所の shard-000/ などに置く"""
+    d = Path(out_vec).parent / f"shard-{shard:03d}"
+    return d / Path(out_vec).name, d / Path(meta_path).name
+
+
+def write_shard_set(out_vec: Path, meta_path: Path, n_shards: int) -> Path:
+    """index.shards.json を作る（既にあればシャード数が一致するか確かめるだけ）"""
+    path = sidecar_path(out_vec, ".shards.json")
+    if path.exists():
+        have = len(read_shard_set(path))
+        if have != n_shards:
+            raise ValueError(f"既存のシャード数（{have}）と --shards {n_shards} が違います。シャード数を変えるときは {path.parent} を作り直してください。")
+        return path
+    shards = []
+    for s in range(n_shards):
+        vec, meta = shard_paths(out_vec, meta_path, s)
+        shards.append({"index": vec.relative_to(path.parent).as_posix(), "meta": meta.relative_to(path.parent).as_posix()})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 複数のシャードを並行に投入しても内容は同じなので、置き換えの競合は問題にならない
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"format": "ragshards", "version": SHARDS_VERSION, "shards": shards}, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+    return path
+
+
+def read_shard_set(path: Path) -> List[Tuple[Path, Path]]:
+    """index.shards.json から各シャードの (index.vec, meta.idx) の絶対パスを返す"""
+    path = Path(path)
+    data = json.loads(path.read_text(encoding="utf-8"))
+    if data.get("format") != "ragshards":
+        raise ValueError(f"シャード構成ファイルではありません: {path}")
+    if int(data.get("version", 0)) > SHARDS_VERSION:
+        raise ValueError(f"未対応のシャード構成の版です: {data.get('version')}")
+    return [((path.parent / s["index"]).resolve(), (path.parent / s["meta"]).resolve()) for s in data["shards"]]
+
+
+def _shard_rows(index_path: Path) -> int:
+    # 投入前のシャードは空として扱う
+    return int(read_vec_header(index_path)["rows"]) if index_path.exists() else 0
+
+
+class ShardedMeta:
+    """全シャードのメタデータを通し番号で引く（MetaStore と同じく len() / [i] / [a:b] / for が使える）"""
+
+    def __init__(self, path: Path) -> None:
+        self.shards = read_shard_set(path)
+        # 行番号の割り当ては検索側（ベクトルの行数）と揃える
+        rows = [_shard_rows(vec) for vec, _ in self.shards]
+        self.offsets = [0] + list(itertools.accumulate(rows))
+        self.metas = [open_meta(meta) for _, meta in self.shards]
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def locate(self, i: int) -> Tuple[int, int]:
+        """通し番号 -> (シャード番号, シャード内の行番号)"""
+        import bisect
+
+        s = bisect.bisect_right(self.offsets, i) - 1
+        return s, i - self.offsets[s]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s, r = self.locate(i)
+        return self.metas[s][r]
+
+    def __iter__(self) -> Iterator[Dict]:
+        for meta, n in zip(self.metas, (b - a for a, b in zip(self.offsets, self.offsets[1:]))):
+            for r in range(n):
+                yield meta[r]
+
+
+def load_shard_aliases(path: Path) -> Dict[int, List[str]]:
+    """各シャードのマニフェストの別名（ingest.py --dedup）を通し番号に直して返す"""
+    from common import load_aliases
+
+    meta = ShardedMeta(path)
+    out: Dict[int, List[str]] = {}
+    for (vec, _), off in zip(meta.shards, meta.offsets):
+        for row, files in load_aliases(vec).items():
+            out[off + row] = files
+    return out
+
+
+def shard_vectors(path: Path, rows: List[int]):
+    """通し番号の行のベクトルを、各シャードの index.vec から集める"""
+    import numpy as np
+
+    shards = read_shard_set(path)
+    offsets = np.asarray([0] + list(itertools.accumulate(_shard_rows(vec) for vec, _ in shards)), dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    which = np.searchsorted(offsets, rows, side="right") - 1
+    out = None
+    for s in np.unique(which).tolist():
+        sel = np.flatnonzero(which == s)
+        part = load_vectors(shards[s][0])[rows[sel] - offsets[s]]
+        if out is None:
+            out = np.zeros((len(rows), part.shape[1]), dtype="float32")
+        out[sel] = part
+    return out if out is not None else np.zeros((0, 0), dtype="float32")
+
+
+def _search_shard(searcher: Any, vec: Path, meta: Path, qs, k: int, filters: Optional[List[str]]) -> List[List[Tuple[int, float]]]:
+    """シャード1つを検索する（filters があれば、そのシャードのメタデータからマスクを作って絞り込む）"""
+    if searcher is None:
+        return [[] for _ in qs]
+    if filters:
+        from filters import filtered_searcher
+
+        searcher = filtered_searcher(searcher, vec, meta, filters)
+    return batch_search(searcher, qs, k)
+
+
+def _shard_worker(conn, index_path: str, meta_path: str, backend: str, opts: Dict[str, Any]) -> None:
+    """シャード1つを開いて常駐し、(要求番号, 質問ベクトル, k, 絞り込み条件) を受け取るたびに (要求番号, エラー, 上位 k 件) を返す"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        vectors = load_vectors(Path(index_path)) if Path(index_path).exists() else None
+        searcher = None
+        if vectors is not None and len(vectors):
+            searcher = open_searcher(Path(index_path), vectors, backend, mask=load_live_mask(Path(index_path), len(vectors)), **opts)
+        conn.send((None, len(vectors) if vectors is not None else 0))
+    except Exception as e:
+        conn.send((f"{type(e).__name__}: {e}", None))
+        return
+    send_lock = threading.Lock()
+
+    def handle(rid: int, qs, k: int, filters: Optional[List[str]]) -> None:
+        try:
+            reply = (rid, None, _search_shard(searcher, Path(index_path), Path(meta_path), qs, k, filters))
+        except Exception as e:
+            reply = (rid, f"{type(e).__name__}: {e}", None)
+        with send_lock:
+            conn.send(reply)
+
+    # 返す順は終わった順（呼び出し側は要求番号で受け取る）
+    with ThreadPoolExecutor(max_workers=SHARD_THREADS) as pool:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                return
+            if msg is None:
+                return
+            pool.submit(handle, *msg)
+
+
+def _read_replies(conn, pending: Dict[int, Any], dead: List[bool], i: int, lock: threading.Lock) -> None:
+    """シャード i の返事を受け取り続け、要求番号の Future に渡す（シャードごとの受信スレッド）
+
+    検索器そのものは参照しない（参照すると __del__ が走らず、検索プロセスが残る）。
+    """
+    while True:
+        try:
+            rid, err, res = conn.recv()
+        except (EOFError, OSError):
+            break
+        with lock:
+            fut = pending.pop(rid, None)
+        if fut is not None:
+            fut.set_result((err, res))
+    # 検索プロセスが終わった: 返事を待っている要求は失敗にする
+    with lock:
+        dead[i] = True
+        waiting = list(pending.values())
+        pending.clear()
+    for fut in waiting:
+        fut.set_result(("検索プロセスが終了しました", None))
+
+
+class ShardedSearcher:
+    """シャードごとの常駐プロセスで並列に検索し、上位 k 件をマージする検索器（search / search_batch / close）。
+
+    procs=False なら子プロセスを使わず、同じプロセスで順に検索する（小さなシャード・デバッグ用）。
+    """
+
+    def __init__(self, path: Path, backend: str = "exact", procs: bool = True, **opts: Any) -> None:
+        self.shards = read_shard_set(path)
+        self._lock = threading.Lock()
+        self._rid = itertools.count()
+        # シャードごとの 送信ロック と 返事待ちの要求（要求番号 -> Future）
+        self._send_locks: List[threading.Lock] = []
+        self._pending: List[Dict[int, Any]] = []
+        self._dead: List[bool] = []
+        self._readers: List[threading.Thread] = []
+        self._conns: List[Any] = []
+        self._procs: List[Any] = []
+        self._local: List[Any] = []
+        self.filters: Optional[List[str]] = None
+        # with_filters で作った検索器は検索プロセスを借りているだけなので、閉じるのは元の検索器に任せる
+        self._borrowed = False
+        rows: List[int] = []
+        if procs:
+            import multiprocessing as mp
+
+            # fork はスレッドを持つ親（server.py）で危ないので、どの OS でも spawn で起動する
+            ctx = mp.get_context("spawn")
+            for vec, meta in self.shards:
+                parent, child = ctx.Pipe()
+                p = ctx.Process(target=_shard_worker, args=(child, str(vec), str(meta), backend, opts), daemon=True)
+                p.start()
+                child.close()
+                self._conns.append(parent)
+                self._procs.append(p)
+                self._send_locks.append(threading.Lock())
+                self._pending.append({})
+                self._dead.append(False)
+            try:
+                for conn, (vec, _) in zip(self._conns, self.shards):
+                    try:
+                        err, n = conn.recv()
+                    except EOFError:
+                        err = "検索プロセスが終了しました"
+                    if err:
+                        raise RuntimeError(f"シャードを開けませんでした: {vec}: {err}")
+                    rows.append(n)
+            except BaseException:
+                self.close()
+                raise
+            for i, conn in enumerate(self._conns):
+                t = threading.Thread(target=_read_replies, args=(conn, self._pending[i], self._dead, i, self._lock), daemon=True)
+                t.start()
+                self._readers.append(t)
+        else:
+            for vec, _ in self.shards:
+                vectors = load_vectors(vec) if vec.exists() else None
+                if vectors is None or not len(vectors):
+                    self._local.append(None)
+                    rows.append(0)
+                    continue
+                self._local.append(open_searcher(vec, vectors, backend, mask=load_live_mask(vec, len(vectors)), **opts))
+                rows.append(len(vectors))
+        self.offsets = [0] + list(itertools.accumulate(rows))
+        self.rows = self.offsets[-1]
+
+    def _fan_out(self, qs, k: int) -> List[List[List[Tuple[int, float]]]]:
+        """シャードごとの [質問ごとの上位 k 件] を返す"""
+        from concurrent.futures import Future
+
+        if not self._conns:
+            return [_search_shard(s, vec, meta, qs, k, self.filters) for s, (vec, meta) in zip(self._local, self.shards)]
+        # 全シャードに送ってから待つ。他の検索の返事とは要求番号で区別するので、検索どうしも並行に進む
+        futs = []
+        for i, conn in enumerate(self._conns):
+            fut: Future = Future()
+            with self._lock:
+                alive = not self._dead[i]
+                rid = next(self._rid)
+                if alive:
+                    self._pending[i][rid] = fut
+            if alive:
+                try:
+                    with self._send_locks[i]:
+                        conn.send((rid, qs, k, self.filters))
+                except OSError:
+                    # 受信スレッドがまだ片付けていなければ、ここで失敗にする
+                    with self._lock:
+                        mine = self._pending[i].pop(rid, None)
+                    if mine is not None:
+                        fut.set_result(("検索プロセスが終了しました", None))
+            else:
+                fut.set_result(("検索プロセスが終了しました", None))
+            futs.append(fut)
+        out = []
+        for fut in futs:
+            err, res = fut.result()
+            if err:
+                raise RuntimeError(f"シャードの検索に失敗しました: {err}")
+            out.append(res)
+        return out
+
+    def with_filters(self, filters: List[str]) -> "ShardedSearcher":
+        """絞り込み条件付きの検索器（検索プロセスは共有し、条件は検索ごとに各シャードへ送る）"""
+        import copy
+
+        out = copy.copy(self)
+        out.filters = filters
+        out._borrowed = True
+        # 元の検索器が先に回収されると検索プロセスが閉じられるので、参照を持っておく
+        out._owner = self
+        return out
+
+    def search_batch(self, queries, k: int) -> List[List[Tuple[int, float]]]:
+        import numpy as np
+
+        qs = np.asarray(queries, dtype="float32")
+        per_shard = self._fan_out(qs, k)
+        merged = []
+        for n in range(len(qs)):
+            # 各シャードの結果はスコア降順なので、ヒープで k 件だけ取り出せばよい
+            runs = [[(off + i, s) for i, s in res[n]] for off, res in zip(self.offsets, per_shard)]
+            merged.append(list(itertools.islice(heapq.merge(*runs, key=lambda x: -x[1]), k)))
+        return merged
+
+    def search(self, query_vec, k: int) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        return self.search_batch(np.asarray(query_vec, dtype="float32").reshape(1, -1), k)[0]
+
+    def close(self) -> None:
+        if self._borrowed:
+            return
+        for i, conn in enumerate(self._conns):
+            try:
+                # 検索プロセスは処理中の要求を返し終えてから終わる。パイプは受信スレッドが EOF を見てから閉じる
+                with self._send_locks[i]:
+                    conn.send(None)
+            except OSError:
+                pass
+        for p in self._procs:
+            p.join(timeout=5)
+        for t in self._readers:
+            t.join(timeout=5)
+        for conn in self._conns:
+            try:
+                conn.close()
+            except OSError:
+                pass
+        self._conns, self._procs, self._readers = [], [], []
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="RAG: show shards of a sharded index")
+    p.add_argument("--index", default="./RAG/index/index.shards.json")
+    args = p.parse_args(argv)
+
+    meta = ShardedMeta(Path(args.index).resolve())
+    shards = []
+    for (vec, m), a, b in zip(meta.shards, meta.offsets, meta.offsets[1:]):
+        mask = load_live_mask(vec, b - a) if vec.exists() else None
+        shards.append({"index": str(vec), "meta": str(m), "rows": b - a, "live": int(mask.sum()) if mask is not None else b - a})
+    print(pretty({"shards": shards, "rows": len(meta)}))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""context_pack の区間結合と詰め込み順の回帰テスト（python -m pytest RAG/tests）"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import chunk_text  # noqa: E402
+from context_pack import merge_spans, pack_contexts, score_gap_cutoff  # noqa: E402
+
+
+def _hits(chunks, order, file="a.md"):
+    return [{"row": i, "score": 1.0 - n * 0.1, "file": file, "chunk_index": i, "text": chunks[i]} for n, i in enumerate(order)]
+
+
+def test_repetitive_text_merges_back_to_source():
+    # 周期的な本文では末尾と先頭の一致が本当の重なりより長くなる。記録した重なりだけを除くこと
+    source = "H He Li Be B C N O F Ne " * 200
+    chunks = chunk_text(source, chunk_size=800, chunk_overlap=200)
+    spans = merge_spans(_hits(chunks, [1, 0, 2]), overlap=200)
+    assert len(spans) == 1
+    assert spans[0]["text"] == source[:2000]
+
+
+def test_short_last_chunk_merges_back_to_source():
+    # 最後のチャンクは重なりより短いことがある
+    source = "abcdefghij" * 25
+    chunks = chunk_text(source, chunk_size=100, chunk_overlap=30)
+    spans = merge_spans(_hits(chunks, range(len(chunks))), overlap=30)
+    assert [s["text"] for s in spans] == [source]
+
+
+def test_unknown_overlap_keeps_chunks_apart():
+    chunks = chunk_text("x" * 300, chunk_size=100, chunk_overlap=20)
+    spans = merge_spans(_hits(chunks, [0, 1]), overlap=None)
+    assert [s["text"] for s in spans] == chunks[:2]
+
+
+def test_packing_follows_hit_order_not_score():
+    # 再ランク後の並び（スコアは元の検索のまま）を優先して予算に詰める
+    hits = [
+        {"row": 7, "score": 0.2, "file": "b.md", "chunk_index": 0, "text": "bbbb"},
+        {"row": 3, "score": 0.9, "file": "a.md", "chunk_index": 0, "text": "aaaa"},
+    ]
+    spans = pack_contexts(hits, max_tokens=4, count=len, overlap=0)
+    assert [s["text"] for s in spans] == ["bbbb"]
+    spans = pack_contexts(hits, max_tokens=0, count=len, overlap=0)
+    assert [s["text"] for s in spans] == ["bbbb", "aaaa"]
+
+
+def test_score_gap_ignores_rerank_order():
+    # 再ランクで上がった低スコアの候補が、後ろの高スコアの候補まで打ち切ってはいけない
+    hits = [
+        {"row": 1, "score": 0.90, "file": "a.md", "chunk_index": 0, "text": "a"},
+        {"row": 2, "score": 0.30, "file": "b.md", "chunk_index": 0, "text": "b"},
+        {"row": 3, "score": 0.88, "file": "c.md", "chunk_index": 0, "text": "c"},
+    ]
+    kept = score_gap_cutoff(hits, 0.1)
+    assert [h["row"] for h in kept] == [1, 3]
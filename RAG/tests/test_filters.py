@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""絞り込み検索の回帰テスト: 条件に合う行が質問から遠くても、近似検索が min(k, 該当行数) 件を返すこと"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from common import normalize_rows, save_vectors  # noqa: E402
+from hnsw_index import HNSWSearcher, update_hnsw  # noqa: E402
+from ivf_index import IVFSearcher, build_ivf  # noqa: E402
+
+K = 10
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    centers = normalize_rows(rng.standard_normal((16, 16)).astype("float32"))
+    labels = rng.integers(0, len(centers), 3000)
+    vectors = normalize_rows(centers[labels] + 0.05 * rng.standard_normal((len(labels), 16)).astype("float32"))
+    index_path = tmp_path_factory.mktemp("ix") / "index.vec"
+    save_vectors(index_path, vectors)
+    build_ivf(index_path, n_lists=16)
+    update_hnsw(index_path, progress=False)
+    # 質問はクラスタ 0 の中心、条件に合うのは質問から最も遠いクラスタだけ
+    q = centers[0]
+    far = int(np.argmin(centers @ q))
+    return index_path, vectors, q, labels == far
+
+
+def _check(searcher, vectors, q, mask):
+    hits = searcher.search(q, K)
+    assert len(hits) == min(K, int(mask.sum()))
+    assert all(mask[r] for r, _ in hits)
+    for r, s in hits:
+        assert s == pytest.approx(float(vectors[r] @ q), abs=1e-5)
+
+
+def test_ivf_keeps_probing_until_k_rows_pass_the_mask(corpus):
+    index_path, vectors, q, mask = corpus
+    _check(IVFSearcher(index_path, vectors, mask=mask, nprobe=1), vectors, q, mask)
+
+
+def test_hnsw_walks_through_masked_out_nodes(corpus):
+    index_path, vectors, q, mask = corpus
+    _check(HNSWSearcher(index_path, vectors, mask=mask, ef=K), vectors, q, mask)